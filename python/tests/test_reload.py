@@ -0,0 +1,51 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+# The game loads its content relative to the python directory
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, GAME_DIR)
+import tworld
+
+# A room added to the map, through a door that's already there
+NEW_ROOM = '''		{
+			"id": "rom900",
+			"name": "Secret Garden",
+			"description": "Roses everywhere.",
+			"doors": ["dor001"]
+		},
+'''
+
+@pytest.fixture
+def game(tmp_path, monkeypatch):
+	# The content files are edited, so the game runs on a copy of them
+	shutil.copy(os.path.join(GAME_DIR, "config.json"), tmp_path)
+	for name in ("entities", "maps"):
+		shutil.copytree(os.path.join(GAME_DIR, name), tmp_path / name)
+	monkeypatch.chdir(tmp_path)
+	game = tworld.Game("config.json")
+	game.register_controller(tworld.GameCommandController)
+	game.player.name = "admin"
+	game.map.change_room(eid=game.settings.get("start"))
+	return game
+
+def add_room(filepath):
+	with open(filepath) as f:
+		content = f.read()
+	content = content.replace("\t\t## Doors\n", "\t\t## Doors\n" + NEW_ROOM, 1)
+	with open(filepath, "w") as f:
+		f.write(content)
+	# Changes are noticed by their modification time and size
+	os.utime(filepath, ns=(0, 0))
+
+def test_completion_after_reload_adds_room(game):
+	controller = game.cmd_controller
+	assert controller.get_completions("travel rom9") == []
+	assert controller.get_completions("give rom9") == []
+	add_room(os.path.join("maps", "a_mad_map.json"))
+	assert game.execute("reload").startswith("Reloaded rom900")
+	assert game.map.get_room("rom900") is not None
+	assert controller.get_completions("travel rom9") == ["rom900"]
+	assert controller.get_completions("give rom9") == ["rom900"]
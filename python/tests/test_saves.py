@@ -0,0 +1,50 @@
+import os
+import sys
+import shutil
+
+import pytest
+
+# The game loads its content relative to the python directory
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, GAME_DIR)
+import tworld
+
+# Pickled by the game before saves had a format of their own, after
+# equipping a sword and walking into the main hall
+BASELINE_SAVE = os.path.join(GAME_DIR, "tests", "data", "baseline.tsave")
+
+@pytest.fixture
+def game(tmp_path, monkeypatch):
+	monkeypatch.chdir(GAME_DIR)
+	game = tworld.Game("config.json")
+	game.register_controller(tworld.GameCommandController)
+	game.player.name = "admin"
+	game.map.change_room(eid=game.settings.get("start"))
+	# Saves are written to and read from the working directory
+	for name in ("config.json", "entities", "maps"):
+		os.symlink(os.path.join(GAME_DIR, name), tmp_path / name)
+	monkeypatch.chdir(tmp_path)
+	return game
+
+def test_load_baseline_pickle(game):
+	shutil.copy(BASELINE_SAVE, ".baseline.tsave")
+	assert game.execute("load baseline").startswith("Loaded game 'baseline'")
+	assert game.map.current_room.eid == "rom002"
+	assert game.player.get_weapon().eid == "wep001"
+	assert game.player.get_attack_damage() == 20
+	# Commands that lock rooms, find routes and log changes all work
+	game.execute("attack until; pickup bread; travel rom010")
+	assert game.map.current_room.eid == "rom010"
+	assert game.execute("undo").startswith("Time rewinds...")
+	assert game.map.current_room.eid == "rom002"
+
+def test_resave_baseline_pickle(game):
+	shutil.copy(BASELINE_SAVE, ".baseline.tsave")
+	game.execute("load baseline")
+	items = sorted(item.name for item in game.player.inventory.get_items())
+	assert game.execute("save resaved").startswith("Saved game")
+	game.execute("go through door dor001")
+	assert game.execute("load resaved").startswith("Loaded game 'resaved'")
+	assert game.map.current_room.eid == "rom002"
+	assert sorted(item.name for item in game.player.inventory.get_items()) == items
+	assert game.player.get_weapon().eid == "wep001"
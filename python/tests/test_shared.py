@@ -0,0 +1,43 @@
+import os
+import sys
+import threading
+
+import pytest
+
+# The game loads its content relative to the python directory
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, GAME_DIR)
+import tworld
+
+@pytest.fixture
+def world(monkeypatch):
+	monkeypatch.chdir(GAME_DIR)
+	world = tworld.Game("config.json")
+	world.map.change_room(eid=world.settings.get("start"))
+	# Only health regen ticks, for the players that join
+	world.settings["regen_ticks"] = 10
+	return world
+
+def test_regen_waits_for_the_players_room(world):
+	game = world.join("other")
+	game.map.change_room(eid="rom010")
+	game.player.health = 50
+	held = threading.Event()
+	release = threading.Event()
+	# Hold the other player's room like a fight in it would
+	def fight():
+		with game.map.lock_rooms([game.map.current_room]):
+			held.set()
+			release.wait(5)
+	fighter = threading.Thread(target=fight)
+	fighter.start()
+	held.wait(5)
+	ticker = threading.Thread(target=lambda: [world.tick() for i in range(world.settings.get("regen_ticks"))])
+	ticker.start()
+	ticker.join(0.2)
+	assert ticker.is_alive()
+	assert game.player.health == 50
+	release.set()
+	ticker.join(5)
+	fighter.join(5)
+	assert game.player.health == 51
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+# The game loads its content relative to the python directory
+GAME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, GAME_DIR)
+import tworld
+
+@pytest.fixture(params=["config.json", "tools/world.json"])
+def game(request, monkeypatch):
+	monkeypatch.chdir(GAME_DIR)
+	game = tworld.Game(request.param)
+	game.register_controller(tworld.GameCommandController)
+	game.player.name = "admin"
+	game.map.change_room(eid=game.settings.get("start"))
+	# Nothing gets in the way of travel
+	for room in game.map.get_rooms():
+		for monster in list(room.get_monsters()):
+			room.discard_monster(monster)
+	return game
+
+def test_undo_skips_commands_that_changed_nothing(game):
+	start = game.map.current_room
+	game.execute("travel rom010")
+	assert game.map.current_room.eid == "rom010"
+	game.execute("me; inspect room; pickup nothing")
+	assert game.execute("undo").startswith("Time rewinds...")
+	assert game.map.current_room is start
+
+def test_nothing_to_undo_after_reload_clears_history(game):
+	game.execute("travel rom010")
+	game.history.clear()
+	game.execute("me")
+	assert game.execute("undo") == "Nothing to undo!"
+	assert game.map.current_room.eid == "rom010"
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Load tests the game server with simulated players. Players either draw
+# commands from a weighted mix or replay a script of commands, one per
+# line, or the commands in a game log. Commands can be sent in batches,
+# one round trip per batch. For each number of concurrent players it
+# reports throughput, the error rate and per-command (or per-batch)
+# latency percentiles. Unless a port is given, a server is started on a
+# free port for the run.
+#
+# usage: loadgen.py [--port PORT] [--players 1,2,4,8,16] [--commands 200]
+#                   [--mix go=4,inspect=3,attack=2,pickup=1,save=1]
+#                   [--script FILE | --log FILE] [--batch 1]
+
+import os
+import re
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+import subprocess
+
+# The game runs relative to the python directory
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+PROMPT = b"> "
+
+class PlayerDied(Exception): pass
+
+class Client:
+	def __init__(self, host, port):
+		self._socket = socket.create_connection((host, port), timeout=30)
+		self.doors = list()
+		self.items = list()
+		welcome = self.read()
+		self.name = re.search(r"You're (\S+)\.", welcome).group(1)
+
+	# Read until the prompt for the next command
+	def read(self):
+		data = b""
+		while not data.endswith(PROMPT):
+			chunk = self._socket.recv(65536)
+			if not chunk:
+				if b"Oh no, you died!" in data:
+					raise PlayerDied()
+				raise ConnectionError("Server closed the connection")
+			data += chunk
+		output = data[:-len(PROMPT)].decode("utf-8", "replace")
+		# The outputs of a batch are separated by blank lines
+		for part in output.split("\n\n"):
+			self._update_room(part)
+		return output
+
+	# Remember the doors and items of the last room described
+	def _update_room(self, output):
+		if "\nDoors:" in output or "\nItems:" in output:
+			self.doors = re.findall(r"^ - (dor\S+)$", output, re.MULTILINE)
+			items = output.split("\nItems:", 1)[1].split("\nDoors:")[0] if "\nItems:" in output else ""
+			self.items = re.findall(r"^ - (.+)$", items, re.MULTILINE)
+
+	def send(self, line):
+		self._socket.sendall((line + "\n").encode("utf-8"))
+		return self.read()
+
+	def close(self):
+		self._socket.close()
+
+# Return the command line for a command from the mix
+def get_line(command, client):
+	if command == "go" and client.doors:
+		return "go through door %s" % random.choice(client.doors)
+	elif command == "pickup" and client.items:
+		return "pickup %s" % random.choice(client.items)
+	elif command == "attack":
+		return "attack"
+	elif command == "save":
+		return "save"
+	return "inspect room"
+
+def is_error(output):
+	return output.startswith("usage:") or output.endswith("command not found")
+
+class Player(threading.Thread):
+	def __init__(self, host, port, count, mix=None, script=None, batch=1):
+		super().__init__(daemon=True)
+		self._address = (host, port)
+		self._count = count
+		self._mix = mix
+		self._script = script
+		self._batch = batch
+		# Command => list of latencies in seconds
+		self.latencies = dict()
+		self.errors = 0
+		self.deaths = 0
+		self.names = list()
+
+	def _connect(self):
+		client = Client(*self._address)
+		self.names.append(client.name)
+		return client
+
+	def run(self):
+		client = None
+		offset = random.randrange(len(self._script)) if self._script else 0
+		for i in range(0, self._count, self._batch):
+			lines = list()
+			for j in range(i, min(i + self._batch, self._count)):
+				if self._script:
+					lines.append(self._script[(offset + j) % len(self._script)])
+				else:
+					lines.append(get_line(random.choices(*self._mix)[0], client) if client else "inspect room")
+			command = lines[0].split(" ")[0] if self._batch == 1 else "batch"
+			try:
+				if not client:
+					client = self._connect()
+				start = time.perf_counter()
+				output = client.send("; ".join(lines))
+				self.latencies.setdefault(command, list()).append(time.perf_counter() - start)
+				if self._batch == 1:
+					self.errors += is_error(output)
+				else:
+					self.errors += sum(is_error(part) for part in output.split("\n\n"))
+			except (OSError, ConnectionError, PlayerDied) as e:
+				# Dead players are disconnected, so join again as a new one
+				if isinstance(e, PlayerDied):
+					self.deaths += 1
+				else:
+					self.errors += 1
+				if client:
+					client.close()
+				client = None
+		if client:
+			client.close()
+
+def percentile(values, fraction):
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+# Start a server on a free port and wait until it accepts connections
+def start_server():
+	with socket.socket() as s:
+		s.bind(("localhost", 0))
+		port = s.getsockname()[1]
+	server = subprocess.Popen(
+		[sys.executable, "tworld.py", "--serve", str(port)],
+		stdout=subprocess.DEVNULL
+	)
+	for i in range(100):
+		try:
+			socket.create_connection(("localhost", port), timeout=1).close()
+			return server, port
+		except OSError:
+			time.sleep(0.1)
+	server.kill()
+	raise RuntimeError("Server didn't start")
+
+def read_script(args):
+	if args.script:
+		with open(args.script) as f:
+			return [line.strip() for line in f if line.strip()]
+	elif args.log:
+		with open(args.log) as f:
+			return re.findall(r"Executing line '(.+)'$", f.read(), re.MULTILINE)
+
+def main():
+	parser = argparse.ArgumentParser(description="Load test the game server")
+	parser.add_argument("--host", default="localhost")
+	parser.add_argument("--port", type=int)
+	parser.add_argument("--players", default="1,2,4,8,16")
+	parser.add_argument("--commands", type=int, default=200, help="commands per player")
+	parser.add_argument("--mix", default="go=4,inspect=3,attack=2,pickup=1,save=1")
+	parser.add_argument("--script", help="file of commands, one per line")
+	parser.add_argument("--log", help="game log to take the commands from")
+	parser.add_argument("--batch", type=int, default=1, help="commands per round trip")
+	args = parser.parse_args()
+	mix = [pair.split("=") for pair in args.mix.split(",")]
+	mix = ([command for command, weight in mix], [float(weight) for command, weight in mix])
+	script = read_script(args)
+
+	server = None
+	port = args.port
+	if not port:
+		server, port = start_server()
+	names = list()
+	try:
+		for players in [int(count) for count in args.players.split(",")]:
+			threads = [Player(args.host, port, args.commands, mix, script, args.batch) for i in range(players)]
+			start = time.perf_counter()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.perf_counter() - start
+			latencies = dict()
+			errors = 0
+			deaths = 0
+			for thread in threads:
+				errors += thread.errors
+				deaths += thread.deaths
+				names.extend(thread.names)
+				for command, values in thread.latencies.items():
+					latencies.setdefault(command, list()).extend(values)
+			total = players * args.commands
+			print("%i players: %.0f cmd/s, %.2f%% errors, %i deaths" % (players, total / elapsed, 100 * errors / total, deaths))
+			print("\tcommand\tcount\tp50 ms\tp95 ms\tp99 ms")
+			for command in sorted(latencies):
+				values = sorted(latencies[command])
+				print("\t%s\t%i\t%.2f\t%.2f\t%.2f" % (
+					command,
+					len(values),
+					percentile(values, 0.5) * 1000,
+					percentile(values, 0.95) * 1000,
+					percentile(values, 0.99) * 1000
+				))
+	finally:
+		if server:
+			server.terminate()
+			server.wait()
+			# Remove the saves made by the players of our own server
+			for name in names:
+				if os.path.exists("." + name + ".tsave"):
+					os.remove("." + name + ".tsave")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures what the pre-forked server saves: building a game from scratch
+# against making one from a loaded template, and the cost of forking a
+# worker with and without freezing the collector. Each forked worker
+# makes a number of games and runs a full collection, then reports how
+# much memory it had to copy from the parent (Linux only).
+#
+# usage: prefork_bench.py [sessions] [repeats]
+
+import gc
+import os
+import sys
+import time
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+# Return the memory in KiB written by this process since it was forked
+def get_private_dirty():
+	try:
+		with open("/proc/self/smaps_rollup") as f:
+			for line in f:
+				if line.startswith("Private_Dirty:"):
+					return int(line.split()[1])
+	except OSError:
+		pass
+	return -1
+
+# Return the average seconds per call
+def measure(function, repeats):
+	start = time.perf_counter()
+	for i in range(repeats):
+		function()
+	return (time.perf_counter() - start) / repeats
+
+# Fork a worker that makes games from the template, and return the
+# seconds taken by the fork and the KiB the worker copied
+def fork_worker(template, sessions):
+	read_fd, write_fd = os.pipe()
+	start = time.perf_counter()
+	pid = os.fork()
+	if pid == 0:
+		os.close(read_fd)
+		games = [template.create("player%i" % i) for i in range(sessions)]
+		gc.collect()
+		os.write(write_fd, str(get_private_dirty()).encode())
+		os._exit(0)
+	elapsed = time.perf_counter() - start
+	os.close(write_fd)
+	with os.fdopen(read_fd) as f:
+		copied = int(f.read() or -1)
+	os.waitpid(pid, 0)
+	return elapsed, copied
+
+def main():
+	sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	if not hasattr(os, "fork"):
+		print("This platform can't fork")
+		sys.exit(1)
+
+	print("cold game\t%.2f ms" % (measure(lambda: tworld.Game("config.json"), repeats) * 1000))
+	template = tworld.GameTemplate(tworld.Game("config.json"))
+	print("template game\t%.2f ms" % (measure(template.create, repeats) * 1000))
+
+	print("gc.freeze\tfork ms\tcopied KiB (%i games)" % sessions)
+	for frozen in (False, True):
+		gc.collect()
+		if frozen:
+			gc.freeze()
+		results = [fork_worker(template, sessions) for i in range(repeats)]
+		print("%s\t%.2f\t%i" % (
+			frozen,
+			sum(elapsed for elapsed, copied in results) / repeats * 1000,
+			sum(copied for elapsed, copied in results) / repeats
+		))
+		gc.unfreeze()
+
+if __name__ == "__main__":
+	main()
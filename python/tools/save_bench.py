@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compares the size and speed of save files against pickling the whole
+# game, after playing a number of random commands to move things around.
+#
+# usage: save_bench.py [commands] [repeats]
+
+import io
+import os
+import sys
+import time
+import pickle
+import random
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+# Play random commands so the saved state isn't just the starting world
+def play(game, count):
+	for i in range(count):
+		room = game.map.current_room
+		doors = room.get_doors()
+		items = room.inventory.get_items()
+		line = random.choice([
+			"attack until",
+			"go through door %s" % random.choice(doors).eid if doors else "look",
+			"pickup %s" % random.choice(items).name if items else "look",
+			"flee"
+		])
+		game.cmd_controller.execute_line(line)
+
+# Return the average seconds per call
+def measure(function, repeats):
+	start = time.perf_counter()
+	for i in range(repeats):
+		function()
+	return (time.perf_counter() - start) / repeats
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+	random.seed(0)
+	game = tworld.Game("config.json")
+	game.register_controller(tworld.GameCommandController)
+	game.player._health = 10 ** 9
+	game.map.change_room(eid=game.settings.get("start"))
+	play(game, count)
+
+	print("format\tbytes\tsave ms\tload ms")
+	data = pickle.dumps(game)
+	print("pickle\t%i\t%.2f\t%.2f" % (
+		len(data),
+		measure(lambda: pickle.dumps(game), repeats) * 1000,
+		measure(lambda: pickle.loads(data), repeats) * 1000
+	))
+	for compression in ("none", "zlib", "lzma"):
+		f = io.BytesIO()
+		tworld.SaveFile.dump(game, f, compression)
+		data = f.getvalue()
+		print("%s\t%i\t%.2f\t%.2f" % (
+			compression,
+			len(data),
+			measure(lambda: tworld.SaveFile.dump(game, io.BytesIO(), compression), repeats) * 1000,
+			measure(lambda: tworld.SaveFile.load(io.BytesIO(data)), repeats) * 1000
+		))
+
+if __name__ == "__main__":
+	main()
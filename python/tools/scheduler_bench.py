@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures the world scheduler with many pending timers: the cost of
+# scheduling them, and of ticking until they have all fired. Each
+# fired timer is scheduled again, like the timers of wandering monsters,
+# so the number pending stays the same throughout.
+#
+# usage: scheduler_bench.py [timers] [max_delay] [ticks]
+
+import os
+import sys
+import time
+import random
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+	max_delay = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+	ticks = int(sys.argv[3]) if len(sys.argv) > 3 else 10 ** 4
+	random.seed(0)
+	wheel = tworld.TimingWheel()
+
+	start = time.perf_counter()
+	for i in range(count):
+		wheel.schedule(random.randint(1, max_delay), i)
+	scheduled = time.perf_counter()
+	fired = 0
+	idle = 0
+	for i in range(ticks):
+		timers = wheel.advance()
+		if not timers:
+			idle += 1
+		for timer in timers:
+			wheel.schedule(max_delay, timer)
+		fired += len(timers)
+	ticked = time.perf_counter()
+
+	print("%i timers pending, delays up to %i ticks" % (len(wheel), max_delay))
+	print("schedule\t%.2f us per timer" % ((scheduled - start) * 10 ** 6 / count))
+	print("tick\t%.2f us per fired timer, %i fired over %i ticks (%i idle)" % (
+		(ticked - scheduled) * 10 ** 6 / max(fired, 1),
+		fired,
+		ticks,
+		idle
+	))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures command throughput in a shared world as the number of players
+# grows. Every player runs in its own thread, walking back and forth
+# through an unlocked door while inspecting, fighting and moving items.
+#
+# usage: shared_world_bench.py [commands_per_player] [max_players]
+
+import os
+import sys
+import time
+import threading
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+COMMANDS = [
+	"inspect room",
+	"me",
+	"attack",
+	"pickup bread",
+	"drop bread",
+	"go through door %s"
+]
+
+# Return (door id, room id) pairs for doors joining two rooms that
+# need no key or puzzle
+def get_open_doors(game):
+	doors = list()
+	for eid in game.entity_factory.get_entity_ids():
+		if eid.startswith("dor"):
+			rooms = game.map.get_rooms(door=eid)
+			if len(rooms) == 2:
+				door = rooms[0].get_door(eid)
+				if not door.key and not door.puzzle:
+					doors.append((eid, rooms[0].eid))
+	return doors
+
+def play(game, door, count, lock=None):
+	for i in range(count):
+		line = COMMANDS[i % len(COMMANDS)]
+		if "%s" in line:
+			line = line % door
+		if lock:
+			with lock:
+				game.cmd_controller.execute_line(line)
+		else:
+			game.cmd_controller.execute_line(line)
+
+# Return commands per second for the given number of players
+def run(players, count, global_lock=False):
+	world = tworld.Game("config.json")
+	doors = get_open_doors(world)
+	sessions = list()
+	for i in range(players):
+		game = world.join("player%i" % i)
+		# Keep everyone alive for the whole run
+		game.player._health = 10 ** 9
+		game.register_controller(tworld.GameCommandController)
+		door, room = doors[i % len(doors)]
+		game.map.change_room(eid=room)
+		sessions.append((game, door))
+	lock = threading.Lock() if global_lock else None
+	threads = [threading.Thread(target=play, args=(game, door, count, lock)) for game, door in sessions]
+	start = time.perf_counter()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	return players * count / (time.perf_counter() - start)
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+	max_players = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+	print("players\troom locks (cmd/s)\tglobal lock (cmd/s)")
+	players = 1
+	while players <= max_players:
+		print("%i\t%.0f\t%.0f" % (
+			players,
+			run(players, count),
+			run(players, count, global_lock=True)
+		))
+		players *= 2
+
+if __name__ == "__main__":
+	main()
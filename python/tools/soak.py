@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Drives a bot through a long session and checks that memory stays
+# bounded. The bot wanders through the map, fights, moves items around
+# and undoes some of its commands, while monsters wander and respawn
+# as set in tools/world.json. Once the warmup is over, the traced
+# memory after each check must stay within max_growth_kb of the first
+# check, or the run fails.
+#
+# usage: soak.py [commands] [check_every] [max_growth_kb]
+
+import os
+import sys
+import gc
+import time
+import random
+import tracemalloc
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+# Return the next command for the bot to run
+def get_command(game):
+	room = game.map.current_room
+	roll = random.random()
+	if roll < 0.3:
+		doors = room.get_doors()
+		if doors:
+			return "go through door %s" % random.choice(doors).eid
+	elif roll < 0.45:
+		return "attack until"
+	elif roll < 0.6:
+		items = room.inventory.get_items()
+		if items:
+			return "pickup %s" % random.choice(items).name
+	elif roll < 0.75:
+		items = game.player.inventory.get_items()
+		if items:
+			return "drop %s" % random.choice(items).name
+	elif roll < 0.8:
+		return "undo"
+	elif roll < 0.85:
+		return "flee"
+	return random.choice(["look", "me", "inspect room", "access inventory"])
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6
+	every = int(sys.argv[2]) if len(sys.argv) > 2 else 10 ** 4
+	max_growth = int(sys.argv[3]) if len(sys.argv) > 3 else 1024
+	random.seed(0)
+	game = tworld.Game("tools/world.json")
+	game.register_controller(tworld.GameCommandController)
+	game.player._health = 10 ** 9
+	game.map.change_room(eid=game.settings.get("start"))
+	tracemalloc.start()
+	baseline = None
+	start = time.perf_counter()
+	print("commands\ttraced KiB\tgrowth KiB\tcmd/s")
+	for i in range(1, count + 1):
+		game.cmd_controller.execute_line(get_command(game))
+		if i % every == 0:
+			gc.collect()
+			size = tracemalloc.get_traced_memory()[0] / 1024
+			# Treat the first tenth of the run as warmup
+			if baseline is None and i >= count // 10:
+				baseline = size
+			growth = size - baseline if baseline is not None else 0
+			print("%i\t%.1f\t%.1f\t%.0f" % (i, size, growth, i / (time.perf_counter() - start)))
+			if growth > max_growth:
+				print("Memory grew by %.1f KiB, more than %i KiB" % (growth, max_growth))
+				sys.exit(1)
+	print("Memory stayed bounded")
+
+if __name__ == "__main__":
+	main()
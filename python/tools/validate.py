@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Checks the map and entity files for broken content before it reaches
+# the game: invalid definitions, references to undefined ids, doors that
+# don't join exactly two rooms, rooms that can't be reached from the
+# start and keys that can never be obtained. Exits with 1 if anything
+# is wrong.
+#
+# usage: validate.py [config_file]
+
+import os
+import re
+import sys
+import json
+import time
+from collections import deque
+
+# The game loads its content relative to the python directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(sys.path[0])
+import tworld
+
+# Fields holding one entity id, and fields holding a list of them. List
+# entries are either an id or a dict overriding fields of a definition
+REFERENCE_FIELDS = {"key": False, "puzzle": False, "items": True, "doors": True, "monsters": True}
+
+# Cross references between the definitions, built in one pass
+class ContentIndex:
+	def __init__(self, definitions, map_ids):
+		self.definitions = definitions
+		# Undefined entity id => ids of the definitions referencing it
+		self.dangling = dict()
+		# Door id => ids of the map rooms it's in
+		self.door_rooms = dict()
+		map_ids = set(map_ids)
+		for eid, entity_dict in definitions.items():
+			self._index(eid, entity_dict, eid in map_ids)
+		for eid in map_ids:
+			if str(eid).startswith("dor") and eid not in self.door_rooms:
+				self.door_rooms[eid] = list()
+
+	def _index(self, eid, entity_dict, in_map):
+		definitions = self.definitions
+		for field, value in entity_dict.items():
+			is_list = REFERENCE_FIELDS.get(field)
+			if is_list is None or not value:
+				continue
+			elif not is_list:
+				if value not in definitions:
+					self.dangling.setdefault(value, list()).append(eid)
+				continue
+			for entry in value:
+				if entry.__class__ is dict:
+					self._index(eid, entry, False)
+					entry = entry.get("id")
+				if entry not in definitions:
+					self.dangling.setdefault(entry, list()).append(eid)
+			if field == "doors" and in_map:
+				for entry in value:
+					door = entry.get("id") if entry.__class__ is dict else entry
+					self.door_rooms.setdefault(door, list()).append(eid)
+
+	# Return the definition for a list entry, with any overrides applied
+	def resolve(self, entry):
+		if isinstance(entry, dict):
+			entity_dict = dict(self.definitions.get(entry.get("id"), dict()))
+			entity_dict.update(entry)
+			return entity_dict
+		return self.definitions.get(entry, dict())
+
+# Return a list of the problems with the content
+def validate(definitions, map_ids, start):
+	index = ContentIndex(definitions, map_ids)
+	problems = list()
+	for eid, referrers in sorted(index.dangling.items(), key=str):
+		problems.append("'%s' is referenced by %s but never defined" % (
+			eid, ", ".join("'%s'" % referrer for referrer in referrers[:5])
+		))
+
+	# Join the rooms in the map through their doors
+	rooms = [eid for eid in map_ids if str(eid).startswith("rom") and eid in definitions]
+	neighbors = dict()
+	for door, door_rooms in index.door_rooms.items():
+		if len(door_rooms) != 2:
+			problems.append("Door '%s' joins %i rooms instead of 2" % (door, len(door_rooms)))
+		key = index.resolve(door).get("key")
+		for room in door_rooms:
+			for other in door_rooms:
+				if other != room:
+					neighbors.setdefault(room, list()).append((key, other))
+
+	if start not in definitions or not str(start).startswith("rom"):
+		problems.append("Start room '%s' is not in the map" % start)
+		return problems
+
+	# Walk the map from the start, only opening doors and chests once
+	# their key has been found. Everything waiting on a key is queued
+	# when it is
+	obtained = set()
+	waiting = dict()
+	visited = {start}
+	queue = deque([(True, start)])
+	while queue:
+		is_room, entry = queue.popleft()
+		entity_dict = definitions.get(entry, dict()) if entry.__class__ is str else index.resolve(entry)
+		if is_room:
+			for field in ("items", "monsters"):
+				for item in entity_dict.get(field) or ():
+					queue.append((False, item))
+			for key, other in neighbors.get(entry, ()):
+				if other in visited:
+					continue
+				elif key and key not in obtained:
+					waiting.setdefault(key, list()).append((True, other))
+				else:
+					visited.add(other)
+					queue.append((True, other))
+			continue
+		entity_type = (entity_dict.get("id") or "")[:3]
+		if entity_type == "key":
+			eid = entity_dict["id"]
+			if eid not in obtained:
+				obtained.add(eid)
+				for target in waiting.pop(eid, ()):
+					if target[0]:
+						if target[1] in visited:
+							continue
+						visited.add(target[1])
+					queue.append(target)
+		elif entity_type == "cst" and entity_dict.get("key") and entity_dict["key"] not in obtained:
+			waiting.setdefault(entity_dict["key"], list()).append((False, entry))
+		elif entity_type in ("cst", "mon", "bos"):
+			# Open chests and the inventories of defeated monsters
+			for item in entity_dict.get("items") or ():
+				queue.append((False, item))
+	for key in sorted(waiting):
+		problems.append("Key '%s' can never be obtained, leaving %i doors or chests locked" % (key, len(waiting[key])))
+
+	# Tell the rooms with no path from the start from the locked ones
+	if len(visited) < len(rooms):
+		connected = {start}
+		queue = deque([start])
+		while queue:
+			for key, other in neighbors.get(queue.popleft(), ()):
+				if other not in connected:
+					connected.add(other)
+					queue.append(other)
+		for room in rooms:
+			if room not in connected:
+				problems.append("Room '%s' can't be reached from '%s'" % (room, start))
+			elif room not in visited:
+				problems.append("Room '%s' is only behind doors whose keys can't be obtained" % room)
+	return problems
+
+def main():
+	config_filepath = sys.argv[1] if len(sys.argv) > 1 else "config.json"
+	with open(config_filepath) as f:
+		# Remove comments the same way the game does
+		settings = json.loads(re.sub("#.*", "", f.read()))
+	filepaths = list()
+	for node in os.walk("entities"):
+		for filepath in node[2]:
+			filepaths.append(os.path.join(node[0], filepath))
+	filepaths.sort()
+	map_filepath = os.path.join("maps", settings.get("map", ""))
+
+	start = time.perf_counter()
+	problems = list()
+	definitions = dict()
+	map_ids = list()
+	for filepath in filepaths + [map_filepath]:
+		filepath, file_definitions, file_problems = tworld._load_definitions(filepath)
+		problems.extend("%s: %s" % (filepath, problem) for problem in file_problems)
+		for entity_dict in file_definitions or ():
+			definitions[entity_dict["id"]] = entity_dict
+			if filepath == map_filepath:
+				map_ids.append(entity_dict["id"])
+	loaded = time.perf_counter()
+	problems.extend(validate(definitions, map_ids, settings.get("start")))
+	checked = time.perf_counter()
+
+	for problem in problems:
+		print(problem)
+	print("%i definitions, %i problems (loaded in %.2fs, checked in %.2fs)" % (
+		len(definitions),
+		len(problems),
+		loaded - start,
+		checked - loaded
+	))
+	sys.exit(1 if problems else 0)
+
+if __name__ == "__main__":
+	main()
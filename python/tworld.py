@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import re
 import sys
-import uuid
+import copy
+import zlib
+import lzma
 import json
+import mmap
+import signal
 import time
 import shlex
 import pickle
+import pstats
+import gc
+import itertools
 import string
+import struct
+import bisect
 import random
+import cProfile
 import hashlib
+import threading
+import socketserver
+import tracemalloc
+import contextlib
+import contextvars
+import asyncio
+import concurrent.futures
+from array import array
+from collections import deque, namedtuple
+from collections.abc import Mapping
 try:
 	import readline
 except:
@@ -19,7 +40,6 @@ except:
 		import pyreadline as readline
 	except:
 		pass
-from inspect import getframeinfo, stack
 
 # Exceptions
 class InvalidSettingsFile(Exception): pass
@@ -31,38 +51,593 @@ class MapNotFound(Exception): pass
 # Higher level increases output
 DEBUG = 0
 _log_file = open("log.txt", "a")
+# Keeps lines from different players' threads from interleaving
+_log_lock = threading.Lock()
 def _log(*args, level=3):
 	timestamp = time.strftime("[%Y-%m-%d_%H:%M:%S]")
-	caller = stack()[1][0]
+	# Only the calling frame is needed, so don't build the whole stack
+	caller = sys._getframe(1)
 	try:
 		caller_class = caller.f_locals["self"].__class__.__qualname__
 	except:
 		caller_class = "__main__"
-	caller_lineno = getframeinfo(caller).lineno
+	caller_lineno = caller.f_lineno
 	preface = "%s <%s:%i>" % (timestamp, caller_class, caller_lineno)
-	if DEBUG >= level:
-		print(preface + " ", *args)
-	# Always print to log file
-	print(preface + " ", *args, file=_log_file)
-	_log_file.flush()
+	with _log_lock:
+		if DEBUG >= level:
+			print(preface + " ", *args)
+		# Always print to log file
+		print(preface + " ", *args, file=_log_file)
+		_log_file.flush()
 
 def _md5(text):
 	return hashlib.md5(text.encode("utf-8")).hexdigest()
 
+# Content packs at least this many bytes are parsed in parallel
+_parallel_load_size = 1 << 20
+
+_json_token_pattern = re.compile(r'["#{}\[\]]')
+_json_string_pattern = re.compile(r'["\\]')
+_json_decoder = json.JSONDecoder()
+
+# Yield the objects in the `key` array of a commented JSON file one at a
+# time, reading it in chunks so that only one object is held in memory.
+# Comments run from a # outside of a string to the end of the line
+def _read_json_objects(f, key="entities", chunk_size=65536):
+	depth = 0
+	in_string = False
+	is_escaped = False
+	in_comment = False
+	in_array = False
+	# Strings directly inside the top level object, the last of which is
+	# the key of the value that follows it
+	key_parts = None
+	last_key = None
+	# Pieces of the object being read, and where the next piece starts
+	parts = None
+	start = None
+	while True:
+		chunk = f.read(chunk_size)
+		if not chunk:
+			break
+		i = 0
+		while i < len(chunk):
+			if in_comment:
+				i = chunk.find("\n", i)
+				if i < 0:
+					break
+				in_comment = False
+				if parts is not None:
+					start = i
+			elif in_string:
+				if is_escaped:
+					is_escaped = False
+					i += 1
+					continue
+				match = _json_string_pattern.search(chunk, i)
+				if not match:
+					break
+				i = match.end()
+				if match.group() == "\\":
+					is_escaped = True
+				else:
+					in_string = False
+					if key_parts is not None:
+						key_parts.append(chunk[start:match.start()])
+						last_key = "".join(key_parts)
+						key_parts = None
+			else:
+				match = _json_token_pattern.search(chunk, i)
+				if not match:
+					break
+				token = match.group()
+				i = match.end()
+				if token == '"':
+					in_string = True
+					if depth == 1:
+						key_parts = list()
+						start = i
+				elif token == "#":
+					in_comment = True
+					if parts is not None:
+						parts.append(chunk[start:match.start()])
+				elif token in "{[":
+					depth += 1
+					if depth == 2 and token == "[" and last_key == key:
+						in_array = True
+					elif depth == 3 and token == "{" and in_array:
+						# Decode objects that fit in the chunk directly, and
+						# scan the ones that don't or that hold comments
+						try:
+							entity_dict, i = _json_decoder.raw_decode(chunk, match.start())
+						except ValueError:
+							parts = list()
+							start = match.start()
+						else:
+							depth -= 1
+							yield entity_dict
+				else:
+					depth -= 1
+					if depth == 2 and parts is not None:
+						parts.append(chunk[start:i])
+						yield json.loads("".join(parts))
+						parts = None
+					elif depth == 1:
+						in_array = False
+					elif depth < 0:
+						raise InvalidSettingsFile("Unexpected '%s'" % token)
+		# Carry whatever is being read over to the next chunk
+		if in_comment:
+			continue
+		if parts is not None:
+			parts.append(chunk[start:])
+			start = 0
+		elif key_parts is not None:
+			key_parts.append(chunk[start:])
+			start = 0
+	if depth or in_string:
+		raise InvalidSettingsFile("Unexpected end of file")
+
+## Entity ids
+# Entity ids are interned process-wide as small ints, which lookups and
+# indexes compare instead of the strings. The strings are only for
+# reading content and showing or saving entities
+_eids = list()
+_eid_numbers = dict()
+_eid_lock = threading.Lock()
+
+def _intern_eid(eid):
+	if eid is None:
+		return None
+	number = _eid_numbers.get(eid)
+	if number is None:
+		with _eid_lock:
+			number = _eid_numbers.get(eid)
+			if number is None:
+				number = len(_eids)
+				_eids.append(eid)
+				_eid_numbers[eid] = number
+	return number
+
+# Unique ids of entities, counting up from 1
+_uids = itertools.count(1)
+
+# Version stamps, unique across the process, for state that caches are
+# keyed on. A stamp stands for one state of one object, so caches shared
+# between players can't mix them up
+_versions = itertools.count(1)
+_uid_lock = threading.Lock()
+
+# Make sure no uid up to and including `uid` is handed out again, for
+# entities loaded from elsewhere
+def _reserve_uids(uid):
+	global _uids
+	with _uid_lock:
+		_uids = itertools.count(max(next(_uids), uid + 1))
+
+# The game whose command is currently being executed. Entities report
+# mutations to it so that its undo history can copy them on write
+_active_game = contextvars.ContextVar("active_game", default=None)
+
+# Must be called before mutating an entity, inventory or map
+def _touch(obj, soft=False):
+	game = _active_game.get()
+	if game is not None:
+		game.history.record(obj, soft)
+
+## Events
+# Every change to the world is described by one of these. Objects are
+# referred to by the ref their game gave them (-1 for None)
+InventoryAdd = namedtuple("InventoryAdd", "inventory item")
+InventoryPop = namedtuple("InventoryPop", "inventory item")
+HealthChanged = namedtuple("HealthChanged", "character health")
+NameChanged = namedtuple("NameChanged", "character name")
+BaseAttackChanged = namedtuple("BaseAttackChanged", "character attack")
+Equipped = namedtuple("Equipped", "character item")
+Unequipped = namedtuple("Unequipped", "character item")
+MonsterAdded = namedtuple("MonsterAdded", "room monster")
+MonsterRemoved = namedtuple("MonsterRemoved", "room monster")
+MonsterChosen = namedtuple("MonsterChosen", "room monster")
+PuzzleSolved = namedtuple("PuzzleSolved", "puzzle is_solved")
+ChestLocked = namedtuple("ChestLocked", "chest is_locked")
+RoomChanged = namedtuple("RoomChanged", "map index")
+RoomBack = namedtuple("RoomBack", "map steps")
+EntityCreated = namedtuple("EntityCreated", "eid")
+Snapshot = namedtuple("Snapshot", "")
+Undo = namedtuple("Undo", "")
+EntityRemoved = namedtuple("EntityRemoved", "entity")
+Rollback = namedtuple("Rollback", "snapshot_id")
+
+# Event types and their field formats (i: integer, s: string), in the
+# order of their type codes. Only ever append to this list
+_event_types = [
+	(InventoryAdd, "ii"),
+	(InventoryPop, "ii"),
+	(HealthChanged, "ii"),
+	(NameChanged, "is"),
+	(BaseAttackChanged, "ii"),
+	(Equipped, "ii"),
+	(Unequipped, "ii"),
+	(MonsterAdded, "ii"),
+	(MonsterRemoved, "ii"),
+	(MonsterChosen, "ii"),
+	(PuzzleSolved, "ii"),
+	(ChestLocked, "ii"),
+	(RoomChanged, "ii"),
+	(RoomBack, "ii"),
+	(EntityCreated, "s"),
+	(Snapshot, ""),
+	(Undo, ""),
+	(EntityRemoved, "i"),
+	(Rollback, "i")
+]
+_event_codes = {event_type: code for code, (event_type, _) in enumerate(_event_types)}
+
+# Record a change to the active game's world index and event log. Fields
+# may be objects, which the log replaces by their refs. Objects that don't
+# have a ref yet are still being created, and their creation is logged
+# instead
+def _emit(event_type, *fields):
+	game = _active_game.get()
+	if game is None:
+		return
+	if game.world_index.is_built:
+		game.world_index.update(event_type, fields)
+	if game.event_log is None:
+		return
+	values = list()
+	for field in fields:
+		if field is None:
+			field = -1
+		elif not isinstance(field, (bool, int, str)):
+			field = field.__dict__.get("_ref")
+			if field is None:
+				return
+		values.append(field)
+	game.event_log.append(event_type(*values))
+
+# Prefix tree of names. Names are matched case-insensitively but
+# returned as they were added
+class Trie:
+	def __init__(self):
+		self._root = dict()
+
+	def add(self, name):
+		node = self._root
+		for char in name.lower():
+			node = node.setdefault(char, dict())
+		node.setdefault(None, set()).add(name)
+
+	def remove(self, name):
+		# Walk down to the name, then prune any nodes left empty
+		path = list()
+		node = self._root
+		for char in name.lower():
+			if char not in node:
+				return
+			path.append((node, char))
+			node = node[char]
+		names = node.get(None)
+		if not names or name not in names:
+			return
+		names.discard(name)
+		if not names:
+			del node[None]
+		for parent, char in reversed(path):
+			if parent[char]:
+				break
+			del parent[char]
+
+	# Return every name starting with the prefix
+	def complete(self, prefix):
+		node = self._root
+		for char in prefix.lower():
+			node = node.get(char)
+			if node is None:
+				return list()
+		names = list()
+		nodes = [node]
+		while nodes:
+			node = nodes.pop()
+			for char, child in node.items():
+				if char is None:
+					names.extend(child)
+				else:
+					nodes.append(child)
+		return names
+
+# Levenshtein distance between two strings
+def _edit_distance(a, b):
+	if len(a) < len(b):
+		a, b = b, a
+	previous = list(range(len(b) + 1))
+	for i, char_a in enumerate(a, 1):
+		current = [i]
+		for j, char_b in enumerate(b, 1):
+			current.append(min(
+				previous[j] + 1,
+				current[j - 1] + 1,
+				previous[j - 1] + (char_a != char_b)
+			))
+		previous = current
+	return previous[-1]
+
+# Burkhard-Keller tree for finding words within an edit distance
+class BKTree:
+	def __init__(self):
+		# Nodes are [word, {distance: child}]
+		self._root = None
+
+	def add(self, word):
+		if self._root is None:
+			self._root = [word, dict()]
+			return
+		node = self._root
+		while True:
+			distance = _edit_distance(word, node[0])
+			if distance == 0:
+				return
+			child = node[1].get(distance)
+			if child is None:
+				node[1][distance] = [word, dict()]
+				return
+			node = child
+
+	# Return (distance, word) pairs for words within the tolerance
+	def search(self, word, tolerance):
+		matches = list()
+		nodes = [self._root] if self._root else list()
+		while nodes:
+			node = nodes.pop()
+			distance = _edit_distance(word, node[0])
+			if distance <= tolerance:
+				matches.append((distance, node[0]))
+			# Only children within tolerance of this distance can match
+			for child_distance, child in node[1].items():
+				if distance - tolerance <= child_distance <= distance + tolerance:
+					nodes.append(child)
+		return matches
+
+# Resolves possibly abbreviated or misspelled names to values. Names are
+# normalized once on insertion; lookups go through an n-gram index for
+# substrings and a BK-tree of words for typos, and matches are ranked:
+# exact, then prefix, then substring, then closest spelling
+class NameIndex:
+	# Longest n-gram indexed
+	_gram_size = 3
+
+	def __init__(self, names=None):
+		# Entries are [name, normalized name, value], None once removed
+		self._entries = list()
+		self._grams = dict()
+		self._words = dict()
+		self._word_tree = BKTree()
+		# New words wait until a lookup needs the tree, since adding to it
+		# is by far the slowest part of adding a name
+		self._new_words = list()
+		if names:
+			for name, value in dict(names).items():
+				self.add(name, value)
+
+	# Indexes saved before words were added lazily
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.__dict__.setdefault("_new_words", list())
+
+	@staticmethod
+	def normalize(name):
+		name = re.sub(r"[^\w\s]", "", str(name).lower())
+		return " ".join(name.split())
+
+	def _get_grams(self, text):
+		size = min(self._gram_size, len(text))
+		return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+	def add(self, name, value):
+		normalized = self.normalize(name)
+		entry_id = len(self._entries)
+		self._entries.append([name, normalized, value])
+		for size in range(1, self._gram_size + 1):
+			for i in range(len(normalized) - size + 1):
+				self._grams.setdefault(normalized[i:i + size], set()).add(entry_id)
+		for word in normalized.split():
+			if word not in self._words:
+				self._new_words.append(word)
+			self._words.setdefault(word, set()).add(entry_id)
+
+	def remove(self, value):
+		for i, entry in enumerate(self._entries):
+			if entry and entry[2] is value:
+				self._entries[i] = None
+
+	def size(self):
+		return sum(1 for entry in self._entries if entry)
+
+	# Return values matching the query, best first
+	def resolve(self, query, limit=None):
+		query = self.normalize(query)
+		if not query:
+			return list()
+		ranked = dict()
+		# Substrings: every n-gram of the query must appear in the name
+		candidates = None
+		for gram in self._get_grams(query):
+			postings = self._grams.get(gram, set())
+			candidates = postings if candidates is None else candidates & postings
+			if not candidates:
+				break
+		for entry_id in candidates or set():
+			normalized = self._entries[entry_id] and self._entries[entry_id][1]
+			if normalized:
+				position = normalized.find(query)
+				if position >= 0:
+					rank = 0 if normalized == query else 1 if position == 0 else 2
+					ranked[entry_id] = (rank, position, len(normalized), entry_id)
+		# Typos: every word of the query must be close to a word in the name
+		if not ranked:
+			for word in self._new_words:
+				self._word_tree.add(word)
+			self._new_words = list()
+			distances = None
+			for word in query.split():
+				tolerance = max(1, len(word) // 4)
+				word_distances = dict()
+				for distance, match in self._word_tree.search(word, tolerance):
+					for entry_id in self._words[match]:
+						if distance < word_distances.get(entry_id, tolerance + 1):
+							word_distances[entry_id] = distance
+				if distances is None:
+					distances = word_distances
+				else:
+					distances = {
+						entry_id: distances[entry_id] + distance
+						for entry_id, distance in word_distances.items()
+						if entry_id in distances
+					}
+			for entry_id, distance in (distances or dict()).items():
+				if self._entries[entry_id]:
+					ranked[entry_id] = (3, distance, len(self._entries[entry_id][1]), entry_id)
+		entry_ids = sorted(ranked, key=ranked.get)[:limit]
+		return [self._entries[entry_id][2] for entry_id in entry_ids]
+
+	# Return the best matching value
+	def get(self, query):
+		values = self.resolve(query, 1)
+		if values:
+			return values[0]
+
+	# Return the value of the (name, value) pair whose name best matches
+	# the query, ranked like resolve() but by going through the names.
+	# For the few names in a room or inventory this is much cheaper than
+	# building an index
+	@classmethod
+	def match(cls, query, pairs):
+		query = cls.normalize(query)
+		if not query:
+			return None
+		names = [(cls.normalize(name), value) for name, value in pairs]
+		best = None
+		for order, (normalized, value) in enumerate(names):
+			position = normalized.find(query)
+			if position >= 0:
+				rank = (0 if normalized == query else 1 if position == 0 else 2, position, len(normalized), order)
+				if best is None or rank < best[0]:
+					best = (rank, value)
+		if best:
+			return best[1]
+		# Typos: every word of the query must be close to a word in the name
+		for order, (normalized, value) in enumerate(names):
+			words = normalized.split()
+			total = 0
+			for word in query.split():
+				tolerance = max(1, len(word) // 4)
+				distance = min((_edit_distance(word, other) for other in words), default=tolerance + 1)
+				if distance > tolerance:
+					break
+				total += distance
+			else:
+				rank = (total, len(normalized), order)
+				if best is None or rank < best[0]:
+					best = (rank, value)
+		if best:
+			return best[1]
+
+# Named tries of completion candidates. Updating a source only adds and
+# removes the names that changed since its last update
+class CompletionIndex:
+	def __init__(self):
+		self._tries = dict()
+		self._names = dict()
+
+	def update(self, source, names):
+		names = set(names)
+		trie = self._tries.setdefault(source, Trie())
+		old_names = self._names.get(source, set())
+		for name in old_names - names:
+			trie.remove(name)
+		for name in names - old_names:
+			trie.add(name)
+		self._names[source] = names
+
+	def complete(self, sources, prefix):
+		matches = set()
+		for source in sources:
+			if source in self._tries:
+				matches.update(self._tries[source].complete(prefix))
+		return sorted(matches)
+
 class CommandController:
+	# Completion sources for each command's arguments
+	_argument_sources = {
+		"help": ["commands"]
+	}
+	# Sources that only change when they grow, and are filled again then
+	_static_sources = ("commands",)
+
 	def __init__(self, game):
 		self.game = game
 		self._is_active = True
+		self._completion = CompletionIndex()
+		self._completions = list()
+		self._completion_is_admin = None
+		self._completion_sizes = dict()
 		self.enable_completion()
 
 	# Method for tab completion
 	def _completer(self, text, state):
-		options = [x for x in self.get_command_names() if x.startswith(text)]
-		if state < len(options):
-			return options[state]
+		if state == 0:
+			try:
+				line = readline.get_line_buffer()[:readline.get_endidx()]
+			except:
+				line = text
+			self._completions = self.get_completions(line, text)
+		if state < len(self._completions):
+			return self._completions[state]
 		else:
 			return None
 
+	# Return completions for the word `text` at the end of a partial line.
+	# Arguments are completed as a whole, so multi-word names work
+	def get_completions(self, line, text=None):
+		if text is None:
+			text = line.split(" ")[-1]
+		command, separator, argument = line.lstrip().partition(" ")
+		if separator:
+			sources = self._argument_sources.get(command.lower(), list())
+			prefix = argument
+		else:
+			sources = ["commands"]
+			prefix = command
+		for source in sources:
+			self._update_completion_source(source)
+		# Only the part from `text` onwards is replaced
+		offset = len(prefix) - len(text)
+		return [match[offset:] for match in self._completion.complete(sources, prefix)]
+
+	def _update_completion_source(self, source):
+		# Admin commands come and go with the player's name
+		if source == "commands":
+			is_admin = self.game.player.name == "admin"
+			if self._completion_is_admin != is_admin:
+				self._completion.update(source, self.get_command_names())
+				self._completion_is_admin = is_admin
+		elif source not in self._static_sources:
+			self._completion.update(source, self._get_completion_names(source))
+		else:
+			size = self._get_completion_size(source)
+			if self._completion_sizes.get(source) != size:
+				self._completion.update(source, self._get_completion_names(source))
+				self._completion_sizes[source] = size
+
+	# Return the current names for a completion source
+	def _get_completion_names(self, source):
+		return list()
+
+	# Return how big a static completion source is, without listing its
+	# names
+	def _get_completion_size(self, source):
+		return 0
+
 	def enable_completion(self):
 		# Ensure readline library has been loaded
 		if "readline" in globals():
@@ -75,25 +650,27 @@ class CommandController:
 		return self._is_active
 
 	def execute_line(self, line):
-#		line_parts = shlex.split(line)
-		line = line.strip()
-		line_parts = line.split(" ")
-		if len(line_parts) > 0:
-			_log("Executing line '%s'" % line, level=3)
-			command = line_parts[0]
-			args = line_parts[1:]
-			func = self.get_command(command)
-			if func:
-				_log("running command '%s'" % command, level=4)
-				try:
-					output = func(*args)
-				except Exception as e:
-					output = str(e)
-				_log("command output:", output, level=5)
-				if output:
-					return str(output)
-				return
-			return "%s: command not found" % command
+		# Mutations made while executing the line belong to this game
+		with self.game.activate():
+#			line_parts = shlex.split(line)
+			line = line.strip()
+			line_parts = line.split(" ")
+			if len(line_parts) > 0:
+				_log("Executing line '%s'" % line, level=3)
+				command = line_parts[0]
+				args = line_parts[1:]
+				func = self.get_command(command)
+				if func:
+					_log("running command '%s'" % command, level=4)
+					try:
+						output = func(*args)
+					except Exception as e:
+						output = str(e)
+					_log("command output:", output, level=5)
+					if output:
+						return str(output)
+					return
+				return "%s: command not found" % command
 
 	def get_command(self, command):
 		return self.get_commands().get(command.lower())
@@ -215,16 +792,117 @@ class StartCommandController(CommandController):
 		return "\t".join(filenames)
 
 class GameCommandController(CommandController):
+	_argument_sources = {
+		"help": ["commands"],
+		"go": ["doors"],
+		"inspect": ["room", "room_items", "player_items", "monster_items", "monster"],
+		"open": ["room_items", "player_items"],
+		"use": ["player_items"],
+		"equip": ["player_items"],
+		"unequip": ["player_items"],
+		"pickup": ["room_items"],
+		"drop": ["player_items"],
+		"access": ["inventory"],
+		"view": ["equipment"],
+		"attack": ["until"],
+		"room": ["rooms"],
+		"travel": ["rooms"],
+		"teleport": ["rooms"],
+		"give": ["entities"],
+		"loot": ["entities"]
+	}
+	_static_sources = ("commands", "room", "inventory", "equipment", "until", "rooms", "entities")
+
+	def _get_completion_names(self, source):
+		room = self.game.map.current_room
+		if source == "doors":
+			return ["through door " + door.eid for door in room.get_doors()]
+		elif source == "room_items":
+			return self._retrieve_items(room.inventory)
+		elif source == "player_items":
+			return self._retrieve_items(self.game.player.inventory)
+		elif source == "monster_items":
+			if room.monster:
+				return self._retrieve_items(room.monster.inventory)
+		elif source == "monster":
+			if room.monster:
+				return [room.monster.name]
+		elif source == "rooms":
+			return [room.eid for room in self.game.map.get_rooms()]
+		elif source == "entities":
+			return self.game.entity_factory.get_entity_ids()
+		elif source in ("room", "inventory", "equipment", "until"):
+			return [source]
+		return list()
+
+	# Reloads add rooms to the map and definitions to the factory
+	def _get_completion_size(self, source):
+		if source == "rooms":
+			return len(self.game.map.get_rooms())
+		elif source == "entities":
+			return self.game.entity_factory.count_definitions()
+		return 0
+
+	def execute_line(self, line):
+		line_parts = line.strip().split(" ")
+		command = line_parts[0].lower()
+		# In a shared world, hold the rooms the command can touch
+		with self.game.map.lock_rooms(self._get_command_rooms(command, line_parts[1:])):
+			with self.game.activate():
+				# Every command except undo opens a new undo generation
+				if command != "undo":
+					self.game.snapshot()
+				# Profile every command but the ones driving the profiler
+				profiler = self.game.profiler
+				profiling = profiler and profiler.is_running() and command != "profile"
+				if profiling:
+					profiler.begin()
+				try:
+					output = super().execute_line(line)
+				finally:
+					if profiling:
+						profiler.end()
+					if self.game.memory_tracker:
+						self.game.memory_tracker.end_command()
+		# The world moves on once the command's rooms are released. Its
+		# changes are undone with the command's, and a tick that changes
+		# nothing doesn't make a command that changed nothing undoable
+		if command != "undo":
+			with self.game.activate():
+				self.game.tick()
+		return output
+
+	# Commands that lock rooms themselves, only as long as they change
+	# them, or that read or write files, which mustn't hold up the other
+	# players of a shared world
+	_unlocked_commands = ("travel", "reload", "save", "load", "replay", "profile", "memory")
+
+	# Return the rooms a command can read or change
+	def _get_command_rooms(self, command, args):
+		if command in self._unlocked_commands:
+			return list()
+		rooms = [self.game.map.current_room]
+		if command == "go" and len(args) == 3:
+			rooms.extend(self.game.map.get_rooms(door=args[2]))
+		elif command == "flee":
+			rooms.append(self.game.map.get_previous_room())
+		elif command == "teleport" and args:
+			rooms.append(self.game.map.get_room(eid=args[0]))
+		return rooms
+
 	def _retrieve_items(self, inventory):
 		items = dict()
 		for item in inventory.get_items():
-			item.parent = inventory
 			items[item.name] = item
 			if item.inventory.size() > 0:
 				inner_items = self._retrieve_items(item.inventory)
 				items.update(inner_items)
 		return items
 
+	# Return the key of `items` that best matches the name
+	def _resolve_name(self, name, items):
+		return NameIndex.match(name, [(key, key) for key in items])
+
 	def _retrieve_local_entities(self, room_inventory=None, player_inventory=None, monster_inventory=None, monster=None):
 	    # If no arguments are True, assume all are True
 		args = [room_inventory, player_inventory, monster_inventory, monster]
@@ -256,37 +934,16 @@ class GameCommandController(CommandController):
 					# If a monster is in the room, it attacks the player and prevents
 					# them from leaving
 					if self.game.map.current_room.monster:
-						damage = self.game.map.current_room.monster.attack(self.game.player)
-						output = "%s attacked" % self.game.map.current_room.monster.name
-						if damage:
-							output += " and did %i damage" % damage
-						output += "!\n"
-						output += "The monster stopped you from leaving\n"
-						output += self.game.player.inspect_stats()
-						return output
+						return self._block_exit()
 					door = self.game.map.current_room.get_door(door_id)
 					if door.key and not self.game.player.inventory.contains(eid=door.key.eid):
 						return "Door requires key '%s'" % door.key.name
 					elif door.puzzle and not door.puzzle.is_solved():
-						# Activate puzzle
-						self.game.view.output("A puzzle blocks the door...")
-						# Print puzzle description
-						self.game.view.output(door.puzzle.inspect())
-						self.game.view.output()
-						controller = PuzzleCommandController(self.game, door.puzzle)
-						while controller.is_active():
-							line = self.game.view.input()
-							output = controller.execute_line(line)
-							if output:
-								self.game.view.output(output)
-							if controller.is_active():
-								self.game.view.output()
-						del controller
-						# Re-enable this controller's tab completion
-						self.enable_completion()
-						# If the puzzle still exists after activation, ignore the door
-						if door.puzzle:
-							return
+						# Activate puzzle. It takes the following commands until
+						# it's solved or ignored, rather than this waiting on
+						# input for them, and goes through the door once solved
+						self.game.cmd_controller = PuzzleCommandController(self.game, door.puzzle, self, "go through door %s" % door_id)
+						return "A puzzle blocks the door...\n" + door.puzzle.inspect()
 					# If the key and puzzle requirements are satisfied, use the door
 					rooms = self.game.map.get_rooms(door=door.eid)
 					_log("Door '%s' matches" % door.eid, rooms, level=4)
@@ -302,6 +959,56 @@ class GameCommandController(CommandController):
 		else:
 			return self.do_help("go")
 
+	# The monster in the current room attacks the player and keeps them
+	# from leaving
+	def _block_exit(self):
+		monster = self.game.map.current_room.monster
+		damage = monster.attack(self.game.player)
+		output = "%s attacked" % monster.name
+		if damage:
+			output += " and did %i damage" % damage
+		output += "!\n"
+		output += "The monster stopped you from leaving\n"
+		output += self.game.player.inspect_stats()
+		return output
+
+	# Return whether the player can walk through a door without stopping
+	def _is_door_open(self, door):
+		if door.key and not self.game.player.inventory.contains(eid=door.key.eid):
+			return False
+		return not door.puzzle or door.puzzle.is_solved()
+
+	def do_travel(self, *args):
+		"""usage: travel room_id
+		   usage: travel room_name
+		   Walk to a room through the doors you can open, until a monster gets in the way"""
+		if args:
+			name = " ".join(args)
+			room = self.game.map.get_room(eid=name, name=name)
+			if not room:
+				return "No such room '%s'" % name
+			if room is self.game.map.current_room:
+				return "You're already in '%s'" % room.name
+			# Doors open with the keys the player holds and the puzzles solved
+			version = (self.game.player.inventory.version, Puzzle.solved_version)
+			route = self.game.map.get_route(room, self._is_door_open, version)
+			if route is None:
+				return "No open way to '%s'" % room.name
+			# Only the two rooms of each step are held, one step at a time
+			rooms = self.game.map.get_rooms()
+			with self.game.map.lock_rooms([self.game.map.current_room]):
+				if self.game.map.current_room.monster:
+					return self._block_exit()
+			for index in route:
+				with self.game.map.lock_rooms([self.game.map.current_room, rooms[index]]):
+					self.game.map.go_to(index)
+					self.game.map.current_room.enter()
+					if self.game.map.current_room.monster and self.game.map.current_room is not room:
+						output = "%s blocks the way!\n" % self.game.map.current_room.monster.name
+						return output + self.game.map.current_room.inspect()
+			return self.game.map.current_room.inspect()
+		return self.do_help("travel")
+
 	@CommandController.admin
 	def do_look(self, *args):
 		"""usage: look
@@ -320,10 +1027,10 @@ class GameCommandController(CommandController):
 			# Collect all inspectable items
 			items = self._retrieve_local_entities()
 			_log("Inspectable items:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				if name.lower() in key.lower():
-					return items[key].inspect()
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				return items[key].inspect()
 			return "Could not find '%s'" % name
 		return self.game.map.current_room.inspect()
 
@@ -335,19 +1042,19 @@ class GameCommandController(CommandController):
 			# Collect all inspectable items
 			items = self._retrieve_local_entities(room_inventory=True, player_inventory=True)
 			_log("Chest candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				if name.lower() in key.lower():
-					# Matched chest
-					chest = items[key]
-					output = ""
-					if chest.is_locked():
-						# Check to see if user has key
-						if self.game.player.inventory.contains(eid=chest.key.eid):
-							chest.is_locked(False)
-							output += "Unlocked chest!\n"
-					output += chest.inspect()
-					return output
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched chest
+				chest = items[key]
+				output = ""
+				if chest.is_locked():
+					# Check to see if user has key
+					if self.game.player.inventory.contains(eid=chest.key.eid):
+						chest.is_locked(False)
+						output += "Unlocked chest!\n"
+				output += chest.inspect()
+				return output
 			return "Could not find '%s'" % name
 
 	def do_use(self, *args):
@@ -358,17 +1065,17 @@ class GameCommandController(CommandController):
 			# Collect all items
 			items = self._retrieve_local_entities(player_inventory=True)
 			_log("Use candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				if name.lower() in key.lower():
-					# Matched item
-					item = items[key]
-					# Determine if item is usable
-					if not item.can_use():
-						return "You cannot use '%s'" % item.name
-					# Use the item
-					item.use(self.game.player)
-					return "Player eats '%s' and heals %i health to %i" % (item.name, item.health, self.game.player.health)
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched item
+				item = items[key]
+				# Determine if item is usable
+				if not item.can_use():
+					return "You cannot use '%s'" % item.name
+				# Use the item
+				item.use(self.game.player)
+				return "Player eats '%s' and heals %i health to %i" % (item.name, item.health, self.game.player.health)
 			return "Could not find '%s'" % name
 
 	def do_equip(self, *args):
@@ -379,18 +1086,17 @@ class GameCommandController(CommandController):
 			# Collect all items
 			items = self._retrieve_local_entities(player_inventory=True)
 			_log("Equip candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				_log("Comparing", name.lower(), "in", key.lower(), level=5)
-				if name.lower() in key.lower():
-					# Matched item
-					item = items[key]
-					# Determine if item is equipable
-					if not item.can_equip():
-						return "You cannot equip '%s'" % item.name
-					# Equip the item
-					item.equip(self.game.player)
-					return "The player equip %s" % item.name
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched item
+				item = items[key]
+				# Determine if item is equipable
+				if not item.can_equip():
+					return "You cannot equip '%s'" % item.name
+				# Equip the item
+				item.equip(self.game.player)
+				return "The player equip %s" % item.name
 			return "Could not find '%s'" % name
 		return self.do_help("equip")
 
@@ -402,21 +1108,20 @@ class GameCommandController(CommandController):
 			# Collect all items
 			items = self._retrieve_local_entities(player_inventory=True)
 			_log("Unequip candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				_log("Comparing", name.lower(), "in", key.lower(), level=5)
-				if name.lower() in key.lower():
-					# Matched item
-					item = items[key]
-					# Determine if item is equipped
-					if item.can_equip() and not item.is_equipped(self.game.player):
-						return "'%s' is not equipped" % item.name
-					elif not item.can_equip():
-						return "'%s' is not an equippable item" % item.name
-					elif item.can_equip and item.is_equipped(self.game.player):
-						# Unequip the item
-						item.unequip(self.game.player)
-						return "The player unequips %s" % item.name
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched item
+				item = items[key]
+				# Determine if item is equipped
+				if item.can_equip() and not item.is_equipped(self.game.player):
+					return "'%s' is not equipped" % item.name
+				elif not item.can_equip():
+					return "'%s' is not an equippable item" % item.name
+				elif item.can_equip and item.is_equipped(self.game.player):
+					# Unequip the item
+					item.unequip(self.game.player)
+					return "The player unequips %s" % item.name
 			return "Could not find '%s'" % name
 		return self.do_help("unequip")
 
@@ -428,18 +1133,18 @@ class GameCommandController(CommandController):
 			# Collect all items
 			items = self._retrieve_local_entities(room_inventory=True)
 			_log("Pickup candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				if name.lower() in key.lower():
-					# Matched item
-					item = items[key]
-					# Remove from room inventory
-					item.parent.pop(eid=item.eid)
-					self.game.player.inventory.add(item)
-					# Display inventory
-					output = "Player picks up '%s'\n" % item.name
-					output += self.game.player.inspect()
-					return output
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched item
+				item = items[key]
+				# Remove from the room inventory or the chest holding it
+				self.game.map.current_room.inventory.get_container(item.uid).pop(uid=item.uid)
+				self.game.player.inventory.add(item)
+				# Display inventory
+				output = "Player picks up '%s'\n" % item.name
+				output += self.game.player.inspect()
+				return output
 			return "Could not find '%s'" % name
 		return self.do_help("pickup")
 
@@ -451,18 +1156,18 @@ class GameCommandController(CommandController):
 			# Collect all items
 			items = self._retrieve_local_entities(player_inventory=True)
 			_log("Drop candidates:", items, level=4)
-			# Determine if name in items
-			for key in items:
-				if name.lower() in key.lower():
-					# Matched item
-					item = items[key]
-					# Remove from room inventory
-					self.game.player.inventory.pop(eid=item.eid)
-					self.game.map.current_room.inventory.add(item)
-					# Display inventory
-					output = "'%s' dropped\n" % item.name
-					output += self.game.player.inspect()
-					return output
+			# Find the closest matching name
+			key = self._resolve_name(name, items)
+			if key:
+				# Matched item
+				item = items[key]
+				# Remove from room inventory
+				self.game.player.inventory.pop(uid=item.uid)
+				self.game.map.current_room.inventory.add(item)
+				# Display inventory
+				output = "'%s' dropped\n" % item.name
+				output += self.game.player.inspect()
+				return output
 			return "Could not find '%s'" % name
 		return self.do_help("drop")
 
@@ -486,23 +1191,58 @@ class GameCommandController(CommandController):
 				return "No equipped items!"
 		return self.do_help("view")
 
+	def _defeat_monster(self, monster):
+		self.game.map.current_room.remove_monster(monster.eid)
+		self.game.schedule_respawn(self.game.map.current_room, monster)
+		output = "You defeated '%s'!" % monster.name
+		# Get dropped items
+		items = monster.get_dropped_items()
+		if items:
+			# Move the items so the monster doesn't keep them alive
+			for item in items:
+				monster.inventory.pop(uid=item.uid)
+			self.game.map.current_room.inventory.update(items)
+			output += "\nSomething fell to the floor..."
+		self.game.remove_entity(monster)
+		return output
+
 	def do_attack(self, *args):
 		"""usage: attack
-		   Try to attack the monster in the current room"""
+		   usage: attack until
+		   usage: attack until health
+		   Try to attack the monster in the current room, or keep fighting until one of you is dead or your health drops to the given value"""
 		monster = self.game.map.current_room.monster
 		player = self.game.player
-		if monster:
+		if monster and args:
+			if args[0] != "until":
+				return self.do_help("attack")
+			try:
+				until = int(args[1]) if len(args) > 1 else 0
+			except ValueError:
+				return self.do_help("attack")
+			if until < 0:
+				return self.do_help("attack")
+			# Resolve the whole fight at once
+			rounds, dealt, taken = player.fight(monster, until)
+			output = "%s fought '%s' for %i rounds, dealing %i damage and taking %i\n" % (
+				player.name,
+				monster.name,
+				rounds,
+				dealt,
+				taken
+			)
+			if not monster.is_alive():
+				output += self._defeat_monster(monster)
+			elif not player.is_alive():
+				raise PlayerIsDead()
+			else:
+				output += "Player [%i]\tMonster [%i]" % (player.health, monster.health)
+		elif monster:
 			damage = player.attack(monster)
 			output = "%s dealt %i damage!\n" % (player.name, damage)
 			if not monster.is_alive():
 				# Monster is dead
-				self.game.map.current_room.remove_monster(monster.eid)
-				output += "You defeated '%s'!" % monster.name
-				# Get dropped items
-				items = monster.get_dropped_items()
-				if items:
-					self.game.map.current_room.inventory.update(items)
-					output += "\nSomething fell to the floor..."
+				output += self._defeat_monster(monster)
 			else:
 				# Monster is alive and well
 				# Attack player
@@ -554,12 +1294,19 @@ class GameCommandController(CommandController):
 			filename = self.game.player.name
 		g = self.game.load(filename)
 		if isinstance(g, Game):
-			self.game = g
+			self.game.copy(g)
 			output = "Loaded game '%s'\n" % filename
 			output += self.game.map.current_room.inspect()
 			return output
 		return "Failed to load game '%s'" % filename
 
+	def do_undo(self, *args):
+		"""usage: undo
+		   Take back the last command that changed the game"""
+		if self.game.undo():
+			return "Time rewinds...\n" + self.game.map.current_room.inspect()
+		return "Nothing to undo!"
+
 	## Admin commands
 	@CommandController.admin
 	def do_set_health(self, *args):
@@ -574,15 +1321,52 @@ class GameCommandController(CommandController):
 		"""usage: set_attack num
 		   Set player attack to value"""
 		if args:
-			self.game.player._base_attack = int(args[0])
+			self.game.player.set_base_attack(args[0])
 		return self.game.player.inspect_stats()
 
 	@CommandController.admin
 	def do_rooms(self, *args):
 		"""usage: rooms
-		   View list of all rooms"""
-		rooms = [room.eid + ": " + room.name for room in self.game.map.get_rooms()]
-		return "\n".join(rooms)
+		   usage: rooms filter
+		   usage: rooms filter page
+		   View list of all rooms, or those whose name matches the filter"""
+		query, page = self._get_page_args(args)
+		rooms = self.game.map.get_rooms(name=query) if query else self.game.map.get_rooms()
+		return self._paginate(
+			lambda start, stop: (len(rooms), rooms[start:stop]),
+			page,
+			lambda room: room.eid + ": " + room.name
+		)
+
+	# Lines per page of the world listings
+	_page_size = 50
+
+	# Split the arguments of a listing into a filter and a page number,
+	# which is the last argument if it's a number
+	def _get_page_args(self, args):
+		if args and args[-1].isdigit():
+			return " ".join(args[:-1]), max(int(args[-1]), 1)
+		return " ".join(args), 1
+
+	# Return one page of what find(start, stop) finds, described by
+	# describe(obj), with the number of pages if there's more than one
+	def _paginate(self, find, page, describe):
+		start = (page - 1) * self._page_size
+		count, objects = find(start, start + self._page_size)
+		lines = [describe(obj) for obj in objects]
+		pages = (count + self._page_size - 1) // self._page_size
+		if pages > 1:
+			lines.append("Page %i of %i (%i results)" % (page, pages, count))
+		return "\n".join(lines)
+
+	# Describe an item or monster by the room it's in and what holds it
+	def _describe_location(self, obj):
+		room, path = self.game.world_index.get_location(obj)
+		return "[%s] %s: %s" % (
+			room.eid if room else "",
+			room.name if room else "",
+			" => ".join(path + [obj.name])
+		)
 
 	@CommandController.admin
 	def do_room(self, *args):
@@ -625,14 +1409,15 @@ class GameCommandController(CommandController):
 	@CommandController.admin
 	def do_items(self, *args):
 		"""usage: items
-		   Return a list of items on the map and their locations"""
-		room_items = list()
-		for room in self.game.map.get_rooms():
-			for item in room.inventory.get_items():
-				room_items.append("[%s] %s: %s" % (room.eid, room.name, item.name))
-				for subitem in item.inventory.get_items():
-					room_items.append("[%s] %s: %s => %s" % (room.eid, room.name, item.name, subitem.name))
-		return "\n".join(room_items)
+		   usage: items filter
+		   usage: items filter page
+		   Return a list of items on the map and their locations. The filter is an item id or name"""
+		query, page = self._get_page_args(args)
+		return self._paginate(
+			lambda start, stop: self.game.world_index.find_items(query, start, stop),
+			page,
+			self._describe_location
+		)
 
 	@CommandController.admin
 	def do_give(self, *args):
@@ -651,20 +1436,181 @@ class GameCommandController(CommandController):
 		else:
 			return "No valid item ids provided"
 
+	@CommandController.admin
+	def do_loot(self, *args):
+		"""usage: loot monster_id
+		   usage: loot monster_id kills
+		   Simulate a monster's drops over a number of kills"""
+		if args:
+			try:
+				kills = int(args[1]) if len(args) > 1 else 10000
+			except ValueError:
+				return self.do_help("loot")
+			monster = self.game.entity_factory.create_entity(args[0])
+			if not isinstance(monster, Monster) or not monster.loot_table:
+				return "No monster with loot '%s'" % args[0]
+			counts = monster.loot_table.count_drops(kills)
+			lines = ["%s over %i kills:" % (monster.name, kills)]
+			for item, count in zip(monster.inventory.get_items(), counts):
+				lines.append("%s: %i (%.2f%%)" % (item.name, count, 100.0 * count / max(kills, 1)))
+			return "\n".join(lines)
+		return self.do_help("loot")
+
+	@CommandController.admin
+	def do_replay(self, *args):
+		"""usage: replay
+		   usage: replay count
+		   usage: replay log_file
+		   usage: replay log_file count
+		   Rebuild the game from the start of an event log, by default the one being recorded, stopping after count events"""
+		args = list(args)
+		count = None
+		if args and args[-1].isdigit():
+			count = int(args.pop())
+		if args:
+			filepath = " ".join(args)
+		elif self.game.event_log:
+			self.game.event_log.flush()
+			filepath = self.game.event_log.filepath
+		else:
+			return "Not recording an event log"
+		game = Game(self.game._filepaths["config"])
+		try:
+			applied = game.replay(EventLog.read(filepath), count)
+		except (IOError, ValueError) as e:
+			return "Failed to replay '%s': %s" % (filepath, e)
+		# Recording stops, leaving the log intact
+		self.game.copy(game)
+		output = "Replayed %i events from '%s'" % (applied, filepath)
+		if self.game.map.current_room:
+			output += "\n" + self.game.map.current_room.inspect()
+		return output
+
+	@CommandController.admin
+	def do_profile(self, *args):
+		"""usage: profile
+		   usage: profile start [count | seconds s] [sample]
+		   usage: profile stop
+		   usage: profile top [count]
+		   usage: profile dump file
+		   Profile the next count commands (or the next seconds), report the hottest functions and dump pstats or collapsed stacks"""
+		profiler = self.game.profiler
+		if not args:
+			return profiler.status() if profiler else "No profile"
+		elif args[0] == "start":
+			options = list(args[1:])
+			sampling = "sample" in options
+			if sampling:
+				options.remove("sample")
+			commands = None
+			seconds = None
+			try:
+				if options and options[0].endswith("s"):
+					seconds = float(options[0][:-1])
+				elif options:
+					commands = int(options[0])
+			except ValueError:
+				return self.do_help("profile")
+			if profiler:
+				profiler.stop()
+			self.game.profiler = Profiler(commands, seconds, sampling)
+			return self.game.profiler.status()
+		elif not profiler:
+			return "No profile"
+		elif args[0] == "stop":
+			profiler.stop()
+			return profiler.report()
+		elif args[0] == "top":
+			try:
+				return profiler.report(int(args[1]) if len(args) > 1 else 10)
+			except ValueError:
+				return self.do_help("profile")
+		elif args[0] == "dump" and len(args) > 1:
+			if profiler.is_empty():
+				return "Nothing profiled"
+			filepath = " ".join(args[1:])
+			profiler.dump(filepath)
+			return "Dumped profile to '%s'" % filepath
+		return self.do_help("profile")
+
+	@CommandController.admin
+	def do_memory(self, *args):
+		"""usage: memory
+		   usage: memory start [every]
+		   usage: memory stop
+		   usage: memory diff [count]
+		   usage: memory objects
+		   Track memory use, diffing tracemalloc snapshots every few commands, or count the live entities by class"""
+		tracker = self.game.memory_tracker
+		if not args:
+			return tracker.status() if tracker else "No memory tracker"
+		elif args[0] == "start":
+			try:
+				every = int(args[1]) if len(args) > 1 else 100
+			except ValueError:
+				return self.do_help("memory")
+			if tracker:
+				tracker.stop()
+			self.game.memory_tracker = MemoryTracker(every)
+			return self.game.memory_tracker.status()
+		elif args[0] == "objects":
+			counts = get_object_counts(self.game)
+			lines = ["live\tin world\tclass"]
+			for name in sorted(counts, key=lambda name: counts[name][0], reverse=True):
+				lines.append("%i\t%i\t%s" % (counts[name][0], counts[name][1], name))
+			return "\n".join(lines)
+		elif not tracker:
+			return "No memory tracker"
+		elif args[0] == "stop":
+			tracker.stop()
+			return tracker.status()
+		elif args[0] == "diff":
+			try:
+				return tracker.report(int(args[1]) if len(args) > 1 else 10)
+			except ValueError:
+				return self.do_help("memory")
+		return self.do_help("memory")
+
 	@CommandController.admin
 	def do_monsters(self, *args):
 		"""usage: monsters
-		   Return a list of monsters on the map and their locations"""
-		room_monsters = list()
-		for room in self.game.map.get_rooms():
-			for monster in room.get_monsters():
-				room_monsters.append("[%s] %s: %s" % (room.eid, room.name, monster.name))
-		return "\n".join(room_monsters)
+		   usage: monsters filter
+		   usage: monsters filter page
+		   Return a list of monsters on the map and their locations. The filter is a monster id or name"""
+		query, page = self._get_page_args(args)
+		return self._paginate(
+			lambda start, stop: self.game.world_index.find_monsters(query, start, stop),
+			page,
+			self._describe_location
+		)
+
+	@CommandController.admin
+	def do_reload(self, *args):
+		"""usage: reload
+		   Patch the world with the changes made to the content files since they were loaded"""
+		is_recording = self.game.event_log is not None
+		can_undo = not self.game.history.is_empty()
+		eids = self.game.reload_content()
+		if not eids:
+			return "No content changed"
+		return "\n".join(["Reloaded " + ", ".join(eids)] + _describe_reload(self.game, is_recording, can_undo))
 
 class PuzzleCommandController(CommandController):
-	def __init__(self, game, puzzle):
+	def __init__(self, game, puzzle, previous=None, then=None):
 		super().__init__(game)
 		self.puzzle = puzzle
+		# The controller to hand back to once the puzzle is done with
+		self._previous = previous
+		# The line it then runs if the puzzle was solved
+		self._then = then
+
+	def is_active(self, value=None):
+		is_active = super().is_active(value)
+		if not is_active and self._previous and self.game.cmd_controller is self:
+			self.game.cmd_controller = self._previous
+			# Re-enable the previous controller's tab completion
+			self._previous.enable_completion()
+		return is_active
 
 	def do_solve(self, *args):
 		"""usage: solve answer
@@ -672,7 +1618,11 @@ class PuzzleCommandController(CommandController):
 		answer = " ".join(args)
 		if self.puzzle.solve(answer):
 			self.is_active(False)
-			return "Correct! The puzzle is deactivated."
+			output = "Correct! The puzzle is deactivated."
+			# Carry on with the command the puzzle stopped
+			if self._then and self.game.cmd_controller is self._previous:
+				output += "\n" + self._previous.execute_line(self._then)
+			return output
 		return "Incorrect"
 
 	def do_hint(self, *args):
@@ -701,14 +1651,31 @@ class PuzzleCommandController(CommandController):
 
 class Entity:
 	def __init__(self, uid=None, eid=None, name="", description=""):
-		self.uid = uid or uuid.uuid4().hex
-		self.eid = eid
+		self.uid = uid or next(_uids)
+		# The interned entity id
+		self.iid = _intern_eid(eid)
 		self.name = name
 		self.description = description
 
+	@property
+	def eid(self):
+		return _eids[self.iid] if self.iid is not None else None
+
+	@eid.setter
+	def eid(self, value):
+		self.iid = _intern_eid(value)
+
 	def inspect(self):
 		return "%s: %s" % (self.name, self.description)
 
+	# Take the content of an entity newly built from the same definition,
+	# keeping the state the game has changed. Returns the entities taken
+	# over from it, which are new to the world
+	def refresh(self, entity):
+		self.name = entity.name
+		self.description = entity.description
+		return list()
+
 	def __repr__(self):
 		return "<%s [%s]>" % (self.__class__.__qualname__, self.eid)
 
@@ -724,11 +1691,15 @@ class Item(Entity):
 		except:
 			self.drop_chance = 1
 
+	def refresh(self, entity):
+		self.drop_chance = entity.drop_chance
+		return super().refresh(entity)
+
 	def can_equip(self):
 		return self._equippable
 
 	def is_equipped(self, player):
-		return self in player.equipped
+		return self.can_equip() and player.get_equipped(self.slot) is self
 
 	def can_use(self):
 		return self._usable
@@ -754,12 +1725,25 @@ class Chest(Item):
 
 	def is_locked(self, value=None):
 		if isinstance(value, bool):
+			_touch(self)
 			self._is_locked = value
+			_emit(ChestLocked, self, value)
 		return self._is_locked
 
 	def requires_key(self):
 		return isinstance(self._key, Key)
 
+	# A chest that no longer needs a key is opened
+	def refresh(self, entity):
+		entities = super().refresh(entity)
+		if getattr(self._key, "iid", None) != getattr(entity.key, "iid", None):
+			self._key = entity.key
+			if entity.key:
+				entities.append(entity.key)
+			else:
+				self._is_locked = False
+		return entities
+
 	def inspect(self):
 		if self.is_locked():
 			return "%s [locked: %s]" % (self.name, self._key.name)
@@ -767,22 +1751,34 @@ class Chest(Item):
 			return super().inspect()
 
 class Equippable(Item):
+	# Characters can only have one item equipped per slot
+	slot = "equippable"
+
 	def __init__(self, uid=None, eid=None, name="", description="", drop_chance=None):
 		# All items can potentially contain other items
 		super().__init__(uid, eid, name, description, drop_chance)
 		self._equippable = True
 
 	def equip(self, player):
-		# You can only have one of each combatitem type equipped,
-		# so unequip any equipped items that share this class
-		for item in player.equipped:
-			if isinstance(item, self.__class__):
-				item.unequip(player)
+		# Unequip whatever already occupies this item's slot
+		item = player.get_equipped(self.slot)
+		if item is self:
+			return
+		elif item:
+			item.unequip(player)
+		_touch(player)
 		player.equipped.append(self)
+		player.slots[self.slot] = self
+		player.invalidate_combat_stats()
+		_emit(Equipped, player, self)
 
 	def unequip(self, player):
-		if self in player.equipped:
+		if player.get_equipped(self.slot) is self:
+			_touch(player)
 			player.equipped.remove(self)
+			del player.slots[self.slot]
+			player.invalidate_combat_stats()
+			_emit(Unequipped, player, self)
 
 class Usable(Item):
 	def __init__(self, uid=None, eid=None, name="", description="", drop_chance=None):
@@ -816,6 +1812,11 @@ class CombatItem(Equippable):
 		self._damage = damage
 		self._equipable = True
 
+	# Characters holding the item recompute their combat stats
+	def refresh(self, entity):
+		self._damage = entity.damage
+		return super().refresh(entity)
+
 	@property
 	def damage(self):
 		return self._damage
@@ -830,9 +1831,11 @@ class CombatItem(Equippable):
 			if not hasattr(self, "_damage"):
 				self._damage = 0
 
-class Weapon(CombatItem): pass
+class Weapon(CombatItem):
+	slot = "weapon"
 
-class Armor(CombatItem): pass
+class Armor(CombatItem):
+	slot = "armor"
 
 class Food(Usable):
 	def __init__(self, uid=None, eid=None, name="", description="", drop_chance=None, health=0):
@@ -852,17 +1855,24 @@ class Food(Usable):
 			if not hasattr(self, "_health"):
 				self._health = 0
 
+	def refresh(self, entity):
+		self._health = entity.health
+		return super().refresh(entity)
+
 	def _on_use(self, player, inventory=None):
 		player.health += self.health
 
 class Puzzle(Item):
-	def __init__(self, uid=None, eid=None, name="", description="", solutions=list(), hints=list(), attempts=None):
+	# Changes whenever any puzzle is solved or unsolved
+	solved_version = 0
+
+	def __init__(self, uid=None, eid=None, name="", description="", solutions=None, hints=None, attempts=None):
 		super().__init__(uid, eid, name, description)
 		self._solutions = list()
-		for solution in solutions:
+		for solution in solutions or ():
 			self.add_solution(solution)
 		self._hints = list()
-		for hint in hints:
+		for hint in hints or ():
 			self.add_hint(hint)
 		self._hint_index = 0
 		try:
@@ -896,6 +1906,7 @@ class Puzzle(Item):
 		hints_len = len(self._hints)
 		if hints_len > 0:
 			hint_index = self._hint_index % hints_len
+			_touch(self)
 			self._hint_index += 1
 			return self._hints[hint_index]
 
@@ -909,6 +1920,7 @@ class Puzzle(Item):
 				self.is_solved(True)
 				return True
 		# Incorrect guess
+		_touch(self)
 		try:
 			self._attempts -= 1
 			if self._attempts < 0:
@@ -919,14 +1931,26 @@ class Puzzle(Item):
 
 	def is_solved(self, value=None):
 		if isinstance(value, bool):
+			_touch(self)
 			self._is_solved = value
+			Puzzle.solved_version = next(_versions)
+			_emit(PuzzleSolved, self, value)
 		return self._is_solved
 
 	def inspect(self):
 		return self.description
 
+	# Solved puzzles stay solved
+	def refresh(self, entity):
+		self._solutions = list(entity._solutions)
+		self._hints = list(entity._hints)
+		return super().refresh(entity)
+
 class Inventory:
-	def __init__(self, items=list()):
+	# Changes with every item added or removed
+	version = 0
+
+	def __init__(self, items=None):
 		self._items = list()
 		# Ensure that only Entity objects are added
 		try:
@@ -938,13 +1962,21 @@ class Inventory:
 	# Retrieve an item by entity id, unique id, or name
 	# If name is given, match the closest named item
 	def get(self, eid=None, uid=None, name=None):
+		if eid and not uid and not name:
+			number = _eid_numbers.get(eid)
+			if number is not None:
+				for item in self._items:
+					if item.iid == number:
+						return item
+			return None
 		if name:
 			name = str(name).lower()
+		number = _eid_numbers.get(eid) if eid else None
 		
 		for item in self._items:
 			if uid and uid == item.uid:
 				return item
-			elif eid and eid == item.eid:
+			elif number is not None and number == item.iid:
 				return item
 			elif name and name in item.name.lower():
 				return item
@@ -954,16 +1986,39 @@ class Inventory:
 	def pop(self, eid=None, uid=None, name=None):
 		item = self.get(eid, uid, name)
 		if item:
+			_touch(self)
 			self._items.remove(item)
+			self.version = next(_versions)
+			_emit(InventoryPop, self, item)
 			return item
 
 	def contains(self, eid=None, uid=None, name=None):
 		return bool(self.get(eid, uid, name))
 
+	# Return the inventory holding the item with the given uid, either
+	# this one or one nested in its items
+	def get_container(self, uid):
+		for item in self._items:
+			if item.uid == uid:
+				return self
+		for item in self._items:
+			container = item.inventory.get_container(uid)
+			if container:
+				return container
+
 	# Add an item to the inventory list
 	def add(self, item):
 		if isinstance(item, Entity):
+			_touch(self)
 			self._items.append(item)
+			self.version = next(_versions)
+			_emit(InventoryAdd, self, item)
+
+	# Stamps are only unique within a process, so a loaded inventory
+	# takes a new one
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.version = next(_versions)
 
 	# Add a list of items
 	def update(self, items):
@@ -979,6 +2034,119 @@ class Inventory:
 	def size(self):
 		return len(self._items)
 
+# Weighted random choice in O(1) per sample using Vose's alias method
+class AliasTable:
+	def __init__(self, weights):
+		size = len(weights)
+		total = sum(weights)
+		self._prob = [1.0] * size
+		self._alias = list(range(size))
+		if size == 0 or total <= 0:
+			return
+		# Scale the weights so that they average to 1, then pair each
+		# under-full column with an over-full one
+		scaled = [weight * size / total for weight in weights]
+		small = [i for i in range(size) if scaled[i] < 1]
+		large = [i for i in range(size) if scaled[i] >= 1]
+		while small and large:
+			less = small.pop()
+			more = large.pop()
+			self._prob[less] = scaled[less]
+			self._alias[less] = more
+			scaled[more] += scaled[less] - 1
+			if scaled[more] < 1:
+				small.append(more)
+			else:
+				large.append(more)
+
+	def size(self):
+		return len(self._prob)
+
+	def sample(self):
+		column = random.randrange(len(self._prob))
+		if random.random() < self._prob[column]:
+			return column
+		return self._alias[column]
+
+	def sample_many(self, count):
+		size = len(self._prob)
+		prob = self._prob
+		alias = self._alias
+		rand = random.random
+		columns = [int(rand() * size) for _ in range(count)]
+		return [column if rand() < prob[column] else alias[column] for column in columns]
+
+# Compiled drop chances for a list of items. Samples are bit masks in
+# which bit i is set if item i dropped. By default every item drops
+# independently; single tables drop at most one item, chosen with an
+# alias table (with any probability left over meaning no drop)
+class LootTable:
+	# Drop chances are rounded to multiples of 1 / 2**16
+	_bits = 16
+
+	def __init__(self, chances, single=False):
+		self.chances = [min(max(float(chance), 0.0), 1.0) for chance in chances]
+		self._single = bool(single)
+		scale = 1 << self._bits
+		self._thresholds = [round(chance * scale) for chance in self.chances]
+		# Items that always drop, and those that need a roll
+		self._always = 0
+		self._rolled = list()
+		for i, threshold in enumerate(self._thresholds):
+			if threshold >= scale:
+				self._always |= 1 << i
+			elif threshold > 0:
+				self._rolled.append((1 << i, threshold))
+		if self._single:
+			weights = list(self.chances)
+			weights.append(max(1.0 - sum(self.chances), 0.0))
+			self._alias_table = AliasTable(weights)
+
+	def size(self):
+		return len(self.chances)
+
+	def is_single(self):
+		return self._single
+
+	# Draw `count` random values of `_bits` bits with a single call
+	def _draw(self, count):
+		values = array("H")
+		values.frombytes(random.getrandbits(self._bits * count).to_bytes(2 * count, "little"))
+		return values
+
+	def sample(self):
+		return self.sample_many(1)[0]
+
+	def sample_many(self, count):
+		if self._single:
+			size = self.size()
+			return [1 << i if i < size else 0 for i in self._alias_table.sample_many(count)]
+		masks = [self._always] * count
+		for bit, threshold in self._rolled:
+			for i, value in enumerate(self._draw(count)):
+				if value < threshold:
+					masks[i] |= bit
+		return masks
+
+	# Return how many times each item dropped over `count` samples
+	def count_drops(self, count):
+		if self._single:
+			counts = [0] * (self.size() + 1)
+			for i in self._alias_table.sample_many(count):
+				counts[i] += 1
+			return counts[:-1]
+		counts = [count if self._always >> i & 1 else 0 for i in range(self.size())]
+		for bit, threshold in self._rolled:
+			i = bit.bit_length() - 1
+			counts[i] = sum(1 for value in self._draw(count) if value < threshold)
+		return counts
+
+	# Return the items that dropped from a list matching the table
+	def select(self, items, mask=None):
+		if mask is None:
+			mask = self.sample()
+		return [item for i, item in enumerate(items) if mask >> i & 1]
+
 class Character(Entity):
 	def __init__(self,
 		uid = None,
@@ -990,7 +2158,7 @@ class Character(Entity):
 		resistance = 0,
 		armor = None,
 		weapon = None,
-		inventory = list()
+		inventory = None
 	):
 		self._name = None
 		self.name = name
@@ -998,6 +2166,7 @@ class Character(Entity):
 
 		# Stats
 		self.health = health
+		self.max_health = self.health
 		self._base_attack = attack
 		self._base_resistance = resistance
 		
@@ -1007,11 +2176,26 @@ class Character(Entity):
 		_log("Added %s to '%s' inventory" % (inventory, self.eid), level=5)
 		_log("'%s' inventory" % self.eid, self.inventory.get_items(), level=5)
 
-		# Equipable items
+		# Compiled drop chances for the inventory, if any
+		self.loot_table = None
+
+		# Equipable items, in the order they were equipped and by slot
 		self.equipped = list()
+		self.slots = dict()
+		self._combat_stats = None
 		self.equip(armor)
 		self.equip(weapon)
 
+	# Characters pickled before they had a full health, drop chances and
+	# equipment slots started with 100 health and had none of the others
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.__dict__.setdefault("max_health", 100)
+		self.__dict__.setdefault("loot_table", None)
+		if "slots" not in state:
+			self.slots = {item.slot: item for item in self.equipped}
+		self._combat_stats = None
+
 	@property
 	def name(self):
 		return self._name
@@ -1023,7 +2207,9 @@ class Character(Entity):
 		else:
 			value = str(value)
 		_log("Changed player '%s' name to '%s'" % (self.name, value))
+		_touch(self)
 		self._name = value
+		_emit(NameChanged, self, value)
 	
 	@property
 	def health(self):
@@ -1032,27 +2218,64 @@ class Character(Entity):
 	@health.setter
 	def health(self, value):
 		try:
-			self._health = int(value)
+			value = int(value)
 		except:
-			return	
+			return
+		_touch(self)
+		self._health = value
 		if self._health < 0:
 			self._health = 0
+		_emit(HealthChanged, self, self._health)
 		if self._health == 0:
 			_log("Character '%s' is dead" % self.name, level=2)
 		else:
 			_log("Set '%s' health to '%i'" % (self.name, self.health), level=2)
 
 	## Combat
+	# Return the effective attack damage and armor, which are only
+	# recomputed after the character's equipment or base attack changes
+	def get_combat_stats(self):
+		if self._combat_stats is None:
+			attack = self._base_attack
+			if self.has_weapon():
+				attack += self.get_weapon().damage
+			armor = None
+			if self.has_armor():
+				armor = self.get_armor().damage
+			self._combat_stats = (attack, armor)
+		return self._combat_stats
+
+	def invalidate_combat_stats(self):
+		self._combat_stats = None
+
+	# Characters at full health get the new full health, the others keep
+	# what they have left, up to it
+	def refresh(self, entity):
+		self._name = entity.name
+		self.description = entity.description
+		if self._health >= self.max_health:
+			self._health = entity.max_health
+		else:
+			self._health = min(self._health, entity.max_health)
+		self.max_health = entity.max_health
+		self._base_attack = entity._base_attack
+		self._base_resistance = entity._base_resistance
+		self.invalidate_combat_stats()
+		return list()
+
+	def set_base_attack(self, value):
+		_touch(self)
+		self._base_attack = int(value)
+		self.invalidate_combat_stats()
+		_emit(BaseAttackChanged, self, self._base_attack)
+
 	def attack(self, character):
 		damage = self.get_attack_damage()
 		character.damage(damage)
 		return damage
 
 	def get_attack_damage(self):
-		damage = self._base_attack
-		if self.has_weapon():
-			damage += self.get_weapon().damage
-		return damage
+		return self.get_combat_stats()[0]
 
 	def damage(self, value):
 		try:
@@ -1060,31 +2283,60 @@ class Character(Entity):
 		except:
 			_log("invalid damage '%s'" % value)
 		else:
-			if self.has_armor():
-				value -= self.get_armor().damage * value
+			armor = self.get_combat_stats()[1]
+			if armor is not None:
+				value -= armor * value
 			self.health -= value
 		return self.health
 
+	# Trade blows with a character until one of them dies or this
+	# character's health drops to `until`, without going through the
+	# health setter on every exchange. Returns the number of rounds
+	# fought and the damage dealt and taken
+	def fight(self, character, until=0):
+		attack, armor = self.get_combat_stats()
+		enemy_attack, enemy_armor = character.get_combat_stats()
+		# Damage after armor is the same for every exchange
+		damage = attack - enemy_armor * attack if enemy_armor is not None else attack
+		enemy_damage = enemy_attack - armor * enemy_attack if armor is not None else enemy_attack
+		# A fight that can't be won only wears the character down
+		if damage <= 0:
+			return 0, 0, 0
+		until = max(until, 0)
+		health = self.health
+		enemy_health = character.health
+		rounds = 0
+		while health > until and enemy_health > 0:
+			rounds += 1
+			enemy_health = max(int(enemy_health - damage), 0)
+			if enemy_health == 0:
+				break
+			health = max(int(health - enemy_damage), 0)
+		dealt = character.health - enemy_health
+		taken = self.health - health
+		character.health = enemy_health
+		self.health = health
+		return rounds, dealt, taken
+
 	def is_alive(self):
 		return self.health > 0
     
 	## Armor
 	def has_armor(self):
-		return bool(self.get_armor())
+		return Armor.slot in self.slots
 
 	def get_armor(self):
-		for item in self.equipped:
-			if isinstance(item, Armor):
-				return item
+		return self.slots.get(Armor.slot)
 
 	## Weapon
 	def has_weapon(self):
-		return bool(self.get_weapon())
+		return Weapon.slot in self.slots
 
 	def get_weapon(self):
-		for item in self.equipped:
-			if isinstance(item, Weapon):
-				return item
+		return self.slots.get(Weapon.slot)
+
+	def get_equipped(self, slot):
+		return self.slots.get(slot)
 
 	## Equip items
 	def equip(self, item):
@@ -1105,6 +2357,9 @@ class Character(Entity):
 
 	## Get dropped items based on probability
 	def get_dropped_items(self):
+		items = self.inventory.get_items()
+		if self.loot_table and self.loot_table.size() == len(items):
+			return self.loot_table.select(items)
 		items = list()
 		for item in self.inventory.get_items():
 			if random.random() <= item.drop_chance:
@@ -1158,15 +2413,28 @@ class Monster(Character):
 		resistance = 0,
 		armor = None,
 		weapon = None,
-		inventory = list(),
-		is_boss = False
+		inventory = None,
+		is_boss = False,
+		loot_table = None
 	):
 		super().__init__(uid, eid, name, description, health, attack, resistance, armor, weapon, inventory)
 		self._is_boss = is_boss
+		self.loot_table = loot_table
 
 	def is_boss(self):
 		return bool(self._is_boss)
 
+	# Monsters only carry what their definition gives them, so they take
+	# the new entity's items along with its equipment and drop chances
+	def refresh(self, entity):
+		self._is_boss = entity._is_boss
+		self.inventory = entity.inventory
+		self.equipped = list(entity.equipped)
+		self.slots = dict(entity.slots)
+		self.loot_table = entity.loot_table
+		super().refresh(entity)
+		return [self.inventory]
+
 class Door(Entity):
 	def __init__(self, uid=None, eid=None, puzzle=None, key=None):
 		super().__init__(uid, eid, name=None, description=None)
@@ -1187,8 +2455,19 @@ class Door(Entity):
 	def has_key(self):
 		return isinstance(self.key, Key)
 
+	# A door keeps its puzzle, solved or not, unless it's given another
+	def refresh(self, entity):
+		entities = list()
+		if getattr(self.puzzle, "iid", None) != getattr(entity.puzzle, "iid", None):
+			self.add_puzzle(entity.puzzle)
+			entities.append(entity.puzzle)
+		if getattr(self.key, "iid", None) != getattr(entity.key, "iid", None):
+			self.add_key(entity.key)
+			entities.append(entity.key)
+		return [entity for entity in entities if entity]
+
 class Room(Entity):
-	def __init__(self, uid=None, eid=None, name="", description="", doors=list(), items=list(), monsters=None):
+	def __init__(self, uid=None, eid=None, name="", description="", doors=None, items=None, monsters=None):
 		super().__init__(uid, eid, name, description)
 		# Add doors
 		self.doors = list()
@@ -1224,8 +2503,9 @@ class Room(Entity):
 			self.doors.append(door)
 
 	def get_door(self, eid):
+		number = _eid_numbers.get(eid)
 		for door in self.doors:
-			if door.eid == eid:
+			if door.iid == number:
 				return door
 
 	def has_door(self, eid):
@@ -1234,25 +2514,45 @@ class Room(Entity):
 	def get_doors(self):
 		return self.doors
 
+	# The items and monsters in the room are the game's, so only the
+	# doors are taken, keeping those the room already has
+	def refresh(self, entity):
+		super().refresh(entity)
+		doors = {door.iid: door for door in self.doors}
+		self.doors = [doors.get(door.iid, door) for door in entity.get_doors()]
+		return [door for door in self.doors if door.iid not in doors]
+
 	## Monsters
 	def add_monster(self, monster):
 		if isinstance(monster, Monster):
+			_touch(self)
 			self._monsters.append(monster)
+			_emit(MonsterAdded, self, monster)
 
 	def remove_monster(self, eid=None, name=None):
 		name = str(name).lower()
+		number = _eid_numbers.get(eid)
 		# Remove monster from monster list
-		for monster in self._monsters:
-			if monster.eid == eid:
-				self._monsters.remove(monster)
+		for monster in list(self._monsters):
+			if monster.iid == number:
+				self.discard_monster(monster)
 			elif name in monster.name.lower():
-				self._monsters.remove(monster)
+				self.discard_monster(monster)
 		# Remove room monster if match
 		if self.monster:
-			if self.monster.eid == eid:
-				self.monster = None
+			if self.monster.iid == number:
+				self.discard_monster(self.monster)
 			elif name in self.monster.name:
-				self.monster = None
+				self.discard_monster(self.monster)
+
+	# Remove one particular monster from the room
+	def discard_monster(self, monster):
+		_touch(self)
+		if monster in self._monsters:
+			self._monsters.remove(monster)
+		if self.monster is monster:
+			self.monster = None
+		_emit(MonsterRemoved, self, monster)
 
 	def get_monster(self):
 		# If a boss monster exists, return the boss monster
@@ -1266,7 +2566,12 @@ class Room(Entity):
 		return self._monsters
 
 	def enter(self):
-		self.monster = self.get_monster()
+		self.set_monster(self.get_monster())
+
+	def set_monster(self, monster):
+		_touch(self)
+		self.monster = monster
+		_emit(MonsterChosen, self, monster)
 
 	## Inspect
 	def inspect(self):
@@ -1287,12 +2592,54 @@ class Room(Entity):
 		return description
 
 class EntityFactory:
-	def __init__(self, entities=list()):
+	def __init__(self, entities=list(), catalog=None):
 		self._entities = dict()
+		# Compiled definitions, looked up when not added directly
+		self._catalog = catalog
+		# Loot tables shared by every monster with the same drops
+		self._loot_tables = dict()
 		if isinstance(entities, list):
 			for entity in entities:
 				self.add_entity(entity)
 
+	# Types of the definition fields that the generators read
+	_definition_types = {
+		"id": str,
+		"name": str,
+		"description": str,
+		"key": str,
+		"puzzle": str,
+		"drop": str,
+		"items": list,
+		"doors": list,
+		"monsters": list,
+		"solutions": list,
+		"hints": list,
+		"use": dict,
+		"equip": dict,
+		"health": (int, float),
+		"attack": (int, float),
+		"armor": (int, float),
+		"probability": (int, float)
+	}
+
+	# Return a list of the problems with a definition
+	@classmethod
+	def check_definition(cls, entity_dict):
+		if not isinstance(entity_dict, dict):
+			return ["Definition is not an object"]
+		eid = entity_dict.get("id")
+		if not eid:
+			return ["Definition has no id"]
+		problems = list()
+		for field, value in entity_dict.items():
+			field_type = cls._definition_types.get(field)
+			if field_type and value is not None and not isinstance(value, field_type):
+				problems.append("'%s' has an invalid '%s'" % (eid, field))
+		if isinstance(eid, str) and not hasattr(cls, "_create_" + eid[:3]):
+			problems.append("'%s' has an unknown entity type" % eid)
+		return problems
+
 	# Add an entity definition / dict
 	def add_definition(self, entity_dict):
 		# Entity must be a dict...
@@ -1302,8 +2649,35 @@ class EntityFactory:
 				self._entities[entity_dict.get("id")] = entity_dict
 				_log("Loaded entity definition '%s'" % entity_dict.get("id"), level=4)
 
-	# Return an entity object based on an entity id
+	# The number of definitions added directly, which grows as content
+	# is reloaded
+	def count_definitions(self):
+		return len(self._entities)
+
+	def get_entity_ids(self):
+		if self._catalog:
+			return list(self._entities) + [eid for eid in self._catalog.get_ids() if eid not in self._entities]
+		return list(self._entities)
+
+	def get_definition(self, eid):
+		entity_dict = self._entities.get(eid)
+		if entity_dict is None and self._catalog:
+			return self._catalog.get(eid)
+		return entity_dict
+
+	def get_definitions(self):
+		return [self.get_definition(eid) for eid in self.get_entity_ids()]
+
+	# Return an entity object based on an entity id. Entities created
+	# while a game is active become part of that game
 	def create_entity(self, eid):
+		entity = self._create_entity(eid)
+		game = _active_game.get()
+		if entity and game is not None:
+			game.add_entity(eid, entity)
+		return entity
+
+	def _create_entity(self, eid):
 		_log("Creating entity '%s'" % eid, level=4)
 		if eid:
 			if isinstance(eid, dict):
@@ -1312,12 +2686,18 @@ class EntityFactory:
 			else:
 				custom_dict = dict()
 				eid = str(eid)
-			entity_dict = self._entities.get(eid)
+			entity_dict = self.get_definition(eid)
 			if entity_dict:
+				# Copy the definition so that it can be shared between games
+				entity_dict = dict(entity_dict)
 				entity_dict.update(custom_dict)
 				generator = self._get_entity_generator(eid)
 				if generator:
-					return generator(entity_dict)
+					entity = generator(entity_dict)
+					if custom_dict and entity:
+						# Saves rebuild the entity from the same definition
+						entity._overrides = custom_dict
+					return entity
 				else:
 					_log("Generator not found for '%s'" % eid, level=4)
 			else:
@@ -1328,7 +2708,7 @@ class EntityFactory:
 		entities = list()
 		if isinstance(eids, list):
 			for eid in eids:
-				entity = self.create_entity(eid)
+				entity = self._create_entity(eid)
 				entities.append(entity)
 		return entities
 
@@ -1358,7 +2738,7 @@ class EntityFactory:
 	# Create a chest object
 	def _create_cst(self, entity_dict):
 		key_eid = entity_dict.get("key")
-		key = self.create_entity(key_eid)
+		key = self._create_entity(key_eid)
 		chest = Chest(
 			eid = entity_dict.get("id"),
 			name = entity_dict.get("name"),
@@ -1374,9 +2754,9 @@ class EntityFactory:
 	def _create_dor(self, entity_dict):
 		# eid, puzzle, key
 		# Create a puzzle if the door has a puzzle
-		puzzle = self.create_entity(entity_dict.get("puzzle"))
+		puzzle = self._create_entity(entity_dict.get("puzzle"))
 		# Create a key if the door has a key
-		key = self.create_entity(entity_dict.get("key"))
+		key = self._create_entity(entity_dict.get("key"))
 		return Door(
 			eid = entity_dict.get("id"),
 			puzzle = puzzle,
@@ -1417,6 +2797,11 @@ class EntityFactory:
 				armor = item
 			elif isinstance(item, Weapon):
 				weapon = item
+		items = [item for item in items if isinstance(item, Entity)]
+		loot_table = self.get_loot_table(
+			[item.drop_chance for item in items],
+			entity_dict.get("drop") == "one"
+		)
 		return Monster(
 			eid = entity_dict.get("id"),
 			name = entity_dict.get("name"),
@@ -1427,9 +2812,19 @@ class EntityFactory:
 			armor = armor,
 			weapon = weapon,
 			inventory = items,
-			is_boss = entity_dict.get("is_boss")
+			is_boss = entity_dict.get("is_boss"),
+			loot_table = loot_table
 		)
 
+	# Return the compiled loot table for a list of drop chances
+	def get_loot_table(self, chances, single=False):
+		key = (tuple(chances), bool(single))
+		loot_table = self._loot_tables.get(key)
+		if not loot_table:
+			loot_table = LootTable(chances, single)
+			self._loot_tables[key] = loot_table
+		return loot_table
+
 	# Create a puzzle object
 	def _create_puz(self, entity_dict):
 		# eid, name, description, solutions, hints, attempts
@@ -1472,33 +2867,157 @@ class EntityFactory:
 		)
 
 class Map:
-	def __init__(self, rooms=list()):
+	def __init__(self, rooms=None, history_depth=100):
 		self._rooms = list()
-		self._room_history = list()
-		for room in rooms:
-			self._add_room(room)
+		# Room uid => index in _rooms
+		self._room_indexes = dict()
+		# Room eid => index of the first room with that eid
+		self._room_eids = dict()
+		self._room_names = NameIndex()
+		# Door eid => indexes of the rooms with that door
+		self._door_rooms = dict()
+		# Room index => (door, index of the room it leads to) for each door,
+		# built when first needed
+		self._exits = None
+		# (start index, state of the guarded doors) => BFS tree
+		self._routes = dict()
+		# Indexes of the most recently visited rooms, oldest first
+		self._room_history = deque(maxlen=history_depth)
+		# Per-room locks, once the map is shared between players
+		self._locks = None
+		for room in rooms or ():
+			self.add_room(room)
+
+	# Store the room history as a compact array of room indexes
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		history = self._room_history
+		state["_room_history"] = (history.maxlen, array("I", history).tobytes())
+		state["_locks"] = None
+		state["_exits"] = None
+		state["_routes"] = dict()
+		return state
+
+	def __setstate__(self, state):
+		history = state.pop("_room_history")
+		self.__dict__.update(state)
+		if isinstance(history, tuple):
+			maxlen, history = history
+			self._room_history = deque(array("I", history), maxlen=maxlen)
+			return
+		# Maps pickled before rooms were indexed kept the rooms visited
+		# themselves. Their entity ids may not be interned yet, so the
+		# game reindexes the map once they are
+		self._room_indexes = {room.uid: index for index, room in enumerate(self._rooms)}
+		self._room_names = NameIndex()
+		for room in self._rooms:
+			self._room_names.add(room.name, room)
+		self.__dict__.setdefault("_room_eids", dict())
+		self.__dict__.setdefault("_door_rooms", dict())
+		self._exits = None
+		self._routes = dict()
+		self._locks = None
+		self._room_history = deque((self._room_indexes[room.uid] for room in history if room.uid in self._room_indexes), maxlen=100)
+
+	# Rebuild the indexes of the rooms and doors by entity id, for maps
+	# loaded from a process that interned the ids differently
+	def reindex(self):
+		self._room_eids = dict()
+		self._door_rooms = dict()
+		for index, room in enumerate(self._rooms):
+			self._room_eids.setdefault(room.iid, index)
+			for door in room.get_doors():
+				self._door_rooms.setdefault(door.iid, list()).append(index)
+		self._exits = None
+		self._routes = dict()
+
+	# Forget the routes, for changes that the route versions don't cover
+	def clear_routes(self):
+		self._routes.clear()
 
 	## Rooms
 	@property
 	def current_room(self):
 		if self._room_history:
-			return self._room_history[-1]
+			return self._rooms[self._room_history[-1]]
 
 	def add_room(self, room):
 		if isinstance(room, Room):
+			index = len(self._rooms)
+			self._room_indexes[room.uid] = index
+			self._room_eids.setdefault(room.iid, index)
+			self._room_names.add(room.name, room)
+			for door in room.get_doors():
+				self._door_rooms.setdefault(door.iid, list()).append(index)
+			if self._locks is not None:
+				self._locks.append(threading.RLock())
 			self._rooms.append(room)
+			if self._exits is not None:
+				self._exits.append(list())
+				self._update_exits(index, room.get_doors())
+			self._routes.clear()
+
+	# Update the indexes of a room whose doors or name changed, given
+	# the doors and name it had
+	def update_room(self, room, doors, name):
+		index = self._room_indexes[room.uid]
+		if room.name != name:
+			self._room_names.remove(room)
+			self._room_names.add(room.name, room)
+		old_doors = {door.iid for door in doors}
+		new_doors = {door.iid for door in room.get_doors()}
+		for iid in old_doors - new_doors:
+			self._door_rooms[iid].remove(index)
+		for iid in new_doors - old_doors:
+			bisect.insort(self._door_rooms.setdefault(iid, list()), index)
+		if self._exits is not None:
+			self._update_exits(index, list(doors) + room.get_doors())
+		self._routes.clear()
+
+	# Return a map of the same rooms with its own room history, for
+	# another player in a shared world. The indexes are changed in place
+	# from then on, so every player's map sees rooms added or changed
+	def share(self):
+		if self._locks is None:
+			self._locks = [threading.RLock() for room in self._rooms]
+		self.get_exits(0)
+		shared = Map.__new__(Map)
+		shared.__dict__.update(self.__dict__)
+		shared._room_history = deque(maxlen=self._room_history.maxlen)
+		return shared
+
+	def is_shared(self):
+		return self._locks is not None
+
+	# Hold the locks of the given rooms, always in map order so that
+	# players locking overlapping rooms can't deadlock
+	@contextlib.contextmanager
+	def lock_rooms(self, rooms):
+		locks = list()
+		if self._locks is not None:
+			indexes = {self._room_indexes[room.uid] for room in rooms if room}
+			locks = [self._locks[index] for index in sorted(indexes)]
+		for lock in locks:
+			lock.acquire()
+		try:
+			yield
+		finally:
+			for lock in reversed(locks):
+				lock.release()
+
+	def get_previous_room(self):
+		if len(self._room_history) > 1:
+			return self._rooms[self._room_history[-2]]
 
 	def get_random_room(self):
 		return random.choice(self._rooms)
 
 	def get_room(self, eid=None, name=None):
+		index = self._room_eids.get(_eid_numbers.get(eid))
+		if index is not None:
+			return self._rooms[index]
 		if name:
-			name = str(name).lower()
-		for room in self._rooms:
-			if room.eid == eid:
-				return room
-			elif name and name in room.name.lower():
-				return room
+			return self._room_names.get(name)
 
 	def get_rooms(self, name=None, door=None):
 		if not name and not door:
@@ -1506,14 +3025,73 @@ class Map:
 
 		rooms = list()
 		if name:
-			name = str(name).lower()
-		for room in self._rooms:
-			if name and name in room.name.lower():
-				rooms.append(room)
-			elif door and room.has_door(door):
-				rooms.append(room)
+			rooms = self._room_names.resolve(name)
+		if door:
+			door_rooms = [self._rooms[index] for index in self._door_rooms.get(_eid_numbers.get(door), ())]
+			rooms.extend(room for room in door_rooms if room not in rooms)
 		return rooms
 
+	def get_room_index(self, room):
+		return self._room_indexes.get(room.uid)
+
+	# Return the (door, room index) pairs leading out of the room with the
+	# given index
+	def get_exits(self, index):
+		if self._exits is None:
+			self._exits = [self._get_room_exits(room_index) for room_index in range(len(self._rooms))]
+		return self._exits[index] if index < len(self._exits) else ()
+
+	def _get_room_exits(self, index):
+		exits = list()
+		for door in self._rooms[index].get_doors():
+			for other in self._door_rooms[door.iid]:
+				if other != index:
+					# Doors lead to the first other room with them
+					exits.append((door, other))
+					break
+		return exits
+
+	# Work out the exits again for a room and the rooms on the other side
+	# of the given doors
+	def _update_exits(self, index, doors):
+		indexes = {index}
+		for door in doors:
+			indexes.update(self._door_rooms.get(door.iid, ()))
+		for room_index in indexes:
+			self._exits[room_index] = self._get_room_exits(room_index)
+
+	# Return the indexes of the rooms on the shortest way from the current
+	# room to `room`, through the doors for which is_open(door) is true,
+	# or None if there's no way there. BFS trees are cached for each start
+	# room and `version`, which must change whenever is_open() could
+	# give another answer for a door with a key or puzzle
+	def get_route(self, room, is_open, version):
+		self.get_exits(0)
+		start = self._room_indexes[self.current_room.uid]
+		end = self._room_indexes[room.uid]
+		tree = self._routes.get((start, version))
+		if tree is None:
+			# Room index => index of the room it was reached from
+			tree = {start: None}
+			queue = deque([start])
+			while queue:
+				index = queue.popleft()
+				for door, other in self._exits[index]:
+					if other not in tree and (not (door.key or door.puzzle) or is_open(door)):
+						tree[other] = index
+						queue.append(other)
+			if len(self._routes) >= 64:
+				self._routes.clear()
+			self._routes[(start, version)] = tree
+		if end not in tree:
+			return None
+		route = list()
+		while end != start:
+			route.append(end)
+			end = tree[end]
+		route.reverse()
+		return route
+
 	def change_room(self, eid=None, name=None, history=None):
 		try:
 			history = int(history)
@@ -1527,10 +3105,7 @@ class Map:
 			# Ensure history is no more than _room_history size - 1
 			history_max = _room_history_len - 1
 			history = history_max if history > history_max else history
-			# Set the current room to visited
-			self.current_room.visited = True
-			# Slice the room history
-			self._room_history = self._room_history[:-history]
+			self.go_back(history)
 			self.current_room.enter()
 			return True
 		elif not eid and not name:
@@ -1538,16 +3113,1442 @@ class Map:
 		else:
 			room = self.get_room(eid, name)
 		if room:
-			if isinstance(self.current_room, Room):
-				self.current_room.visited = True
-			self._room_history.append(room)
+			self.go_to(self._room_indexes[room.uid])
 			room.enter()
 			return True
 		return False
 
+	# Move to the room at the given index, without entering it
+	def go_to(self, index):
+		_touch(self)
+		if isinstance(self.current_room, Room):
+			_touch(self.current_room)
+			self.current_room.visited = True
+		self._room_history.append(index)
+		_emit(RoomChanged, self, index)
+
+	# Step back through the room history, without entering the room
+	def go_back(self, steps):
+		# Set the current room to visited
+		_touch(self)
+		_touch(self.current_room)
+		self.current_room.visited = True
+		for _ in range(steps):
+			self._room_history.pop()
+		_emit(RoomBack, self, steps)
+
+# Where every item and monster in the world is, by entity id, for admin
+# queries. The index is built on the first query and then kept up to
+# date from the game's events, so a query only looks at its own results.
+# Undo restores objects without events, so it throws the index away.
+# Items are in room inventories, nested in other items or carried by
+# monsters; items carried by players aren't indexed. Objects are keyed
+# by id(), which holds since the index keeps them alive
+class WorldIndex:
+	def __init__(self, game):
+		self.game = game
+		self.is_built = False
+		# Players of a shared world update it from their own threads
+		self._lock = threading.Lock()
+
+	# Only the game is kept when pickled, since ids don't survive it
+	def __getstate__(self):
+		return {"game": self.game}
+
+	def __setstate__(self, state):
+		self.__init__(state["game"])
+
+	def invalidate(self):
+		with self._lock:
+			self.is_built = False
+			self._items = None
+			self._containers = None
+			self._owners = None
+			self._monsters = None
+			self._monster_rooms = None
+
+	def build(self):
+		with self._lock:
+			# Entity id number => {id(item): item}
+			self._items = dict()
+			# id(item) => the inventory holding it
+			self._containers = dict()
+			# id(inventory) => the room, item or monster it belongs to
+			self._owners = dict()
+			# Entity id number => {id(monster): monster}
+			self._monsters = dict()
+			# id(monster) => the room it's in
+			self._monster_rooms = dict()
+			# Names => entity id numbers, built on the first query by name
+			self._item_names = None
+			self._monster_names = None
+			# Numbers of items and monsters
+			self._counts = [0, 0]
+			for room in self.game.map.get_rooms():
+				self._owners[id(room.inventory)] = room
+				self._add_items(room.inventory)
+				for monster in room.get_monsters():
+					self._add_monster(room, monster)
+			self.is_built = True
+
+	# Index a room added to the map
+	def add_room(self, room):
+		with self._lock:
+			if self.is_built:
+				self._owners[id(room.inventory)] = room
+				self._add_items(room.inventory)
+				for monster in room.get_monsters():
+					self._add_monster(room, monster)
+
+	# Apply a change to the world, given as an event with objects
+	def update(self, event_type, fields):
+		if event_type is InventoryAdd:
+			inventory, item = fields
+			with self._lock:
+				if id(inventory) in self._owners:
+					self._add_item(inventory, item)
+		elif event_type is InventoryPop:
+			inventory, item = fields
+			with self._lock:
+				if self._containers.get(id(item)) is inventory:
+					self._remove_item(item)
+		elif event_type is MonsterAdded:
+			room, monster = fields
+			with self._lock:
+				if id(room.inventory) in self._owners:
+					self._add_monster(room, monster)
+		elif event_type is MonsterRemoved:
+			room, monster = fields
+			with self._lock:
+				if self._monster_rooms.get(id(monster)) is room:
+					self._remove_monster(monster)
+
+	def _add_items(self, inventory):
+		for item in inventory.get_items():
+			self._add_item(inventory, item)
+
+	def _add_item(self, inventory, item):
+		items = self._items.get(item.iid)
+		if items is None:
+			items = self._items[item.iid] = dict()
+			if self._item_names is not None:
+				self._item_names.add(item.name, item.iid)
+		if id(item) not in items:
+			self._counts[0] += 1
+		items[id(item)] = item
+		self._containers[id(item)] = inventory
+		self._owners[id(item.inventory)] = item
+		self._add_items(item.inventory)
+
+	def _remove_item(self, item):
+		items = self._items.get(item.iid)
+		if items and items.pop(id(item), None) is not None:
+			self._counts[0] -= 1
+		self._containers.pop(id(item), None)
+		self._owners.pop(id(item.inventory), None)
+		for subitem in item.inventory.get_items():
+			self._remove_item(subitem)
+
+	def _add_monster(self, room, monster):
+		monsters = self._monsters.get(monster.iid)
+		if monsters is None:
+			monsters = self._monsters[monster.iid] = dict()
+			if self._monster_names is not None:
+				self._monster_names.add(monster.name, monster.iid)
+		if id(monster) not in monsters:
+			self._counts[1] += 1
+		monsters[id(monster)] = monster
+		self._monster_rooms[id(monster)] = room
+		self._owners[id(monster.inventory)] = monster
+		self._add_items(monster.inventory)
+
+	def _remove_monster(self, monster):
+		monsters = self._monsters.get(monster.iid)
+		if monsters and monsters.pop(id(monster), None) is not None:
+			self._counts[1] -= 1
+		self._monster_rooms.pop(id(monster), None)
+		self._owners.pop(id(monster.inventory), None)
+		for item in monster.inventory.get_items():
+			self._remove_item(item)
+
+	# Return the entity id numbers a query is for: the one it's the id
+	# of, or those whose names match it best first, or all of them
+	def _get_numbers(self, monsters, query):
+		groups = self._monsters if monsters else self._items
+		if not query:
+			return groups
+		number = _eid_numbers.get(query)
+		if number in groups:
+			return [number]
+		names = self._monster_names if monsters else self._item_names
+		if names is None:
+			names = NameIndex()
+			for number, group in groups.items():
+				if group:
+					names.add(next(iter(group.values())).name, number)
+			if monsters:
+				self._monster_names = names
+			else:
+				self._item_names = names
+		return names.resolve(query)
+
+	# Return the number of matches and the matches from start to stop
+	def _find(self, monsters, query, start, stop):
+		if not self.is_built:
+			self.build()
+		with self._lock:
+			groups = self._monsters if monsters else self._items
+			count = 0
+			found = list()
+			for number in self._get_numbers(monsters, query):
+				group = groups.get(number)
+				if not group:
+					continue
+				# Only copy the groups the page covers
+				if count + len(group) > start and count < stop:
+					found.extend(itertools.islice(group.values(), max(start - count, 0), stop - count))
+				count += len(group)
+				# Everything matches, so the count is already known
+				if not query and count >= stop:
+					return self._counts[monsters], found
+			return count, found
+
+	# Return the number of items matching the query and those from start
+	# to stop, in groups by entity id
+	def find_items(self, query=None, start=0, stop=sys.maxsize):
+		return self._find(False, query, start, stop)
+
+	def find_monsters(self, query=None, start=0, stop=sys.maxsize):
+		return self._find(True, query, start, stop)
+
+	# Return the items and monsters with the given entity id
+	def get_entities(self, eid):
+		if not self.is_built:
+			self.build()
+		number = _eid_numbers.get(eid)
+		with self._lock:
+			return list(self._items.get(number, dict()).values()) + list(self._monsters.get(number, dict()).values())
+
+	# Return the room, item or monster an item is directly in
+	def get_owner(self, item):
+		with self._lock:
+			return self._owners.get(id(self._containers.get(id(item))))
+
+	# Names changed, so the indexes by name are built again when needed
+	def rename(self):
+		with self._lock:
+			self._item_names = None
+			self._monster_names = None
+
+	# Return the room an item or monster is in and the names of the
+	# containers and monsters holding it, outermost first
+	def get_location(self, obj):
+		path = list()
+		with self._lock:
+			while True:
+				room = self._monster_rooms.get(id(obj))
+				if room:
+					return room, path
+				inventory = self._containers.get(id(obj))
+				owner = self._owners.get(id(inventory)) if inventory else None
+				if owner is None:
+					return None, path
+				if isinstance(owner, Room):
+					return owner, path
+				path.insert(0, owner.name)
+				obj = owner
+
+# The objects of a game's world by the ref they're logged with. Refs
+# count up and are never reused. The table is touched like entities, so
+# undo also brings back the refs of the objects it brings back
+class RefTable:
+	def __init__(self):
+		self._objects = dict()
+		self._next_ref = 0
+
+	def __len__(self):
+		return len(self._objects)
+
+	def __iter__(self):
+		return iter(list(self._objects.values()))
+
+	def get(self, ref):
+		return self._objects.get(ref)
+
+	# Return the new ref of the object
+	def add(self, obj):
+		_touch(self)
+		ref = self._next_ref
+		self._next_ref += 1
+		self._objects[ref] = obj
+		return ref
+
+	def discard(self, ref):
+		_touch(self)
+		self._objects.pop(ref, None)
+
+# Copy-on-write undo history. Taking a snapshot only opens a new
+# generation; an object's state is copied the first time it is touched
+# in that generation, so everything left untouched stays shared.
+# Generations are only kept once something is recorded in them, so
+# commands that change nothing don't push real changes out of the window.
+class History:
+	def __init__(self, depth=100):
+		self._generations = deque(maxlen=depth)
+		self._snapshot_id = 0
+		# The snapshot opened last, until something is recorded in it
+		self._pending = None
+		# Snapshots up to this one can no longer be rolled back to
+		self._floor = 0
+		# Soft records of the pending snapshot, kept only if it's recorded in
+		self._soft = dict()
+
+	# Shallow copy an object's attributes, copying containers so that
+	# later in-place changes don't leak into the saved state
+	def _capture(self, obj):
+		state = obj.__dict__.copy()
+		for key, value in state.items():
+			if isinstance(value, (list, dict, set, deque)):
+				state[key] = copy.copy(value)
+		return state
+
+	def _restore(self, records):
+		for obj, state in records.values():
+			obj.__dict__.clear()
+			obj.__dict__.update(state)
+
+	# Open a new generation and return its id
+	def snapshot(self):
+		self._snapshot_id += 1
+		self._pending = self._snapshot_id
+		self._soft.clear()
+		return self._snapshot_id
+
+	# Save an object's state if it hasn't been saved in this generation.
+	# A soft record doesn't open the generation by itself, but is kept if
+	# something else does
+	def record(self, obj, soft=False):
+		if self._pending is not None:
+			if soft:
+				if id(obj) not in self._soft:
+					self._soft[id(obj)] = (obj, self._capture(obj))
+				return
+			if len(self._generations) == self._generations.maxlen:
+				# The oldest generation falls out of the window
+				self._floor = self._generations[0][0] if self._generations else self._pending
+			self._generations.append((self._pending, self._soft))
+			self._soft = dict()
+			self._pending = None
+		if self._generations:
+			records = self._generations[-1][1]
+			if id(obj) not in records:
+				records[id(obj)] = (obj, self._capture(obj))
+
+	# Revert every change made since the given snapshot was taken
+	def rollback(self, snapshot_id):
+		if snapshot_id <= self._floor or snapshot_id > self._snapshot_id:
+			return False
+		while self._generations and self._generations[-1][0] >= snapshot_id:
+			self._restore(self._generations.pop()[1])
+		self._pending = None
+		return True
+
+	# Revert the last generation that changed anything, returning the id
+	# of its snapshot
+	def undo(self):
+		self._pending = None
+		if self._generations:
+			snapshot_id, records = self._generations.pop()
+			self._restore(records)
+			return snapshot_id
+		return None
+
+	def clear(self):
+		self._generations.clear()
+		self._pending = None
+		self._floor = self._snapshot_id
+
+	def is_empty(self):
+		return not self._generations
+
+# Hierarchical timing wheel of timers due after a number of ticks. Each
+# level has 64 slots, each spanning 64 times the ticks of the level
+# below, and timers past the top level wait in an overflow slot. Timers
+# move down a level when their slot comes up, so scheduling and firing
+# are O(1) amortized and a tick only looks at the one slot that's due.
+# Slots are chains of immutable (due, timer, next) nodes, newest first,
+# so undo saves the whole wheel by copying the list of their heads. The
+# clock moving on isn't a change of its own, so the wheel only joins
+# undo generations that something else opened
+class TimingWheel:
+	_bits = 6
+
+	def __init__(self, levels=4):
+		self.tick = 0
+		self._level_count = levels
+		# The slots of every level in a row, then the overflow slot
+		self._slots = [None] * ((levels << self._bits) + 1)
+		self._size = 0
+		# Players of a shared world tick it from their own threads
+		self._lock = threading.Lock()
+
+	# Chains are saved as lists, since pickling long chains of nested
+	# nodes would recurse too deep
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["_lock"]
+		state["_slots"] = [self._get_timers(node) for node in self._slots]
+		return state
+
+	def __setstate__(self, state):
+		slots = state.pop("_slots")
+		self.__dict__.update(state)
+		self._slots = [None] * len(slots)
+		for index, timers in enumerate(slots):
+			for due, timer in timers:
+				self._slots[index] = (due, timer, self._slots[index])
+		self._lock = threading.Lock()
+
+	def __len__(self):
+		return self._size
+
+	# Return the (due, timer) pairs of a chain, oldest first
+	@staticmethod
+	def _get_timers(node):
+		timers = list()
+		while node:
+			timers.append(node[:2])
+			node = node[2]
+		timers.reverse()
+		return timers
+
+	# Fire the timer after `delay` ticks, at least one
+	def schedule(self, delay, timer):
+		with self._lock:
+			_touch(self, soft=True)
+			self._size += 1
+			self._place(self.tick + max(int(delay), 1), timer)
+
+	# Put a timer in the lowest level whose current slots reach its tick,
+	# which is the one holding the highest bit where it differs from now
+	def _place(self, due, timer):
+		bits = self._bits
+		level = max((due ^ self.tick).bit_length() - 1, 0) // bits
+		if level < self._level_count:
+			index = (level << bits) + ((due >> (bits * level)) & ((1 << bits) - 1))
+		else:
+			index = len(self._slots) - 1
+		self._slots[index] = (due, timer, self._slots[index])
+
+	def _cascade(self, index):
+		node = self._slots[index]
+		if node:
+			self._slots[index] = None
+			for due, timer in self._get_timers(node):
+				self._place(due, timer)
+
+	# Move on one tick and return the timers that are due
+	def advance(self):
+		with self._lock:
+			_touch(self, soft=True)
+			self.tick += 1
+			tick = self.tick
+			bits = self._bits
+			mask = (1 << bits) - 1
+			if tick & ((1 << (bits * self._level_count)) - 1) == 0:
+				self._cascade(len(self._slots) - 1)
+			# Higher levels first, since they cascade into the lower ones
+			for level in range(self._level_count - 1, 0, -1):
+				if tick & ((1 << (bits * level)) - 1) == 0:
+					self._cascade((level << bits) + ((tick >> (bits * level)) & mask))
+			node = self._slots[tick & mask]
+			if not node:
+				return list()
+			self._slots[tick & mask] = None
+			timers = [timer for due, timer in self._get_timers(node)]
+			self._size -= len(timers)
+			return timers
+
+def _write_varint(buffer, value):
+	# Zigzag encode so that small negative numbers stay small
+	value = value * 2 if value >= 0 else -value * 2 - 1
+	while value > 0x7f:
+		buffer.append(value & 0x7f | 0x80)
+		value >>= 7
+	buffer.append(value)
+
+def _read_varint(f):
+	value = 0
+	shift = 0
+	while True:
+		byte = f.read(1)
+		if not byte:
+			raise EOFError()
+		value |= (byte[0] & 0x7f) << shift
+		if byte[0] < 0x80:
+			break
+		shift += 7
+	return value >> 1 if value % 2 == 0 else -(value >> 1) - 1
+
+# Append-only log of events. Each event is a type code followed by its
+# fields as varints or length-prefixed strings. Events are buffered and
+# streamed to the file, so memory stays bounded however long the game runs
+class EventLog:
+	_header = b"TLOG\x01"
+
+	def __init__(self, filepath, buffer_size=1 << 16):
+		self.filepath = filepath
+		self._file = open(filepath, "wb")
+		self._file.write(self._header)
+		self._buffer = bytearray()
+		self._buffer_size = buffer_size
+		self._count = 0
+
+	def append(self, event):
+		buffer = self._buffer
+		code = _event_codes[type(event)]
+		buffer.append(code)
+		for kind, value in zip(_event_types[code][1], event):
+			if kind == "i":
+				_write_varint(buffer, int(value))
+			else:
+				data = value.encode("utf-8")
+				_write_varint(buffer, len(data))
+				buffer.extend(data)
+		self._count += 1
+		if len(buffer) >= self._buffer_size:
+			self.flush()
+
+	def size(self):
+		return self._count
+
+	def flush(self):
+		self._file.write(self._buffer)
+		self._file.flush()
+		self._buffer.clear()
+
+	def close(self):
+		self.flush()
+		self._file.close()
+
+	# Yield the events in a log file one at a time
+	@classmethod
+	def read(cls, filepath):
+		with open(filepath, "rb") as f:
+			if f.read(len(cls._header)) != cls._header:
+				raise ValueError("Not an event log '%s'" % filepath)
+			while True:
+				code = f.read(1)
+				if not code:
+					return
+				event_type, event_format = _event_types[code[0]]
+				values = list()
+				try:
+					for kind in event_format:
+						value = _read_varint(f)
+						if kind == "s":
+							value = f.read(value).decode("utf-8")
+						values.append(value)
+				except EOFError:
+					# The last event was cut short by a crash
+					return
+				yield event_type(*values)
+
+# Read-only catalog of entity definitions compiled into one file, which
+# is memory mapped so that processes loading the same catalog share it
+# through the page cache. All integers are little endian:
+#
+#   header   "TCAT", version, 3 bytes padding, then as uint32s the number
+#            of entities, index slots, strings, map ids and sources, and
+#            the offsets of the string table, string data, index, map ids
+#            and sources
+#   records  per entity, its field count and (key string, value offset)
+#            pairs. Values are a tag followed by an int64, a float64, a
+#            string index or a count of list items or dict pairs
+#   strings  the start offset of every string in the string data, and
+#            one more for the end of the last
+#   index    open addressed (id string index + 1, record offset) slots,
+#            hashed by the CRC32 of the id
+#   map ids, sources  string indexes
+class Catalog:
+	_magic = b"TCAT"
+	_version = 1
+	_header = struct.Struct("<4sB3x10I")
+	_none, _false, _true, _int, _float, _string, _list, _dict = range(8)
+
+	def __init__(self, filepath):
+		self.filepath = filepath
+		with open(filepath, "rb") as f:
+			self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		(magic, version, self._count, self._slots, string_count, map_count, source_count,
+			self._strings, self._string_data, self._index, self._map_ids, self._sources
+		) = self._header.unpack_from(self._data)
+		if magic != self._magic or version != self._version:
+			raise ValueError("Not a catalog '%s'" % filepath)
+		self._map_count = map_count
+		self._source_count = source_count
+
+	# Keep the file name rather than the mapping when pickled
+	def __getstate__(self):
+		return {"filepath": self.filepath}
+
+	def __setstate__(self, state):
+		self.__init__(state["filepath"])
+
+	# Return whether the catalog was compiled from these source files
+	# since they last changed
+	@classmethod
+	def is_current(cls, filepath, sources):
+		try:
+			catalog = cls(filepath)
+			modified = os.path.getmtime(filepath)
+			return catalog.get_sources() == list(sources) and all(
+				os.path.getmtime(source) <= modified for source in sources
+			)
+		except (OSError, ValueError, struct.error):
+			return False
+
+	@classmethod
+	def compile(cls, filepath, definitions, map_ids, sources):
+		strings = dict()
+		def intern(value):
+			index = strings.get(value)
+			if index is None:
+				index = strings[value] = len(strings)
+			return index
+		data = bytearray(cls._header.size)
+		def write_value(value):
+			offset = len(data)
+			if value is None:
+				data.append(cls._none)
+			elif value is True or value is False:
+				data.append(cls._true if value else cls._false)
+			elif isinstance(value, int):
+				data.append(cls._int)
+				data.extend(struct.pack("<q", value))
+			elif isinstance(value, float):
+				data.append(cls._float)
+				data.extend(struct.pack("<d", value))
+			elif isinstance(value, str):
+				data.append(cls._string)
+				data.extend(struct.pack("<I", intern(value)))
+			elif isinstance(value, Mapping):
+				data.append(cls._dict)
+				data.extend(struct.pack("<I", len(value)))
+				for key, item in value.items():
+					data.extend(struct.pack("<I", intern(str(key))))
+					write_value(item)
+			else:
+				data.append(cls._list)
+				data.extend(struct.pack("<I", len(value)))
+				for item in value:
+					write_value(item)
+			return offset
+		records = list()
+		for entity_dict in definitions:
+			offset = len(data)
+			fields = list(entity_dict.items())
+			data.extend(struct.pack("<I", len(fields)))
+			# Leave room for the field table, then fill it in
+			table = len(data)
+			data.extend(bytes(8 * len(fields)))
+			for i, (key, value) in enumerate(fields):
+				struct.pack_into("<II", data, table + 8 * i, intern(str(key)), write_value(value))
+			records.append((intern(entity_dict["id"]), offset))
+		map_ids = [intern(eid) for eid in map_ids]
+		sources = [intern(source) for source in sources]
+
+		# Strings
+		string_data = [value.encode("utf-8") for value in strings]
+		strings_offset = len(data)
+		position = 0
+		for value in string_data:
+			data.extend(struct.pack("<I", position))
+			position += len(value)
+		data.extend(struct.pack("<I", position))
+		string_data_offset = len(data)
+		for value in string_data:
+			data.extend(value)
+
+		# Index, at most half full
+		slots = 1
+		while slots < 2 * len(records):
+			slots *= 2
+		index = [(0, 0)] * slots
+		for string, offset in records:
+			slot = zlib.crc32(string_data[string]) & (slots - 1)
+			while index[slot][0]:
+				slot = (slot + 1) & (slots - 1)
+			index[slot] = (string + 1, offset)
+		index_offset = len(data)
+		for entry in index:
+			data.extend(struct.pack("<II", *entry))
+		map_ids_offset = len(data)
+		data.extend(struct.pack("<%iI" % len(map_ids), *map_ids))
+		sources_offset = len(data)
+		data.extend(struct.pack("<%iI" % len(sources), *sources))
+		cls._header.pack_into(data, 0, cls._magic, cls._version, len(records), slots, len(strings),
+			len(map_ids), len(sources), strings_offset, string_data_offset, index_offset,
+			map_ids_offset, sources_offset)
+		# Write a new file rather than changing one another process has mapped
+		temporary_filepath = filepath + ".tmp"
+		with open(temporary_filepath, "wb") as f:
+			f.write(data)
+		os.replace(temporary_filepath, filepath)
+
+	def _get_string_bytes(self, index):
+		start, end = struct.unpack_from("<II", self._data, self._strings + 4 * index)
+		return self._data[self._string_data + start:self._string_data + end]
+
+	def _get_string(self, index):
+		return self._get_string_bytes(index).decode("utf-8")
+
+	# Return (value, offset after the value)
+	def _read_value(self, offset):
+		data = self._data
+		tag = data[offset]
+		offset += 1
+		if tag == self._none:
+			return None, offset
+		elif tag == self._false or tag == self._true:
+			return tag == self._true, offset
+		elif tag == self._int:
+			return struct.unpack_from("<q", data, offset)[0], offset + 8
+		elif tag == self._float:
+			return struct.unpack_from("<d", data, offset)[0], offset + 8
+		elif tag == self._string:
+			return self._get_string(struct.unpack_from("<I", data, offset)[0]), offset + 4
+		count = struct.unpack_from("<I", data, offset)[0]
+		offset += 4
+		if tag == self._list:
+			value = list()
+			for _ in range(count):
+				item, offset = self._read_value(offset)
+				value.append(item)
+			return value, offset
+		value = dict()
+		for _ in range(count):
+			key = self._get_string(struct.unpack_from("<I", data, offset)[0])
+			value[key], offset = self._read_value(offset + 4)
+		return value, offset
+
+	# Return the definition with the given id, whose fields are decoded
+	# when they're read
+	def get(self, eid):
+		if not isinstance(eid, str):
+			return None
+		key = eid.encode("utf-8")
+		mask = self._slots - 1
+		slot = zlib.crc32(key) & mask
+		while True:
+			string, offset = struct.unpack_from("<II", self._data, self._index + 8 * slot)
+			if not string:
+				return None
+			elif self._get_string_bytes(string - 1) == key:
+				return CatalogEntry(self, offset)
+			slot = (slot + 1) & mask
+
+	def get_ids(self):
+		ids = list()
+		for slot in range(self._slots):
+			string, offset = struct.unpack_from("<II", self._data, self._index + 8 * slot)
+			if string:
+				ids.append((offset, self._get_string(string - 1)))
+		# In the order they were compiled
+		return [eid for offset, eid in sorted(ids)]
+
+	def _get_string_list(self, offset, count):
+		return [self._get_string(index) for index in struct.unpack_from("<%iI" % count, self._data, offset)]
+
+	def get_map_ids(self):
+		return self._get_string_list(self._map_ids, self._map_count)
+
+	def get_sources(self):
+		return self._get_string_list(self._sources, self._source_count)
+
+	def size(self):
+		return self._count
+
+# A definition in a catalog
+class CatalogEntry(Mapping):
+	def __init__(self, catalog, offset):
+		self._catalog = catalog
+		self._offset = offset
+		self._fields = None
+
+	# Field name => value offset, read on first use
+	def _get_fields(self):
+		if self._fields is None:
+			catalog = self._catalog
+			count = struct.unpack_from("<I", catalog._data, self._offset)[0]
+			table = struct.unpack_from("<%iI" % (2 * count), catalog._data, self._offset + 4)
+			self._fields = {catalog._get_string(table[i]): table[i + 1] for i in range(0, len(table), 2)}
+		return self._fields
+
+	def __getitem__(self, key):
+		return self._catalog._read_value(self._get_fields()[key])[0]
+
+	def __iter__(self):
+		return iter(self._get_fields())
+
+	def __len__(self):
+		return len(self._get_fields())
+
+# Versioned, compressed save files. Only what can change during a game is
+# stored: each entity is written as its id plus its mutable state, and is
+# rebuilt from its definition when loaded. Values are tagged, and every
+# string after its first use is written as an index into a string table
+class SaveFile:
+	_header = b"TSAV"
+	_version = 1
+	_compressions = {
+		"none": (0, bytes, bytes),
+		"zlib": (1, zlib.compress, zlib.decompress),
+		"lzma": (2, lzma.compress, lzma.decompress)
+	}
+	# Value tags
+	_none, _false, _true, _int, _float, _string, _string_ref, _list = range(8)
+
+	@classmethod
+	def is_save(cls, f):
+		position = f.tell()
+		is_save = f.read(len(cls._header)) == cls._header
+		f.seek(position)
+		return is_save
+
+	@classmethod
+	def dump(cls, game, f, compression="zlib"):
+		code, compress, decompress = cls._compressions[compression]
+		buffer = bytearray()
+		cls._write(buffer, cls._get_game_state(game), dict())
+		f.write(cls._header + bytes([cls._version, code]))
+		f.write(compress(bytes(buffer)))
+
+	# Return a new game built from the content in the config file with the
+	# saved state applied to it
+	@classmethod
+	def load(cls, f, settings_filepath="config.json"):
+		header = f.read(len(cls._header) + 2)
+		if header[:len(cls._header)] != cls._header:
+			raise ValueError("Not a save file")
+		if header[-2] != cls._version:
+			raise ValueError("Unsupported save version %i" % header[-2])
+		for code, compress, decompress in cls._compressions.values():
+			if code == header[-1]:
+				break
+		else:
+			raise ValueError("Unsupported save compression %i" % header[-1])
+		state = cls._read(io.BytesIO(decompress(f.read())), list())
+		# Rebuilding the world isn't a change to the running game
+		token = _active_game.set(None)
+		try:
+			game = Game(settings_filepath)
+			cls._set_game_state(game, state)
+		finally:
+			_active_game.reset(token)
+		return game
+
+	@classmethod
+	def _write(cls, buffer, value, strings):
+		if value is None:
+			buffer.append(cls._none)
+		elif value is True or value is False:
+			buffer.append(cls._true if value else cls._false)
+		elif isinstance(value, int):
+			buffer.append(cls._int)
+			_write_varint(buffer, value)
+		elif isinstance(value, float):
+			buffer.append(cls._float)
+			buffer.extend(struct.pack("<d", value))
+		elif isinstance(value, str):
+			index = strings.get(value)
+			if index is None:
+				strings[value] = len(strings)
+				data = value.encode("utf-8")
+				buffer.append(cls._string)
+				_write_varint(buffer, len(data))
+				buffer.extend(data)
+			else:
+				buffer.append(cls._string_ref)
+				_write_varint(buffer, index)
+		else:
+			buffer.append(cls._list)
+			_write_varint(buffer, len(value))
+			for item in value:
+				cls._write(buffer, item, strings)
+
+	@classmethod
+	def _read(cls, f, strings):
+		tag = f.read(1)[0]
+		if tag == cls._none:
+			return None
+		elif tag == cls._false or tag == cls._true:
+			return tag == cls._true
+		elif tag == cls._int:
+			return _read_varint(f)
+		elif tag == cls._float:
+			return struct.unpack("<d", f.read(8))[0]
+		elif tag == cls._string:
+			value = f.read(_read_varint(f)).decode("utf-8")
+			strings.append(value)
+			return value
+		elif tag == cls._string_ref:
+			return strings[_read_varint(f)]
+		return [cls._read(f, strings) for _ in range(_read_varint(f))]
+
+	@classmethod
+	def _get_game_state(cls, game):
+		rooms = list()
+		for room in game.map.get_rooms():
+			monsters = room.get_monsters()
+			rooms.append([
+				bool(getattr(room, "visited", False)),
+				cls._get_inventory_state(room.inventory),
+				[cls._get_entity_state(monster) for monster in monsters],
+				monsters.index(room.monster) if room.monster in monsters else -1,
+				[cls._get_entity_state(door.puzzle) if door.puzzle else None for door in room.get_doors()]
+			])
+		history = game.map._room_history
+		return [
+			game._name,
+			game.is_won(),
+			cls._get_entity_state(game.player),
+			rooms,
+			[history.maxlen or 0, list(history)]
+		]
+
+	@classmethod
+	def _set_game_state(cls, game, state):
+		name, is_won, player, rooms, (maxlen, history) = state
+		game._name = name
+		game._is_won = is_won
+		cls._set_entity_state(game, game.player, player)
+		for room, (visited, items, monsters, monster, puzzles) in zip(game.map.get_rooms(), rooms):
+			if visited:
+				room.visited = True
+			room.inventory = cls._create_inventory(game, items)
+			room._monsters = [cls._create_entity(game, monster_state) for monster_state in monsters]
+			room.monster = room._monsters[monster] if monster >= 0 else None
+			for door, puzzle in zip(room.get_doors(), puzzles):
+				if door.puzzle and puzzle:
+					cls._set_entity_state(game, door.puzzle, puzzle)
+		game.map._room_history = deque(history, maxlen=maxlen or None)
+		# Timers aren't saved, so they start over for the rebuilt world
+		game.scheduler = TimingWheel()
+		game.schedule_world()
+		# Give the rebuilt objects refs for event logging
+		for obj in game._objects:
+			del obj._ref
+		game._objects = RefTable()
+		game._register(game.map)
+		game._register(game.player)
+
+	@classmethod
+	def _get_inventory_state(cls, inventory):
+		return [cls._get_entity_state(item) for item in inventory.get_items()]
+
+	@classmethod
+	def _create_inventory(cls, game, state):
+		return Inventory([cls._create_entity(game, item) for item in state])
+
+	# [definition, inventory, ...], where the definition is the entity id
+	# or the JSON of a custom definition, and the rest depends on the class
+	@classmethod
+	def _get_entity_state(cls, entity):
+		overrides = getattr(entity, "_overrides", None)
+		state = [
+			json.dumps(overrides) if overrides else entity.eid,
+			cls._get_inventory_state(entity.inventory)
+		]
+		if isinstance(entity, Character):
+			items = entity.inventory.get_items()
+			state.extend([
+				entity.name,
+				entity.health,
+				entity._base_attack,
+				entity._base_resistance,
+				# Equipped items are usually in the inventory
+				[items.index(item) if item in items else cls._get_entity_state(item) for item in entity.equipped]
+			])
+		elif isinstance(entity, Chest):
+			state.append(entity.is_locked())
+		elif isinstance(entity, Puzzle):
+			state.extend([entity.is_solved(), entity._hint_index, entity._attempts])
+		return state
+
+	@classmethod
+	def _create_entity(cls, game, state):
+		definition = state[0]
+		if definition.startswith("{"):
+			definition = json.loads(definition)
+		entity = game.entity_factory._create_entity(definition)
+		cls._set_entity_state(game, entity, state)
+		return entity
+
+	@classmethod
+	def _set_entity_state(cls, game, entity, state):
+		entity.inventory = cls._create_inventory(game, state[1])
+		if isinstance(entity, Character):
+			name, health, attack, resistance, equipped = state[2:]
+			entity._name = name
+			entity._health = health
+			entity._base_attack = attack
+			entity._base_resistance = resistance
+			entity.equipped = list()
+			entity.slots = dict()
+			items = entity.inventory.get_items()
+			for item in equipped:
+				item = items[item] if isinstance(item, int) else cls._create_entity(game, item)
+				item.equip(entity)
+			entity.invalidate_combat_stats()
+		elif isinstance(entity, Chest):
+			entity._is_locked = state[2]
+		elif isinstance(entity, Puzzle):
+			entity._is_solved, entity._hint_index, entity._attempts = state[2:]
+
+# Profiles the commands a game runs, either for the next `commands`
+# commands or for the next `seconds` seconds. The deterministic mode uses
+# cProfile; the sampling mode records the command thread's stack every
+# `interval` seconds from a background thread, which costs far less
+class Profiler:
+	def __init__(self, commands=None, seconds=None, sampling=False, interval=0.005):
+		self._commands = commands
+		self._deadline = time.time() + seconds if seconds else None
+		self._sampling = sampling
+		self._interval = interval
+		self._is_running = True
+		self._in_command = False
+		self._command_count = 0
+		self._thread_id = threading.get_ident()
+		if sampling:
+			# Collapsed stack => sample count
+			self._stacks = dict()
+			self._sampler = threading.Thread(target=self._sample, daemon=True)
+			self._sampler.start()
+		else:
+			self._profile = cProfile.Profile()
+
+	def is_running(self):
+		return self._is_running
+
+	def is_sampling(self):
+		return self._sampling
+
+	def _sample(self):
+		while self._is_running:
+			time.sleep(self._interval)
+			if self._deadline and time.time() >= self._deadline:
+				self._is_running = False
+			elif self._in_command:
+				frame = sys._current_frames().get(self._thread_id)
+				names = list()
+				while frame:
+					code = frame.f_code
+					names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+					frame = frame.f_back
+				stack = ";".join(reversed(names))
+				self._stacks[stack] = self._stacks.get(stack, 0) + 1
+
+	# Called around each command
+	def begin(self):
+		self._in_command = True
+		if not self._sampling:
+			self._profile.enable()
+
+	def end(self):
+		if not self._sampling:
+			self._profile.disable()
+		self._in_command = False
+		self._command_count += 1
+		if self._commands and self._command_count >= self._commands:
+			self.stop()
+		elif self._deadline and time.time() >= self._deadline:
+			self.stop()
+
+	def stop(self):
+		self._is_running = False
+
+	# No command has been profiled, so there are no stats to report
+	def is_empty(self):
+		return self._command_count == 0
+
+	def status(self):
+		return "%s profiler %s after %i commands" % (
+			"Sampling" if self._sampling else "Deterministic",
+			"running" if self._is_running else "stopped",
+			self._command_count
+		)
+
+	# Return (function, self time or samples, total time or samples)
+	# for the hottest functions
+	def get_top(self, count=10):
+		if self._sampling:
+			own = dict()
+			total = dict()
+			for stack, samples in self._stacks.items():
+				names = stack.split(";")
+				own[names[-1]] = own.get(names[-1], 0) + samples
+				for name in set(names):
+					total[name] = total.get(name, 0) + samples
+			top = sorted(own, key=own.get, reverse=True)[:count]
+			return [(name, own[name], total[name]) for name in top]
+		stats = pstats.Stats(self._profile).stats
+		top = sorted(stats, key=lambda function: stats[function][2], reverse=True)[:count]
+		return [
+			("%s:%i:%s" % (os.path.basename(function[0]), function[1], function[2]), stats[function][2], stats[function][3])
+			for function in top
+		]
+
+	def report(self, count=10):
+		if self.is_empty():
+			return self.status() + "\nNothing profiled"
+		unit = "samples" if self._sampling else "seconds"
+		lines = [self.status(), "self %s\ttotal %s\tfunction" % (unit, unit)]
+		for name, own, total in self.get_top(count):
+			if self._sampling:
+				lines.append("%i\t%i\t%s" % (own, total, name))
+			else:
+				lines.append("%.4f\t%.4f\t%s" % (own, total, name))
+		return "\n".join(lines)
+
+	# Write pstats (deterministic) or collapsed stacks (sampling)
+	def dump(self, filepath):
+		if self._sampling:
+			with open(filepath, "w") as f:
+				for stack, samples in sorted(self._stacks.items()):
+					f.write("%s %i\n" % (stack, samples))
+		else:
+			self._profile.dump_stats(filepath)
+
+# Parse and check the definitions in a file. Runs in the loading pool, so
+# it reports problems rather than logging them
+def _load_definitions(filepath):
+	definitions = list()
+	problems = list()
+	try:
+		with open(filepath) as f:
+			for entity_dict in _read_json_objects(f):
+				entity_problems = EntityFactory.check_definition(entity_dict)
+				if entity_problems:
+					problems.extend(entity_problems)
+				else:
+					definitions.append(entity_dict)
+	except Exception as e:
+		return filepath, None, problems + [str(e)]
+	return filepath, definitions, problems
+
+# Return the lines telling a player what a reload took from their game
+def _describe_reload(game, was_recording, could_undo):
+	lines = list()
+	if was_recording and game.event_log is None:
+		lines.append("The event log stopped, since a reload can't be replayed")
+	if could_undo and game.history.is_empty():
+		lines.append("The world changed, so earlier commands can no longer be undone")
+	return lines
+
+# Watches the content files a game was loaded from, so that changes to
+# them can be patched into running games instead of restarting. Only
+# the files whose size or modification time changed are read again, and
+# only the definitions in them that differ from the loaded ones are
+# applied, to the entities built from them. Rooms and doors are found
+# through the map, and items and monsters through the world index, so
+# the work follows the size of the change rather than of the world.
+# Definitions in a changed file win over those of the same id in other
+# files, and definitions removed from a file stay loaded, since timers
+# may still respawn them
+class ContentWatcher:
+	def __init__(self, entity_factory, filepaths, map_filepath):
+		self.entity_factory = entity_factory
+		self._map_filepath = map_filepath
+		# Filepath => (modification time, size) when last read
+		self._stats = {filepath: self._stat(filepath) for filepath in filepaths + [map_filepath]}
+		# Players of a shared world can reload from their own threads
+		self._lock = threading.Lock()
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _stat(filepath):
+		try:
+			stat = os.stat(filepath)
+			return stat.st_mtime_ns, stat.st_size
+		except OSError:
+			return None
+
+	# Return the content files changed since they were last read, and new
+	# entity files, in the order the game loads them
+	def poll(self):
+		filepaths = list(self._stats)
+		for node in os.walk("entities"):
+			directory = node[0]
+			for filepath in node[2]:
+				filepath = os.path.join(directory, filepath)
+				if filepath not in self._stats:
+					filepaths.append(filepath)
+		changed = list()
+		for filepath in filepaths:
+			stat = self._stat(filepath)
+			if stat != self._stats.get(filepath):
+				self._stats[filepath] = stat
+				if stat is not None:
+					changed.append(filepath)
+		changed.sort(key=lambda filepath: (filepath == self._map_filepath, filepath))
+		return changed
+
+	# Read the changed files into the entity factory. Returns the ids of
+	# the definitions that changed and those of the map's rooms among them
+	def load(self):
+		with self._lock:
+			definitions = dict()
+			room_ids = list()
+			for filepath in self.poll():
+				filepath, file_definitions, problems = _load_definitions(filepath)
+				for problem in problems:
+					_log("Invalid definition in '%s': %s" % (filepath, problem))
+				for entity_dict in file_definitions or ():
+					eid = entity_dict["id"]
+					if entity_dict != self.entity_factory.get_definition(eid):
+						_log("Reloaded entity definition '%s' from '%s'" % (eid, filepath), level=2)
+						self.entity_factory.add_definition(entity_dict)
+						definitions[eid] = entity_dict
+						if filepath == self._map_filepath and eid[:3] == "rom":
+							room_ids.append(eid)
+			return list(definitions), room_ids
+
+	# Load the changed content and patch the games with it. Games sharing
+	# a world only need one of them patched. Returns the ids of the
+	# definitions that changed
+	def reload(self, games):
+		eids, room_ids = self.load()
+		if eids:
+			for game in games:
+				self.patch(game, eids, room_ids)
+		return eids
+
+	# Apply changed definitions to the entities of a game's world, adding
+	# the map's new rooms. Returns the number of entities patched. A
+	# reload isn't an event, so the game stops recording, and the undo
+	# history can't reach across it, so it starts over
+	def patch(self, game, eids, room_ids=()):
+		token = _active_game.set(None)
+		try:
+			added = list()
+			for eid in room_ids:
+				if game.map.get_room(eid) is None:
+					self._add_room(game, eid)
+					added.append(eid)
+			patches = list()
+			# Entities that only take values from the new one can share it
+			new_entities = dict()
+			for eid in eids:
+				if eid in added:
+					continue
+				for entity, room in self._get_entities(game, eid):
+					overrides = getattr(entity, "_overrides", None)
+					key = json.dumps(overrides, sort_keys=True) if overrides else eid
+					new_entity = new_entities.get(key)
+					if new_entity is None:
+						new_entity = self.entity_factory._create_entity(overrides or eid)
+						if not isinstance(new_entity, (Room, Door, Chest, Monster)):
+							new_entities[key] = new_entity
+					if type(new_entity) is type(entity):
+						patches.append((entity, new_entity, room))
+			with game.map.lock_rooms({room for entity, new_entity, room in patches}):
+				for entity, new_entity, room in patches:
+					self._patch_entity(game, entity, new_entity, room)
+		finally:
+			_active_game.reset(token)
+		if patches:
+			game.world_index.rename()
+			if game.event_log:
+				_log("Stopped recording '%s', since a reload can't be replayed" % game.event_log.filepath)
+				game.stop_recording()
+			if not game.history.is_empty():
+				_log("Cleared the undo history of '%s' for a reload" % game.name)
+				game.history.clear()
+		return len(patches)
+
+	def _add_room(self, game, eid):
+		room = self.entity_factory._create_entity(eid)
+		game.map.add_room(room)
+		game._register(room)
+		game.world_index.add_room(room)
+		index = game.map.get_room_index(room)
+		for monster in room.get_monsters():
+			game.schedule_wander(index, monster, initial=True)
+
+	# Return the (entity, room it's in) pairs for an entity id. Items
+	# players carry aren't in the world index, and neither are the keys
+	# and puzzles of doors, which are only looked for when a key or
+	# puzzle changes
+	def _get_entities(self, game, eid):
+		entity_type = eid[:3]
+		if entity_type == "rom":
+			room = game.map.get_room(eid)
+			return [(room, room)] if room else list()
+		elif entity_type == "dor":
+			return [(room.get_door(eid), room) for room in game.map.get_rooms(door=eid)]
+		entities = [(entity, game.world_index.get_location(entity)[0]) for entity in game.world_index.get_entities(eid)]
+		number = _eid_numbers.get(eid)
+		for character in game.characters:
+			entities.extend((item, None) for item in self._get_carried(character.inventory, number))
+		if entity_type in ("key", "puz"):
+			for room in game.map.get_rooms():
+				for door in room.get_doors():
+					entities.extend((entity, room) for entity in (door.key, door.puzzle) if entity and entity.iid == number)
+		return entities
+
+	def _get_carried(self, inventory, number):
+		items = list()
+		for item in inventory.get_items():
+			if item.iid == number:
+				items.append(item)
+			items.extend(self._get_carried(item.inventory, number))
+		return items
+
+	def _patch_entity(self, game, entity, new_entity, room):
+		doors = list(room.get_doors()) if room else list()
+		name = room.name if room else None
+		# A monster's items are replaced, so it's indexed again with them
+		inventory = entity.inventory if isinstance(entity, Monster) else None
+		if inventory and room:
+			game.world_index.update(MonsterRemoved, (room, entity))
+		for added in entity.refresh(new_entity):
+			game._register(added)
+		if inventory:
+			game._unregister(inventory)
+			if room:
+				game.world_index.update(MonsterAdded, (room, entity))
+		# The way through the map changes with the doors and their keys
+		# and puzzles
+		if isinstance(entity, (Room, Door, Key, Puzzle)) and room:
+			game.map.update_room(room, doors, name)
+		elif isinstance(entity, CombatItem):
+			owner = game.world_index.get_owner(entity)
+			for character in game.characters + [owner]:
+				if isinstance(character, Character):
+					character.invalidate_combat_stats()
+
+# Tracks a game's memory use while it runs. Every `every` commands
+# it takes a tracemalloc snapshot and diffs it against the previous one,
+# keeping the traced size after each check so growth can be spotted
+class MemoryTracker:
+	def __init__(self, every=100, frames=1):
+		self._every = max(1, int(every))
+		self._command_count = 0
+		# Leave tracing alone if something else started it
+		self._owns_tracing = not tracemalloc.is_tracing()
+		if self._owns_tracing:
+			tracemalloc.start(frames)
+		self._snapshot = self._take_snapshot()
+		self._diff = list()
+		# (command count, traced bytes) for the most recent checks
+		self._sizes = deque(maxlen=100)
+
+	def _take_snapshot(self):
+		return tracemalloc.take_snapshot().filter_traces((
+			tracemalloc.Filter(False, tracemalloc.__file__),
+		))
+
+	def is_running(self):
+		return self._snapshot is not None
+
+	# Called after each command
+	def end_command(self):
+		if self.is_running():
+			self._command_count += 1
+			if self._command_count % self._every == 0:
+				self.check()
+
+	def check(self):
+		snapshot = self._take_snapshot()
+		self._diff = snapshot.compare_to(self._snapshot, "lineno")
+		self._snapshot = snapshot
+		self._sizes.append((self._command_count, tracemalloc.get_traced_memory()[0]))
+
+	def stop(self):
+		if self._owns_tracing:
+			tracemalloc.stop()
+		self._snapshot = None
+
+	def get_sizes(self):
+		return list(self._sizes)
+
+	def status(self):
+		if not self.is_running():
+			return "Memory tracker stopped after %i commands" % self._command_count
+		current, peak = tracemalloc.get_traced_memory()
+		return "Memory tracker running after %i commands, checking every %i: %.1f KiB traced, %.1f KiB peak" % (
+			self._command_count,
+			self._every,
+			current / 1024,
+			peak / 1024
+		)
+
+	# Return the source lines whose allocations changed the most between
+	# the last two checks
+	def report(self, count=10):
+		lines = [self.status()]
+		for command_count, size in self.get_sizes()[-5:]:
+			lines.append("after %i commands: %.1f KiB" % (command_count, size / 1024))
+		for stat in self._diff[:count]:
+			lines.append(str(stat))
+		return "\n".join(lines)
+
+# Return {class name: (live instances, instances in the game's world)}
+# for the entities and inventories alive in the process. Objects that are
+# alive but no longer in the world are kept by undo history or leaked
+def get_object_counts(game):
+	counts = dict()
+	for obj in gc.get_objects():
+		if isinstance(obj, (Entity, Inventory)):
+			name = obj.__class__.__name__
+			counts[name] = counts.get(name, 0) + 1
+	world_counts = dict()
+	for obj in game.get_world_objects():
+		name = obj.__class__.__name__
+		world_counts[name] = world_counts.get(name, 0) + 1
+	return {name: (count, world_counts.get(name, 0)) for name, count in counts.items()}
+
+# The starting state of a game, from which new games sharing its content
+# and settings are made without reading any files. The game is kept
+# pickled, since unpickling it is far quicker than building or copying it
+class GameTemplate:
+	def __init__(self, game):
+		self.entity_factory = game.entity_factory
+		self.settings = game.settings
+		# Objects every game shares rather than copies, by id
+		self._shared = {id(self.entity_factory): self.entity_factory, id(self.settings): self.settings}
+		for loot_table in self.entity_factory._loot_tables.values():
+			self._shared[id(loot_table)] = loot_table
+		f = io.BytesIO()
+		pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+		pickler.persistent_id = lambda obj: id(obj) if id(obj) in self._shared else None
+		pickler.dump(game)
+		self._data = f.getvalue()
+
+	def create(self, name=None):
+		unpickler = pickle.Unpickler(io.BytesIO(self._data))
+		unpickler.persistent_load = self._shared.__getitem__
+		game = unpickler.load()
+		if name:
+			game._name = name
+			game.player.name = name
+		return game
+
+# Guards the character list shared by the players of a world
+_join_lock = threading.Lock()
+
 class Game:
 	# pylint: disable=too-many-instance-attributes
-	def __init__(self, settings_filepath="config.json", name=None):
+	def __init__(self, settings_filepath="config.json", name=None, record=False):
 		# Default attributes
 		self._filepaths = {
 			"config": None,
@@ -1562,6 +4563,13 @@ class Game:
 		self.view = None
 		self.characters = list()
 		self._map = None
+		# Every object in the world, by the ref it's logged with
+		self._objects = RefTable()
+		self.event_log = None
+		self.profiler = None
+		self.memory_tracker = None
+		self.scheduler = TimingWheel()
+		self.world_index = WorldIndex(self)
 		map_entity_ids = list()
 
 		# Load settings
@@ -1569,42 +4577,66 @@ class Game:
 		self.settings = self.read_settings(settings_filepath)
 		_log("Config:", self.settings, level=4)
 
-		# Load entity definitions
-		self.entity_factory = EntityFactory()
+		# Undo history
+		self.history = History(self.settings.get("undo_depth", 100))
+
+		# Find the entity files, in a fixed order so that duplicate ids
+		# always resolve the same way, and the map
+		filepaths = list()
 		for node in os.walk("entities"):
 			directory = node[0]
-			filepaths = node[2]
-			for filepath in filepaths:
-				filepath = os.path.join(directory, filepath)
-				settings = self.read_settings(filepath)
-				if settings:
-					self._filepaths["entities"].append(filepath)
-					for entity_dict in settings.get("entities"):
-						self.entity_factory.add_definition(entity_dict)
-
-		# Load map definitions
+			for filepath in node[2]:
+				filepaths.append(os.path.join(directory, filepath))
+		filepaths.sort()
 		map_filename = self.settings.get("map")
-		if map_filename:
-			map_filepath = os.path.join("maps", self.settings.get("map"))
-			if not os.path.isfile(map_filepath):
-				raise MapNotFound()
-			settings = self.read_settings(map_filepath)
-			if settings:
-				self._filepaths["map"] = map_filepath
-				for entity_dict in settings.get("entities"):
-					self.entity_factory.add_definition(entity_dict)
-					map_entity_ids.append(entity_dict.get("id"))
-			else:
-				raise MapNotFound()
-		else:
+		if not map_filename:
+			raise MapNotFound()
+		map_filepath = os.path.join("maps", map_filename)
+		if not os.path.isfile(map_filepath):
 			raise MapNotFound()
 
-		# Create character
-		self.player = Player("me")
-		self.characters.append(self.player)
+		# Use the compiled catalog of the content if it's up to date, or
+		# load the content and compile it
+		catalog_filepath = self.settings.get("catalog")
+		sources = filepaths + [map_filepath]
+		if catalog_filepath and Catalog.is_current(catalog_filepath, sources):
+			catalog = Catalog(catalog_filepath)
+			self.entity_factory = EntityFactory(catalog=catalog)
+			map_entity_ids = catalog.get_map_ids()
+			self._filepaths["entities"] = filepaths
+		else:
+			self.entity_factory = EntityFactory()
+			map_entity_ids = self._load_content(filepaths, map_filepath)
+			if catalog_filepath:
+				try:
+					Catalog.compile(catalog_filepath, self.entity_factory.get_definitions(), map_entity_ids, sources)
+				except Exception as e:
+					_log("Failed to compile catalog '%s': %s" % (catalog_filepath, str(e)))
+		if not map_entity_ids:
+			raise MapNotFound()
+		self._filepaths["map"] = map_filepath
+		self.content_watcher = ContentWatcher(self.entity_factory, self._filepaths["entities"], map_filepath)
 
-		# Build game map
-		self.build_map(map_entity_ids)
+		# Nothing built here is a change to a game that's already running
+		token = _active_game.set(None)
+		try:
+			# Create character
+			self.player = Player("me")
+			self.characters.append(self.player)
+
+			# Build game map
+			self.build_map(map_entity_ids)
+			self._register(self.map)
+			self._register(self.player)
+			self.schedule_world()
+		finally:
+			_active_game.reset(token)
+
+		# Log every change to the world, if asked to. Games built to
+		# replay or load into, or to serve, must leave the log alone, since
+		# recording starts it over
+		if record and self.settings.get("event_log"):
+			self.record(self.settings.get("event_log"))
 
 	@property
 	def name(self):
@@ -1623,22 +4655,91 @@ class Game:
 			filename = self.name
 		return "." + filename + self.save_extension
 
+	# The undo history refers to live objects, and the event log to an
+	# open file, so neither is saved. The interned entity ids and the
+	# last uid are, since they only hold in this process
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state["history"]
+		state["event_log"] = None
+		state["profiler"] = None
+		state["memory_tracker"] = None
+		state["_eids"] = _eids[:]
+		state["_last_uid"] = next(_uids)
+		return state
+
+	def __setstate__(self, state):
+		eids = state.pop("_eids", None)
+		_reserve_uids(state.pop("_last_uid", 0))
+		self.__dict__.update(state)
+		self.history = History(self.settings.get("undo_depth", 100))
+		self.profiler = None
+		self.memory_tracker = None
+		if "world_index" not in state:
+			self.world_index = WorldIndex(self)
+		if "content_watcher" not in state:
+			self.content_watcher = ContentWatcher(self.entity_factory, self._filepaths["entities"], self._filepaths["map"])
+		# Games saved before the world ran on its own
+		if "scheduler" not in state:
+			self.scheduler = TimingWheel()
+			self.schedule_world()
+		# Games pickled before refs could be taken back kept them in a list
+		if isinstance(state.get("_objects"), list):
+			objects = self._objects
+			self._objects = RefTable()
+			for obj in objects:
+				self._objects.add(obj)
+		# Games pickled by this process, or one forked from it, share its
+		# interned ids
+		if eids is None or _eids[:len(eids)] != eids:
+			self._reintern_eids(eids)
+		# Games pickled before changes were logged give their objects refs
+		# like loaded saves do
+		if "_objects" not in state:
+			self.event_log = None
+			self._objects = RefTable()
+			self._register(self.map)
+			self._register(self.player)
+
+	# Intern the entity ids of a game loaded from another process, given
+	# the ids it had interned, or None for games saved before ids were
+	# interned
+	def _reintern_eids(self, eids):
+		numbers = [_intern_eid(eid) for eid in eids or ()]
+		entities = [obj for obj in self.get_world_objects() if isinstance(obj, Entity)]
+		for character in self.characters:
+			entities.extend(item for item in character.equipped if item not in entities)
+		for entity in entities:
+			if eids is None:
+				entity.iid = _intern_eid(entity.__dict__.pop("eid", None))
+			elif entity.iid is not None:
+				entity.iid = numbers[entity.iid]
+		self.map.reindex()
+
+	# The game is saved to memory while the player's room is held, and
+	# written out after it's released
 	def save(self, filename=None):
 		filepath = self.save_filepath(filename)
 		try:
+			data = io.BytesIO()
+			with self.map.lock_rooms([self.map.current_room]):
+				SaveFile.dump(self, data, self.settings.get("save_compression", "zlib"))
 			with open(filepath, "wb") as f:
-				pickle.dump(self, f)
+				f.write(data.getvalue())
 			return filepath
-		except:
-			pass
+		except Exception as e:
+			_log("Failed to save '%s': %s" % (filepath, str(e)))
 
 	def load(self, filename=None):
 		filepath = self.save_filepath(filename)
 		try:
 			with open(filepath, "rb") as f:
+				if SaveFile.is_save(f):
+					return SaveFile.load(f, self._filepaths["config"])
+				# Saves from before the save format were pickled
 				return pickle.load(f)
-		except:
-			pass
+		except Exception as e:
+			_log("Failed to load '%s': %s" % (filepath, str(e)))
 		return False
 
 	def create_controller(self, controller):
@@ -1673,8 +4774,53 @@ class Game:
 			_log("Invalid settings file '%s': %s" % (filepath, str(e)))
 			return {}
 
+	# Load the entity definitions, then the map's, into the entity factory
+	# and return the ids of the map's entities. Later definitions replace
+	# earlier ones with the same id
+	def _load_content(self, filepaths, map_filepath):
+		map_entity_ids = list()
+		sources = dict()
+		for filepath, definitions, problems in self.load_definitions(filepaths + [map_filepath]):
+			for problem in problems:
+				_log("Invalid definition in '%s': %s" % (filepath, problem))
+			if definitions is None:
+				if filepath == map_filepath:
+					raise MapNotFound()
+				continue
+			for entity_dict in definitions:
+				eid = entity_dict["id"]
+				if eid in sources:
+					_log("'%s' in '%s' replaces the definition in '%s'" % (eid, filepath, sources[eid]), level=2)
+				sources[eid] = filepath
+				self.entity_factory.add_definition(entity_dict)
+				if filepath == map_filepath:
+					map_entity_ids.append(eid)
+			if definitions and filepath != map_filepath:
+				self._filepaths["entities"].append(filepath)
+		return map_entity_ids
+
+	# Return (filepath, definitions, problems) for each file, in order,
+	# parsing large content packs across a pool of processes. Definitions
+	# is None if the file couldn't be read
+	def load_definitions(self, filepaths):
+		workers = self.settings.get("load_workers") or os.cpu_count() or 1
+		try:
+			size = sum(os.path.getsize(filepath) for filepath in filepaths)
+		except OSError:
+			size = 0
+		# Starting the pool costs more than parsing a small pack
+		if workers < 2 or len(filepaths) < 2 or size < _parallel_load_size:
+			return [_load_definitions(filepath) for filepath in filepaths]
+		with concurrent.futures.ProcessPoolExecutor(min(workers, len(filepaths))) as executor:
+			return list(executor.map(_load_definitions, filepaths))
+
+	# Patch the world with the content files changed since they were
+	# loaded, and return the ids of the definitions that changed
+	def reload_content(self):
+		return self.content_watcher.reload([self])
+
 	def build_map(self, map_entity_ids):
-		self.map = Map()
+		self.map = Map(history_depth=self.settings.get("history_depth", 100))
 		for eid in map_entity_ids:
 			entity = self.entity_factory.create_entity(eid)
 			if isinstance(entity, Room):
@@ -1687,26 +4833,389 @@ class Game:
 
 	def is_won(self, value=None):
 		if isinstance(value, bool):
-			if self.is_won() == False and value == True:
-				message = self.settings.get("win", dict()).get("message")
-				if message:
-					self.view.output(message)
 			self._is_won = value
 		return self._is_won
 
+	# Check a command's output against the winning condition. If it wins
+	# the game, return the winning message ("" if there isn't one)
+	def check_win(self, output):
+		win_condition = self.settings.get("win", dict())
+		if self._is_won or not output:
+			return None
+		_log("Checking output against the winning condition", win_condition, level=6)
+		contains = win_condition.get("output_contains")
+		matches = win_condition.get("output_matches")
+		if (contains and contains in output) or (matches and matches == output):
+			# The game is won!
+			self.is_won(True)
+			return win_condition.get("message") or ""
+
+	## Batches
+	# Run the commands in a line, separated by the command separator
+	def execute(self, line):
+		separator = self.settings.get("command_separator", ";")
+		return self.execute_batch(self._split_commands(line, separator) if separator else [line])
+
+	# Split a line at the separator, except where it's escaped with a
+	# backslash, as puzzle answers may need. An eval takes the rest of the
+	# line as it is, since Python code has its own uses for the separator
+	@staticmethod
+	def _split_commands(line, separator):
+		commands = list()
+		for part in line.split(separator):
+			if commands and commands[-1].lower().split()[:1] == ["eval"]:
+				commands[-1] += separator + part
+			elif commands and commands[-1].endswith("\\"):
+				commands[-1] = commands[-1][:-1] + separator + part
+			else:
+				commands.append(part)
+		return commands
+
+	# Run commands as one unit and return their combined output, so that
+	# it's rendered once. The batch stops early once a command wins the
+	# game, kills the player or quits
+	def execute_batch(self, lines):
+		outputs = list()
+		for line in lines:
+			# Allow for a trailing separator
+			if len(lines) > 1 and not line.strip():
+				continue
+			output = self.cmd_controller.execute_line(line)
+			message = self.check_win(output)
+			if output:
+				outputs.append(output + "\n" + message if message else output)
+			if message is not None or not self.is_running() or not self.player.is_alive():
+				break
+		return "\n\n".join(outputs)
+
 	def get_character(self, eid=None, name=None):
-		name = str(name).lower()
+		number = _eid_numbers.get(eid) if eid else None
 		for character in self.characters:
-			if character.eid == eid:
-				return character
-			elif name in character.name.lower():
+			if number is not None and character.iid == number:
 				return character
+		if name:
+			# Names can change, so they're gone through per lookup
+			return NameIndex.match(name, [(character.name, character) for character in self.characters])
+
+	# Mutations made inside the block belong to this game
+	@contextlib.contextmanager
+	def activate(self):
+		token = _active_game.set(self)
+		try:
+			yield
+		finally:
+			_active_game.reset(token)
+
+	## Events
+	# Give every object reachable from `obj` a ref. The walk always visits
+	# objects in the same order, so a game rebuilt from the same content
+	# gives the same objects the same refs
+	def _register(self, obj):
+		objects = [obj]
+		while objects:
+			obj = objects.pop()
+			if obj is None or "_ref" in obj.__dict__:
+				continue
+			obj._ref = self._objects.add(obj)
+			objects.extend(reversed(self._get_children(obj)))
+
+	# Take the refs back from an object and everything it owns, once it
+	# has left the world for good, so they don't keep it alive
+	def _unregister(self, obj):
+		objects = [obj]
+		while objects:
+			obj = objects.pop()
+			if obj is None or "_ref" not in obj.__dict__:
+				continue
+			_touch(obj)
+			self._objects.discard(obj._ref)
+			del obj._ref
+			objects.extend(self._get_children(obj))
+
+	# Return the objects directly owned by an object in the world
+	@staticmethod
+	def _get_children(obj):
+		if isinstance(obj, Map):
+			return obj.get_rooms()
+		elif isinstance(obj, Room):
+			return [obj.inventory] + obj.get_doors() + obj.get_monsters()
+		elif isinstance(obj, Door):
+			return [obj.puzzle, obj.key]
+		elif isinstance(obj, Chest):
+			return [obj.inventory, obj.key]
+		elif isinstance(obj, (Item, Character)):
+			return [obj.inventory]
+		elif isinstance(obj, Inventory):
+			return obj.get_items()
+		return list()
+
+	# Return every object reachable from the map and the characters
+	def get_world_objects(self):
+		found = dict()
+		objects = [self.map] + self.characters
+		while objects:
+			obj = objects.pop()
+			if obj is not None and id(obj) not in found:
+				found[id(obj)] = obj
+				objects.extend(self._get_children(obj))
+		return list(found.values())
+
+	# Called for entities created while the game is active
+	def add_entity(self, eid, entity):
+		self._register(entity)
+		_emit(EntityCreated, json.dumps(eid) if isinstance(eid, dict) else str(eid))
+
+	# Called for entities that are gone from the world for good, such as
+	# defeated monsters. Respawns are new entities
+	def remove_entity(self, entity):
+		_emit(EntityRemoved, entity)
+		self._unregister(entity)
+
+	# Start logging every change to the world to a file
+	def record(self, filepath):
+		self.stop_recording()
+		self.event_log = EventLog(filepath)
+
+	def stop_recording(self):
+		if self.event_log:
+			self.event_log.close()
+			self.event_log = None
+
+	# Apply logged events to this game, which must have been built from
+	# the same content as the game that logged them, optionally stopping
+	# after `count` events. Returns the number of events applied
+	def replay(self, events, count=None):
+		applied = 0
+		with self.activate():
+			for event in events:
+				if count is not None and applied >= count:
+					break
+				self._apply_event(event)
+				applied += 1
+		return applied
+
+	def _apply_event(self, event):
+		objects = [self._objects.get(field) if isinstance(field, int) else None for field in event]
+		event_type = type(event)
+		if event_type is InventoryAdd:
+			objects[0].add(objects[1])
+		elif event_type is InventoryPop:
+			objects[0].pop(uid=objects[1].uid)
+		elif event_type is HealthChanged:
+			objects[0].health = event.health
+		elif event_type is NameChanged:
+			objects[0].name = event.name
+		elif event_type is BaseAttackChanged:
+			objects[0].set_base_attack(event.attack)
+		elif event_type is Equipped:
+			objects[1].equip(objects[0])
+		elif event_type is Unequipped:
+			objects[1].unequip(objects[0])
+		elif event_type is MonsterAdded:
+			objects[0].add_monster(objects[1])
+		elif event_type is MonsterRemoved:
+			objects[0].discard_monster(objects[1])
+		elif event_type is MonsterChosen:
+			objects[0].set_monster(objects[1])
+		elif event_type is PuzzleSolved:
+			objects[0].is_solved(bool(event.is_solved))
+		elif event_type is ChestLocked:
+			objects[0].is_locked(bool(event.is_locked))
+		elif event_type is RoomChanged:
+			objects[0].go_to(event.index)
+		elif event_type is RoomBack:
+			objects[0].go_back(event.steps)
+		elif event_type is EntityCreated:
+			eid = json.loads(event.eid) if event.eid.startswith("{") else event.eid
+			self.entity_factory.create_entity(eid)
+		elif event_type is EntityRemoved:
+			self.remove_entity(objects[0])
+		elif event_type is Snapshot:
+			self.snapshot()
+		elif event_type is Undo:
+			self.undo()
+		elif event_type is Rollback:
+			self.rollback(event.snapshot_id)
+
+	## World simulation
+	# The world moves on one tick after every command. Monsters wander
+	# between rooms and respawn after being defeated, and characters
+	# regain health, each every so many ticks as set in the settings (0
+	# to turn it off). Timers are checked when they fire rather than
+	# cancelled, so those for monsters or characters that are gone are
+	# simply dropped
+	def schedule_world(self):
+		for index, room in enumerate(self.map.get_rooms()):
+			for monster in room.get_monsters():
+				self.schedule_wander(index, monster, initial=True)
+		for character in self.characters:
+			self.schedule_regen(character)
+
+	# Spread the first timers out so that everything doesn't move at once
+	def schedule_wander(self, room_index, monster, initial=False):
+		ticks = self.settings.get("wander_ticks", 0)
+		if ticks and not monster.is_boss():
+			self.scheduler.schedule(random.randint(1, ticks) if initial else ticks, ("wander", room_index, monster))
+
+	# The timer keeps the map of the character's game, which knows the
+	# room the character is in
+	def schedule_regen(self, character, map=None):
+		ticks = self.settings.get("regen_ticks", 0)
+		if ticks:
+			self.scheduler.schedule(ticks, ("regen", character, map or self.map))
+
+	def schedule_respawn(self, room, monster):
+		ticks = self.settings.get("respawn_ticks", 0)
+		if ticks and not monster.is_boss():
+			definition = getattr(monster, "_overrides", None) or monster.eid
+			self.scheduler.schedule(ticks, ("respawn", self.map.get_room_index(room), definition))
+
+	def tick(self):
+		for timer in self.scheduler.advance():
+			if timer[0] == "wander":
+				self._wander(*timer[1:])
+			elif timer[0] == "regen":
+				self._regen(*timer[1:])
+			elif timer[0] == "respawn":
+				self._respawn(*timer[1:])
+
+	# Move a monster through a door without a key or puzzle, unless it's
+	# the one a player is facing
+	def _wander(self, room_index, monster):
+		rooms = self.map.get_rooms()
+		room = rooms[room_index]
+		exits = [(door, other) for door, other in self.map.get_exits(room_index) if not door.key and not door.puzzle]
+		with self.map.lock_rooms([room] + [rooms[other] for door, other in exits]):
+			if monster not in room.get_monsters():
+				return
+			if exits and monster is not room.monster and monster.health > 0:
+				door, room_index = random.choice(exits)
+				room.discard_monster(monster)
+				rooms[room_index].add_monster(monster)
+		self.schedule_wander(room_index, monster)
+
+	# In a shared world the timer can fire on another player's thread, so
+	# the character's room is held like a fight in it holds it. The
+	# character may have moved on before the room was held
+	def _regen(self, character, map=None):
+		map = map or self.map
+		while True:
+			room = map.current_room
+			with map.lock_rooms([room]):
+				if room is not map.current_room:
+					continue
+				if character not in self.characters or character.health <= 0:
+					return
+				if character.health < character.max_health:
+					character.health = min(character.health + self.settings.get("regen_amount", 1), character.max_health)
+				break
+		self.schedule_regen(character, map)
+
+	def _respawn(self, room_index, definition):
+		room = self.map.get_rooms()[room_index]
+		with self.map.lock_rooms([room]):
+			monster = self.entity_factory.create_entity(definition)
+			if isinstance(monster, Monster):
+				room.add_monster(monster)
+		if isinstance(monster, Monster):
+			self.schedule_wander(room_index, monster)
+
+	## Shared worlds
+	# Add another player to this game's world. The returned game shares
+	# rooms, monsters, items and characters with this one but has its own
+	# player, position, view and controller. Rooms are locked per command
+	# instead of being undoable, so undo is disabled for every player
+	def join(self, name=None):
+		game = Game.__new__(Game)
+		game.__dict__.update(self.__dict__)
+		game.player = Player(name=name)
+		# Players save their own games
+		game._name = name or self._name
+		game.map = self.map.share()
+		game.view = None
+		game.cmd_controller = None
+		self.history = History(0)
+		game.history = History(0)
+		# Neither can the world's changes be logged by one game
+		self.stop_recording()
+		game.event_log = None
+		with _join_lock:
+			self.characters.append(game.player)
+		self.schedule_regen(game.player, game.map)
+		return game
+
+	# Remove a game's player from the world it joined
+	def leave(self, game):
+		with _join_lock:
+			if game.player in self.characters:
+				self.characters.remove(game.player)
+
+	## Snapshots
+	def snapshot(self):
+		_emit(Snapshot)
+		return self.history.snapshot()
+
+	# Undo restores objects without going through their setters, so
+	# neither the index nor the version stamps see it
+	def rollback(self, snapshot_id):
+		self.world_index.invalidate()
+		self.map.clear_routes()
+		if self.history.rollback(snapshot_id):
+			_emit(Rollback, snapshot_id)
+			return True
+		return False
 
-	# Copy game state
+	# Undo is logged as a rollback to the snapshot it reverted to. Ticks
+	# that only moved timers make generations that a replay doesn't, so
+	# undoing "the last one" could revert another command there
+	def undo(self):
+		self.world_index.invalidate()
+		self.map.clear_routes()
+		snapshot_id = self.history.undo()
+		if snapshot_id:
+			_emit(Rollback, snapshot_id)
+		return snapshot_id
+
+	# Copy game state, keeping this game's view and controller. The undo
+	# history can't reach across the copy, so it starts over
 	def copy(self, game):
+		view = self.view
+		cmd_controller = self.cmd_controller
+		profiler = self.profiler
+		memory_tracker = self.memory_tracker
+		# The event log can't describe how the other game got to its state
+		self.stop_recording()
 		self.__dict__ = game.__dict__.copy()
+		self.view = view
+		self.cmd_controller = cmd_controller
+		self.profiler = profiler
+		self.memory_tracker = memory_tracker
+		self.history = History(self.settings.get("undo_depth", 100))
+
+class View:
+	# Write out any output held back
+	def flush(self):
+		pass
+
+# Collects the output for another view and writes it in one go, when
+# input is asked for or the view is flushed
+class BufferedView(View):
+	def __init__(self, view):
+		self.view = view
+		self._buffer = list()
+
+	def input(self, prompt=None):
+		self.flush()
+		return self.view.input(prompt)
+
+	def output(self, value=""):
+		self._buffer.append(str(value))
 
-class View: pass
+	def flush(self):
+		if self._buffer:
+			self.view.output("\n".join(self._buffer))
+			self._buffer = list()
+		self.view.flush()
 
 class TUI(View):
 	def __init__(self, prompt=": "):
@@ -1728,6 +5237,294 @@ class TUI(View):
 	def output(self, value=""):
 		print(value)
 
+# Talks to a player over a socket. Every read is preceded by a prompt,
+# so clients know the output of their last command is complete once the
+# prompt arrives
+class SocketView(View):
+	def __init__(self, rfile, wfile, prompt="> "):
+		self._rfile = rfile
+		self._wfile = wfile
+		self.prompt = prompt
+
+	def input(self, prompt=None):
+		if prompt == None:
+			prompt = self.prompt
+		self._wfile.write(prompt.encode("utf-8"))
+		self.flush()
+		line = self._rfile.readline()
+		if not line:
+			raise EOFError()
+		return line.decode("utf-8", "replace").rstrip("\r\n")
+
+	def output(self, value=""):
+		self._wfile.write((str(value) + "\n").encode("utf-8"))
+
+	def flush(self):
+		self._wfile.flush()
+
+# Talks to a player over asyncio streams. Input and output are awaited,
+# so one thread can serve every player. Output is written once the
+# prompt for the next command is
+class AsyncView(View):
+	def __init__(self, reader, writer, prompt="> "):
+		self._reader = reader
+		self._writer = writer
+		self.prompt = prompt
+
+	async def input(self, prompt=None):
+		if prompt == None:
+			prompt = self.prompt
+		self._writer.write(prompt.encode("utf-8"))
+		await self.flush()
+		line = await self._reader.readline()
+		if not line:
+			raise EOFError()
+		return line.decode("utf-8", "replace").rstrip("\r\n")
+
+	async def output(self, value=""):
+		self._writer.write((str(value) + "\n").encode("utf-8"))
+
+	async def flush(self):
+		await self._writer.drain()
+
+# Serves one shared world to every player that connects
+class GameServer(socketserver.ThreadingTCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def __init__(self, address, world):
+		self.world = world
+		self._player_count = 0
+		self._count_lock = threading.Lock()
+		# Worker processes number their players apart so saves don't clash
+		self.player_prefix = "player"
+		super().__init__(address, GameRequestHandler)
+
+	def next_player_name(self):
+		with self._count_lock:
+			self._player_count += 1
+			return "%s%i" % (self.player_prefix, self._player_count)
+
+	# Return the game for a new connection, and clean up after it
+	def create_game(self):
+		return self.world.join(self.next_player_name())
+
+	def end_game(self, game):
+		self.world.leave(game)
+
+	# Check the content files for changes every so many seconds, from a
+	# thread of its own
+	def watch_content(self, seconds):
+		def watch():
+			while True:
+				time.sleep(seconds)
+				try:
+					self.reload_content()
+				except Exception as e:
+					_log("Failed to reload content: %s" % str(e))
+		threading.Thread(target=watch, daemon=True).start()
+
+	# The shared world is patched under its room locks
+	def reload_content(self):
+		return self.world.reload_content()
+
+	# Bring a game up to date with the content before its next command
+	def update_game(self, game):
+		pass
+
+# Gives every connection a game of its own, made from a template
+class SessionServer(GameServer):
+	def __init__(self, address, template):
+		self.template = template
+		# Content changes in the order they were loaded, and the number of
+		# them applied to each session
+		self._updates = list()
+		self._versions = dict()
+		super().__init__(address, template.create())
+
+	def create_game(self):
+		version = len(self._updates)
+		game = self.template.create(self.next_player_name())
+		self._versions[game] = version
+		return game
+
+	def end_game(self, game):
+		self._versions.pop(game, None)
+
+	# Sessions aren't locked, so each takes the changes from its own
+	# thread, between commands. New sessions are made from a template
+	# that has them
+	def reload_content(self):
+		eids, room_ids = self.world.content_watcher.load()
+		if eids:
+			game = self.template.create()
+			self.world.content_watcher.patch(game, eids, room_ids)
+			self.template = GameTemplate(game)
+			self._updates.append((eids, room_ids))
+		return eids
+
+	def update_game(self, game):
+		version = self._versions.get(game, len(self._updates))
+		if version < len(self._updates):
+			can_undo = not game.history.is_empty()
+			for eids, room_ids in self._updates[version:]:
+				self.world.content_watcher.patch(game, eids, room_ids)
+			lines = _describe_reload(game, False, can_undo)
+			if lines:
+				game.view.output("\n".join(lines))
+		self._versions[game] = len(self._updates)
+
+class GameRequestHandler(socketserver.StreamRequestHandler):
+	# Buffer output until the prompt and send it at once, without waiting
+	# for the client to acknowledge the last packet
+	wbufsize = io.DEFAULT_BUFFER_SIZE
+	disable_nagle_algorithm = True
+
+	def handle(self):
+		world = self.server.world
+		game = self.server.create_game()
+		game.view = SocketView(self.rfile, self.wfile)
+		game.register_controller(GameCommandController)
+		try:
+			with game.activate():
+				if not game.map.change_room(eid=world.settings.get("start")):
+					game.map.change_room()
+			game.view.output("You're %s. Type 'help' for help with commands." % game.player.name)
+			game.view.output(game.map.current_room.inspect())
+			while game.is_running() and game.player.is_alive():
+				line = game.view.input()
+				self.server.update_game(game)
+				output = game.execute(line)
+				if output:
+					game.view.output(output)
+			if not game.player.is_alive():
+				game.view.output("Oh no, you died!")
+		# quit exits, which must only end this player's connection
+		except (EOFError, ConnectionError, SystemExit):
+			pass
+		finally:
+			self.server.end_game(game)
+
+# Serve the world in the config file on a port until interrupted
+def serve(port=8023, config_path="config.json", host="localhost"):
+	server = GameServer((host, port), Game(config_path))
+	if server.world.settings.get("reload_seconds"):
+		server.watch_content(server.world.settings.get("reload_seconds"))
+	print("Serving '%s' on %s:%i" % (server.world.settings.get("name"), host, port))
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+# Play a game through an AsyncView until the player quits, dies or
+# disconnects
+async def play_async(game):
+	with game.activate():
+		if not game.map.change_room(eid=game.settings.get("start")):
+			game.map.change_room()
+	await game.view.output("You're %s. Type 'help' for help with commands." % game.player.name)
+	await game.view.output(game.map.current_room.inspect())
+	while game.is_running() and game.player.is_alive():
+		output = game.execute(await game.view.input())
+		if output:
+			await game.view.output(output)
+	if not game.player.is_alive():
+		await game.view.output("Oh no, you died!")
+		await game.view.flush()
+
+# Serve the world like serve(), but from a single thread with asyncio,
+# each player being a coroutine instead of a thread
+def serve_async(port=8023, config_path="config.json", host="localhost"):
+	world = Game(config_path)
+	player_count = itertools.count(1)
+
+	async def handle(reader, writer):
+		game = world.join("player%i" % next(player_count))
+		game.view = AsyncView(reader, writer)
+		game.register_controller(GameCommandController)
+		try:
+			await play_async(game)
+		# quit exits, which would stop the loop and every other player
+		except (EOFError, ConnectionError, SystemExit):
+			pass
+		finally:
+			world.leave(game)
+			writer.close()
+
+	# Players are only ever between commands while the loop runs this
+	async def watch_content(seconds):
+		while True:
+			await asyncio.sleep(seconds)
+			try:
+				world.reload_content()
+			except Exception as e:
+				_log("Failed to reload content: %s" % str(e))
+
+	async def run():
+		server = await asyncio.start_server(handle, host, port, reuse_address=True)
+		print("Serving '%s' on %s:%i" % (world.settings.get("name"), host, port))
+		# The loop only keeps a weak reference to the task
+		watcher = None
+		if world.settings.get("reload_seconds"):
+			watcher = asyncio.create_task(watch_content(world.settings.get("reload_seconds")))
+		async with server:
+			await server.serve_forever()
+
+	asyncio.run(run())
+
+# Load the content once, then fork worker processes that share it and
+# accept connections on the same socket, each connection getting its
+# own game made from the loaded one
+def serve_prefork(workers=None, port=8023, config_path="config.json", host="localhost"):
+	workers = workers or os.cpu_count() or 1
+	start = time.perf_counter()
+	template = GameTemplate(Game(config_path))
+	loaded = time.perf_counter()
+	template.create()
+	created = time.perf_counter()
+	server = SessionServer((host, port), template)
+	# Keep the collector from touching, and so copying, the pages the
+	# workers share with the parent
+	gc.collect()
+	gc.freeze()
+	pids = list()
+	fork_seconds = 0
+	for i in range(workers):
+		fork_start = time.perf_counter()
+		pid = os.fork()
+		if pid == 0:
+			# Don't roll the same monsters in every worker
+			random.seed()
+			server.player_prefix = "player%i-" % (i + 1)
+			# Threads don't survive the fork
+			if template.settings.get("reload_seconds"):
+				server.watch_content(template.settings.get("reload_seconds"))
+			try:
+				server.serve_forever()
+			except KeyboardInterrupt:
+				pass
+			finally:
+				os._exit(0)
+		fork_seconds += time.perf_counter() - fork_start
+		pids.append(pid)
+	print("Serving '%s' on %s:%i with %i workers" % (template.settings.get("name"), host, port, workers))
+	print("Loaded content in %.1f ms, forked workers in %.2f ms each, new games take %.2f ms" % (
+		(loaded - start) * 1000,
+		fork_seconds * 1000 / workers,
+		(created - loaded) * 1000
+	))
+	try:
+		for pid in pids:
+			os.waitpid(pid, 0)
+	except KeyboardInterrupt:
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:
+				pass
+	finally:
+		server.server_close()
+
 def main():
 	# start new game
 	if len(sys.argv) > 1:
@@ -1735,9 +5532,10 @@ def main():
 	else:
 		config_path = "config.json"
 		
-	game = Game(config_path)
+	game = Game(config_path, record=True)
 	game.register_controller(StartCommandController)
-	game.register_view(TUI)
+	# Write each command's output at once
+	game.view = BufferedView(TUI())
 
     # map info
 	if game.settings.get("name"):
@@ -1745,7 +5543,9 @@ def main():
 	if game.settings.get("version"):
 		game.view.output("Version: " + str(game.settings.get("version")))
 	if game.settings.get("ask_name"):
-		game.player.name = game.view.input("Your Name: ")
+		name = game.view.input("Your Name: ")
+		with game.activate():
+			game.player.name = name
 
 	# print brief help
 	game.view.output()
@@ -1758,45 +5558,52 @@ def main():
 
 	# starting location
 	room_id = game.settings.get("start")
-	if not game.map.change_room(eid=room_id):
-		game.map.change_room()
+	with game.activate():
+		if not game.map.change_room(eid=room_id):
+			game.map.change_room()
 #	game.view.output(game.map.current_room.inspect())
 #	game.view.output()
 
-	# Game winning condition
-	win_condition = game.settings.get("win")
-	_log("Winning condition", win_condition, level=2)
-
 	# In-game loop
-	while game.is_running() and game.player.is_alive():
-		# run command
-		try:
-			command = game.view.input()
-		except KeyboardInterrupt:
-			game.view.output()
-			continue
+	try:
+		while game.is_running() and game.player.is_alive():
+			# run command
+			try:
+				command = game.view.input()
+			except KeyboardInterrupt:
+				game.view.output()
+				continue
 
-		_log("Sending command '%s' to controller '%s'" % (command, game.cmd_controller), level=5)
-		output = game.cmd_controller.execute_line(command)
-		if output:
-			game.view.output(output)
-			if win_condition.get("output_contains"):
-				_log("Checking to see if output contains", win_condition.get("output_contains"), level=6)
-				if win_condition.get("output_contains") in output:
-					# The game is won!
-					game.is_won(True)
-			if win_condition.get("output_matches"):
-				if win_condition.get("output_matches") == output:
-					# The game is won!
-					game.is_won(True)
-
-		# aesthetic line space
-		game.view.output()
+			_log("Sending command '%s' to controller '%s'" % (command, game.cmd_controller), level=5)
+			output = game.execute(command)
+			if output:
+				game.view.output(output)
+
+			# aesthetic line space
+			game.view.output()
+	finally:
+		game.view.flush()
 
 	if not game.player.is_alive():
 		raise PlayerIsDead()
 
 if __name__ == "__main__":
+	# usage: tworld.py --serve [port] [config_path]
+	#        tworld.py --serve-async [port] [config_path]
+	#        tworld.py --prefork [workers] [port] [config_path]
+	if sys.argv[1:2] in (["--serve"], ["--serve-async"]):
+		try:
+			(serve if sys.argv[1] == "--serve" else serve_async)(int(sys.argv[2]) if len(sys.argv) > 2 else 8023, *sys.argv[3:4])
+		except KeyboardInterrupt:
+			pass
+		sys.exit()
+	elif sys.argv[1:2] == ["--prefork"]:
+		args = [int(arg) for arg in sys.argv[2:4]]
+		if hasattr(os, "fork"):
+			serve_prefork(*args, *sys.argv[4:5])
+		else:
+			serve(*args[1:], *sys.argv[4:5])
+		sys.exit()
 	while True:
 		try:
 			main()